@@ -0,0 +1,46 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""pytest fixtures shared by the test_*.py files.
+
+The tests run against syringe_emulator, so no hardware is needed:
+    python3 -m pytest -q
+"""
+import pytest
+import syringe_motor
+import syringe_emulator
+
+BAUD=115200
+
+@pytest.fixture
+def emulator():
+    """An emulator answering on addresses 1 and 2. emulator.slave_path is its port."""
+    emu=syringe_emulator.Emulator('12', baud=BAUD)
+    emu.start()
+    yield emu
+    emu.stop()
+
+@pytest.fixture
+def motor(emulator):
+    """A Motor connected to address 1 of the emulator."""
+    m=syringe_motor.Motor()
+    m.connect(emulator.slave_path, BAUD, '1')
+    yield m
+    m.disconnect()
+
+class Counting(syringe_motor.Motor):
+    """A Motor that keeps the commands it sends, in sent."""
+
+    def __init__(self):
+        super(Counting, self).__init__()
+        self.sent=[]
+
+    def sendCommand(self, message, delay=None):
+        self.sent.append(message)
+        return super(Counting, self).sendCommand(message, delay)
+
+@pytest.fixture
+def counting(emulator):
+    """A Counting motor connected to address 1 of the emulator."""
+    m=Counting()
+    m.connect(emulator.slave_path, BAUD, '1')
+    yield m
+    m.disconnect()
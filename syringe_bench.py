@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Round-trip latency benchmarks for the serial command path.
+
+Runs the command sequences ControllerWindow sends against an emulated
+controller (see syringe_emulator) at several baud rates, and reports
+p50/p99 latency and commands per second for each as JSON.
+
+Example:
+    python3 syringe_bench.py --bauds 9600,115200 --output bench.json
+    python3 syringe_bench.py --save-baseline      #store current numbers
+    python3 syringe_bench.py                      #exit 1 on regressions
+
+Numbers depend on the machine, so there is no baseline in the repo.
+Make one on the machine the changes are compared on, before making them.
+Only p50 is compared, relative to the baseline: p99 of a few hundred
+round trips moves with scheduler noise alone. Any new timeout is also a
+regression, so a baseline with timeouts isn't saved.
+
+"""
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import syringe_motor
+import syringe_emulator
+
+BAUDS=[9600, 19200, 38400, 57600, 115200]
+BASELINE_FILE='bench_baseline.json'
+#round trips of each workload's commands, enough for a steady p50
+REPEAT=200
+#how much slower a p50 may get before it counts as a regression, 0.2=20%
+TOLERANCE=0.2
+
+#same strings ControllerWindow builds for a 1 mL, 10 cycle pump with 45 s waits
+PUMP_PROGRAM="gV6000A0gM30000G1M15000V6000A120000gM30000G1M15000G10R"
+
+WORKLOADS={
+    'connect': lambda: ["Q"],
+    'init_motor': lambda: ["L5000R", "V200000R", "Z10000R", "z1073741824R", "&"],
+    'getPosition': lambda: ["?0"],
+    'handlePump': lambda: [PUMP_PROGRAM],
+    'stop': lambda: ["TR", "?0"],
+}
+
+def run_workload(motor, commands, repeat, delay=None):
+    """Sends commands repeat times and times each round trip.
+
+    Returns:
+        (latencies, timeouts, elapsed): per-command latencies in seconds,
+        the number of commands that got no reply, and the total wall time.
+
+    """
+    latencies=[]
+    timeouts=0
+    start=time.perf_counter()
+    for _ in range(repeat):
+        for c in commands:
+            t=time.perf_counter()
+            response=motor.sendRawCommand("/"+motor.motor_address+c, delay)
+            latencies.append(time.perf_counter()-t)
+            if response is None:
+                timeouts+=1
+    return latencies, timeouts, time.perf_counter()-start
+
+def summarize(latencies, timeouts, elapsed):
+    lat=np.array(latencies)
+    return {
+        'p50_ms': float(np.percentile(lat, 50)*1000),
+        'p99_ms': float(np.percentile(lat, 99)*1000),
+        'cmds_per_sec': len(lat)/elapsed,
+        'timeouts': timeouts,
+    }
+
+def bench(bauds=BAUDS, repeat=REPEAT, delay_factor=None, latency=0.0, calibrate=False):
+    """Runs every workload at every baud rate.
+
+    Args:
+        delay_factor (float): multiplies the default 2*bytesize/baudrate
+            delay Motor.wait enforces between port operations. None uses
+            the bus's own delay.
+        latency (float): emulated controller turnaround, in seconds.
+        calibrate (bool): run SerialBus.calibrate before the workloads.
+
+    Returns:
+        {baud: {workload: summary}} with string keys, ready for json.
+
+    """
+    results={}
+    for baud in bauds:
+        #time_scale keeps homing and moves from stalling the later workloads
+        emu=syringe_emulator.Emulator('1', baud=baud, latency=latency, time_scale=1000.0)
+        path=emu.start()
+        motor=syringe_motor.Motor()
+        try:
+            motor.connect(path, baud, '1')
+            if calibrate:
+                motor.bus.calibrate('1')
+            delay=None if delay_factor is None else delay_factor*2*(8.0/baud)
+            results[str(baud)]={}
+            for name, workload in WORKLOADS.items():
+                results[str(baud)][name]=summarize(*run_workload(motor, workload(), repeat, delay))
+        finally:
+            motor.disconnect()
+            emu.stop()
+    return results
+
+def timeouts(results):
+    """Lists the workloads that had commands go unanswered."""
+    return ["%s@%s timeouts: %d"%(name, baud, summary['timeouts'])
+            for baud, workloads in sorted(results.items()) for name, summary in sorted(workloads.items())
+            if summary['timeouts']]
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Lists the p50 latencies that got slower than baseline by more than tolerance, and new timeouts."""
+    regressions=[]
+    for baud, workloads in results.items():
+        for name, summary in workloads.items():
+            base=baseline.get(baud, {}).get(name)
+            if base is None:
+                continue
+            if summary['p50_ms']>base['p50_ms']*(1+tolerance):
+                regressions.append("%s@%s p50_ms: %.2f ms (baseline %.2f ms)"%(name, baud, summary['p50_ms'], base['p50_ms']))
+            if summary['timeouts']>base['timeouts']:
+                regressions.append("%s@%s timeouts: %d (baseline %d)"%(name, baud, summary['timeouts'], base['timeouts']))
+    return regressions
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description="Benchmark serial round trips against an emulated controller.")
+    parser.add_argument('--bauds', default=','.join(str(b) for b in BAUDS))
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--delay-factor', type=float, help="scale the default delay instead of using the bus's")
+    parser.add_argument('--calibrate', action='store_true', help="calibrate the bus timing first")
+    parser.add_argument('--latency', type=float, default=0.0, help="emulated controller turnaround, seconds")
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help="allowed p50 slowdown before flagging, 0.2=20%%")
+    parser.add_argument('--output', help="write results here instead of stdout")
+    args=parser.parse_args(argv)
+
+    results=bench([int(b) for b in args.bauds.split(',')], args.repeat, args.delay_factor, args.latency, args.calibrate)
+    text=json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.save_baseline:
+        lost=timeouts(results)
+        if lost:
+            #a baseline that already loses replies would hide the next lost one
+            for t in lost:
+                print("not saving a baseline with "+t, file=sys.stderr)
+            return 1
+        with open(args.baseline, 'w') as f:
+            f.write(text)
+        return 0
+
+    try:
+        with open(args.baseline) as f:
+            baseline=json.load(f)
+    except EnvironmentError:
+        print("no baseline in "+args.baseline+", make one with --save-baseline", file=sys.stderr)
+        return 0
+    regressions=compare(results, baseline, args.tolerance)
+    for r in regressions:
+        print("REGRESSION: "+r, file=sys.stderr)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
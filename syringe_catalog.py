@@ -0,0 +1,119 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Finds calibration files under a directory, remembering what it found.
+
+A calibration file is an .xml file whose root element is <constants>, as
+written by MotorGroup.serialize. A directory is only listed again if its
+mtime changed, and a file is only opened again if its mtime or size
+changed, so rescanning a large data directory mostly costs stat calls.
+
+Example:
+    catalog=CalibrationCatalog('.')
+    for path in catalog.scan():
+        print(path)
+
+"""
+import os
+import xml.etree.ElementTree as ET
+
+ROOT_TAG='constants'
+#bytes read at a time while looking for the root element
+SNIFF_CHUNK=4096
+
+def sniff_root(path):
+    """Reads only as much of an xml file as needed to find its root tag.
+
+    Returns:
+        the root tag, or None if the file isn't readable xml.
+
+    """
+    parser=ET.XMLPullParser(['start'])
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk=f.read(SNIFF_CHUNK)
+                if not chunk:
+                    return None
+                parser.feed(chunk)
+                for _, element in parser.read_events():
+                    return element.tag
+    except (EnvironmentError, ET.ParseError):
+        return None
+
+class CalibrationCatalog:
+    """Index of the calibration files under root."""
+
+    def __init__(self, root='.'):
+        self.root=root
+        #dir path -> (mtime_ns, subdirectory paths, .xml file paths)
+        self._dirs={}
+        #file path -> (mtime_ns, size, is a calibration file)
+        self._files={}
+
+    def _list_dir(self, path, st):
+        cached=self._dirs.get(path)
+        if cached is not None and cached[0]==st.st_mtime_ns:
+            return cached[1], cached[2]
+        subdirs=[]
+        xmls=[]
+        try:
+            entries=list(os.scandir(path))
+        except EnvironmentError:
+            entries=[]
+        for e in entries:
+            #hidden: .git, and the temp files serialize renames into place
+            if e.name.startswith('.'):
+                continue
+            try:
+                if e.is_dir(follow_symlinks=False):
+                    subdirs.append(e.path)
+                elif e.name.lower().endswith('.xml') and e.is_file():
+                    xmls.append(e.path)
+            except EnvironmentError:
+                continue
+        self._dirs[path]=(st.st_mtime_ns, subdirs, xmls)
+        return subdirs, xmls
+
+    def _is_calibration(self, path):
+        try:
+            st=os.stat(path)
+        except EnvironmentError:
+            self._files.pop(path, None)
+            return False
+        cached=self._files.get(path)
+        if cached is not None and cached[:2]==(st.st_mtime_ns, st.st_size):
+            return cached[2]
+        found=sniff_root(path)==ROOT_TAG
+        self._files[path]=(st.st_mtime_ns, st.st_size, found)
+        return found
+
+    def scan(self):
+        """Lists the calibration files, reusing cached results where nothing changed.
+
+        Returns:
+            sorted paths relative to root.
+
+        """
+        found=[]
+        seen_dirs=set()
+        seen_files=set()
+        stack=[self.root]
+        while stack:
+            path=stack.pop()
+            try:
+                st=os.stat(path)
+            except EnvironmentError:
+                continue
+            seen_dirs.add(path)
+            subdirs, xmls=self._list_dir(path, st)
+            stack.extend(subdirs)
+            for f in xmls:
+                seen_files.add(f)
+                if self._is_calibration(f):
+                    found.append(os.path.relpath(f, self.root))
+
+        #forget removed directories and files
+        for path in set(self._dirs)-seen_dirs:
+            del self._dirs[path]
+        for path in set(self._files)-seen_files:
+            del self._files[path]
+        return sorted(found)
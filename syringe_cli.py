@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Command line control of syringe pumps, without the GUI.
+
+Uses the same calibration file as syringe_pump_controller.py, and never
+imports Qt, so scripts and cron jobs start quickly. Link it into your
+path as syringe-pump to use it like:
+
+    syringe-pump inject --port /dev/ttyUSB0 --addr 1 --ml 0.5 --secs 10
+    syringe-pump position --addr 1
+    syringe-pump run mix.json --port /dev/ttyUSB0
+    syringe-pump profile --addr 1 --flows 0,2,2,0 --secs 60
+    syringe-pump accel --addr 1
+
+Errors are printed to stderr and give exit status 1.
+"""
+import sys
+import json
+import argparse
+import serial
+import syringe_motor
+
+CALIBRATION_FILE='syringe_pump_data.xml'
+
+def _default_port(port):
+    if port is not None:
+        return port
+    ports=syringe_motor.scan_ports()
+    if not ports:
+        raise ValueError("no adapters found. Use --port.")
+    return ports[0]
+
+def open_pump(args):
+    """Loads the calibration and connects to the pump in args.
+
+    Returns:
+        (group, key, motor)
+
+    """
+    group=syringe_motor.MotorGroup()
+    group.load(args.calibration)
+    num=args.addr.upper()
+    sym=syringe_motor.convertToSymbol(num)
+    if sym is None:
+        raise ValueError("--addr must be a pump number from 0 to F")
+    key=group.pump_key(num)
+    motor=group.motordict.get(key)
+    if motor is None:
+        motor=syringe_motor.Motor()
+        group.motordict[key]=motor
+    motor.connect(_default_port(args.port), args.baud, sym)
+    return group, key, motor
+
+def save_position(args, group, motor, position):
+    motor.motor_position=position
+    #any fix-up load() scheduled is covered by this write
+    group.flush()
+    group.serialize(args.calibration)
+
+def cmd_ports(args):
+    import syringe_ports
+    if syringe_ports.has_sysfs():
+        for a in syringe_ports.enumerate_adapters(None if args.known else {}):
+            print("%s\t%s:%s\t%s\t%s"%(a.device, a.vid, a.pid, a.serial, a.description))
+    else:
+        for p in syringe_motor.scan_ports():
+            print(p)
+    return 0
+
+def cmd_status(args):
+    group, key, motor=open_pump(args)
+    response=motor.sendCommand("/"+motor.motor_address+"Q")
+    if response is None:
+        raise ValueError("motor did not respond")
+    print(("busy" if response.busy else "ready")+("" if not response.error else ", "+response.error_text))
+    return 1 if response.error else 0
+
+def cmd_position(args):
+    group, key, motor=open_pump(args)
+    position=motor.getPosition()
+    print(position)
+    save_position(args, group, motor, position)
+    return 0
+
+def cmd_init(args):
+    group, key, motor=open_pump(args)
+    #acceleration, then a velocity low enough not to slip, then home
+    motor.sendRawCommand("/"+motor.motor_address+"L5000R")
+    motor.sendRawCommand("/"+motor.motor_address+"V200000R")
+    motor.sendCommand("/"+motor.motor_address+"Z10000R")
+    if not motor.wait_until_idle(timeout=args.timeout):
+        raise ValueError("motor did not finish initializing")
+    #start in the middle, so the motor can move both ways
+    middle=1073741824
+    motor.sendRawCommand("/"+motor.motor_address+"z"+str(middle)+"R")
+    motor.max_pos=2147483647
+    save_position(args, group, motor, middle)
+    print("Motor initialized.")
+    return 0
+
+def _move(args, vol):
+    group, key, motor=open_pump(args)
+    target, warnings=motor.inject(vol, args.secs)
+    for w in warnings:
+        print(w, file=sys.stderr)
+    if args.wait:
+        motor.wait_until_idle(timeout=args.secs*2+10)
+        target=motor.getPosition()
+    save_position(args, group, motor, target)
+    print(int(target))
+    return 0
+
+def cmd_inject(args):
+    return _move(args, args.ml)
+
+def cmd_draw(args):
+    return _move(args, -args.ml)
+
+def cmd_stop(args):
+    group, key, motor=open_pump(args)
+    motor.sendRawCommand("/"+motor.motor_address+"TR")
+    position=motor.getPosition()
+    save_position(args, group, motor, position)
+    print(position)
+    return 0
+
+def cmd_pump(args):
+    import syringe_program
+    group, key, motor=open_pump(args)
+    exe, warnings=syringe_program.cycle_program(motor, args.ml, args.pull_secs, args.top_wait_ms,
+                                                args.push_secs, args.bottom_wait_ms, args.repeats)
+    for w in warnings:
+        print(w, file=sys.stderr)
+    response=motor.run_program(exe)
+    if response is None:
+        raise ValueError("motor did not respond")
+    if response.error:
+        raise ValueError("motor rejected "+exe+": "+response.error_text)
+    return 0
+
+def cmd_profile(args):
+    group, key, motor=open_pump(args)
+    flows=[float(f) for f in args.flows.split(',')]
+    slot, warnings=motor.upload_profile(flows, args.secs, args.tolerance, start=not args.store_only)
+    for w in warnings:
+        print(w, file=sys.stderr)
+    if args.wait and not args.store_only:
+        motor.wait_until_idle(timeout=args.secs*2+10)
+        save_position(args, group, motor, motor.getPosition())
+    print(slot)
+    return 0
+
+def cmd_accel(args):
+    group, key, motor=open_pump(args)
+    if args.set is not None:
+        value=args.set
+    else:
+        value=motor.measure_accel_scale(args.steps, args.accel)
+    motor.accel_scale=value
+    group.flush()
+    group.serialize(args.calibration)
+    print(value)
+    return 0
+
+def cmd_run(args):
+    import syringe_protocol
+    group=syringe_motor.MotorGroup()
+    group.load(args.calibration)
+    actions=syringe_protocol.load_protocol(args.protocol)
+    for a in actions:
+        key=group.pump_key(a.pump.upper())
+        if key not in group.motordict:
+            sym=syringe_motor.convertToSymbol(a.pump.upper())
+            if sym is None:
+                raise ValueError("pump "+a.pump+" is not a pump number from 0 to F")
+            group.motordict[key]=syringe_motor.Motor()
+            group.motordict[key].motor_address=sym
+    #protocols may name pumps in either case
+    actions=[a._replace(pump=group.pump_key(a.pump.upper())) for a in actions]
+
+    group.connect(_default_port(args.port), args.baud)
+    runner=syringe_protocol.ProtocolRunner(group, actions)
+    for w in runner.warnings:
+        print(w, file=sys.stderr)
+    dispatches=runner.run()
+    report=syringe_protocol.skew_report(dispatches)
+    report['dispatches']=[{'time': d.action.time, 'pump': d.action.pump, 'action': d.action.kind,
+                           'skew_ms': None if d.skew is None else d.skew*1000, 'error': d.error}
+                          for d in dispatches]
+    print(json.dumps(report, indent=2))
+    return 1 if report['errors'] else 0
+
+def build_parser():
+    parser=argparse.ArgumentParser(prog='syringe-pump', description="Control Silverpak syringe pumps without the GUI.")
+    sub=parser.add_subparsers(dest='command')
+    sub.required=True
+
+    def command(name, func, help, pump=True):
+        p=sub.add_parser(name, help=help)
+        p.set_defaults(func=func)
+        p.add_argument('--port', help="serial device. Defaults to the first known adapter")
+        p.add_argument('--baud', type=int, default=9600)
+        p.add_argument('--calibration', default=CALIBRATION_FILE, help="calibration xml, as saved by the GUI")
+        p.add_argument('--record', metavar='FILE', help="keep a flight recording of serial traffic, see syringe_recorder.py")
+        if pump:
+            p.add_argument('--addr', default='1', help="pump number, 0-F")
+        return p
+
+    p=sub.add_parser('ports', help="list serial adapters")
+    p.set_defaults(func=cmd_ports)
+    p.add_argument('--all', dest='known', action='store_false', help="include unknown USB serial adapters")
+
+    command('status', cmd_status, "say whether the pump is busy")
+    command('position', cmd_position, "print the pump's position in steps")
+    p=command('init', cmd_init, "home the pump")
+    p.add_argument('--timeout', type=float, default=60)
+    command('stop', cmd_stop, "stop the pump and print where it stopped")
+
+    for name, func, verb in (('inject', cmd_inject, "inject"), ('draw', cmd_draw, "draw")):
+        p=command(name, func, verb+" a volume over a time")
+        p.add_argument('--ml', type=float, required=True)
+        p.add_argument('--secs', type=float, required=True)
+        p.add_argument('--wait', action='store_true', help="wait for the move to finish")
+
+    p=command('pump', cmd_pump, "run a draw/inject cycle, like the Pumping tab")
+    p.add_argument('--ml', type=float, required=True)
+    p.add_argument('--pull-secs', type=float, required=True)
+    p.add_argument('--push-secs', type=float, required=True)
+    p.add_argument('--top-wait-ms', type=float, default=0)
+    p.add_argument('--bottom-wait-ms', type=float, default=0)
+    p.add_argument('--repeats', type=float, default=1, help="0 repeats forever")
+
+    p=command('profile', cmd_profile, "store a flow profile in a program slot and run it, printing the slot")
+    p.add_argument('--flows', required=True, help="comma separated mL/min, spread evenly over --secs. Negative draws")
+    p.add_argument('--secs', type=float, required=True)
+    p.add_argument('--tolerance', type=float, default=0.001, help="largest volume error allowed, mL")
+    p.add_argument('--store-only', action='store_true', help="only store it, to start later with 'e' and the slot")
+    p.add_argument('--wait', action='store_true', help="wait for the profile to finish")
+
+    p=command('accel', cmd_accel, "measure the pump's acceleration per unit of 'L', and save it as accel_scale."
+                                  " The pump moves --steps and back")
+    p.add_argument('--set', type=float, metavar='ACCEL_SCALE', help="save this value instead of measuring")
+    p.add_argument('--steps', type=int, default=20000, help="length of the test move")
+    p.add_argument('--accel', type=int, default=100, help="the 'L' to measure with")
+
+    p=command('run', cmd_run, "run a json protocol across several pumps, see syringe_protocol", pump=False)
+    p.add_argument('protocol')
+    return parser
+
+def main(argv=None):
+    args=build_parser().parse_args(argv)
+    try:
+        if getattr(args, 'record', None):
+            import syringe_recorder
+            syringe_recorder.install(args.record)
+        return args.func(args)
+    except (ValueError, IndexError, EnvironmentError, serial.serialutil.SerialException) as e:
+        print("err: "+str(e), file=sys.stderr)
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
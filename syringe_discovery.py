@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Finds every controller on every port.
+
+Each candidate port is probed on its own thread, sweeping the baud rates
+and all 16 addresses, so a whole lab comes up in about the time one port
+takes. The result is a list of BusEntry, which populate() turns into a
+MotorGroup.
+
+Example:
+    entries=discover()
+    populate(motorGroup, entries)
+
+or from a shell:
+    python3 syringe_discovery.py --ports /dev/ttyUSB0,/dev/ttyUSB1
+
+"""
+import sys
+import json
+import argparse
+import collections
+import concurrent.futures
+import serial
+import syringe_motor
+
+BAUDS=[9600, 19200, 38400, 57600, 115200]
+
+BusEntry=collections.namedtuple('BusEntry', ['port', 'baud', 'address', 'firmware'])
+
+def probe_port(port, bauds=BAUDS, addresses=None):
+    """Sweeps one port for controllers.
+
+    If the port is already in use by this process, only its current baud
+    rate is probed, so connected pumps aren't disturbed.
+
+    Args:
+        port (str): device to probe.
+        bauds: baud rates to try.
+        addresses: address symbols to try. Defaults to all 16.
+
+    Returns:
+        a list of BusEntry. Empty if the port can't be opened.
+
+    """
+    if addresses is None:
+        addresses=[syringe_motor.convertToSymbol(n) for n in '123456789ABCDEF0']
+
+    bus=syringe_motor.SerialBus.find(port)
+    owned=bus is None
+    if owned:
+        bus=syringe_motor.SerialBus(port, bauds[0])
+        try:
+            bus.open(register=False)
+        except (serial.serialutil.SerialException, OSError, ValueError):
+            return []
+    else:
+        bauds=[bus.srl_port.baudrate]
+
+    found=[]
+    try:
+        for baud in bauds:
+            with bus.srl_rlock:
+                bus.srl_port.baudrate=baud
+            for address in addresses:
+                if bus.sendCommand("/"+address+"Q") is None:
+                    continue
+                firmware=bus.sendRawCommand("/"+address+"&")
+                found.append(BusEntry(port, baud, address, firmware))
+    except (serial.serialutil.SerialException, OSError):
+        pass
+    finally:
+        if owned:
+            bus.close()
+    return found
+
+def discover(ports=None, bauds=BAUDS, addresses=None, max_workers=32):
+    """Probes every port at once.
+
+    Args:
+        ports: devices to probe. Defaults to syringe_motor.scan_ports().
+
+    Returns:
+        a list of BusEntry, sorted by port, baud and address.
+
+    """
+    if ports is None:
+        ports=syringe_motor.scan_ports()
+    if not ports:
+        return []
+    entries=[]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(ports))) as pool:
+        for found in pool.map(lambda p: probe_port(p, bauds, addresses), ports):
+            entries.extend(found)
+    return sorted(entries)
+
+def populate(motorGroup, entries):
+    """Adds the discovered motors to a MotorGroup and connects them.
+
+    Motors already in the group keep their calibration, and are moved off
+    the bus they were on. motordict is keyed by address, so if two ports
+    have a motor at the same address, only the first is added. A port
+    runs at one baud rate, so controllers found on a port at another baud
+    rate than its first entry's are skipped too; set them to one rate
+    with the 'b' command. The group's bus becomes the first entry's.
+
+    Returns:
+        the entries that were skipped.
+
+    """
+    skipped=[]
+    used=set()
+    port_bauds={}
+    for entry in entries:
+        key=motorGroup.pump_key(syringe_motor.convertToNum(entry.address))
+        if key in used or port_bauds.setdefault(entry.port, entry.baud)!=entry.baud:
+            skipped.append(entry)
+            continue
+        used.add(key)
+        bus=syringe_motor.SerialBus.get(entry.port, entry.baud)
+        if len(used)==1:
+            motorGroup.bus=bus
+        motor=motorGroup.motordict.get(key)
+        if motor is None:
+            motor=syringe_motor.Motor()
+            motorGroup.motordict[key]=motor
+        elif motor.bus is not bus or motor.motor_address!=entry.address:
+            #detach goes by the old address, so before it changes
+            motor.bus.detach(motor)
+            #maybe a different controller, with other programs stored
+            motor.invalidate_programs()
+            motor.invalidate()
+            motor.model.reset()
+        motor.motor_address=entry.address
+        bus.attach(motor)
+    return skipped
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description="Find Silverpak controllers on every port, baud rate and address.")
+    parser.add_argument('--ports', help="comma separated devices. Defaults to the known USB adapters")
+    parser.add_argument('--bauds', default=','.join(str(b) for b in BAUDS))
+    args=parser.parse_args(argv)
+
+    ports=args.ports.split(',') if args.ports else None
+    entries=discover(ports, [int(b) for b in args.bauds.split(',')])
+    print(json.dumps([e._asdict() for e in entries], indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Pseudo-terminal stand-in for Silverpak/EZStepper controllers.
+
+Opens a pty pair and answers the DT protocol on the master side, so
+syringe_motor.Motor.connect() can be pointed at the slave path exactly
+like a /dev/ttyUSB* device. Several addresses can share one emulator, as
+they would on an RS-485 chain.
+
+Example:
+    emu=Emulator(addresses='12')
+    emu.start()
+    motor=syringe_motor.Motor()
+    motor.connect(emu.slave_path, 9600, '1')
+    ...
+    emu.stop()
+
+or from a shell, printing the path to connect to:
+    python3 syringe_emulator.py --addresses 12 --latency 0.002
+
+"""
+import os
+import re
+import sys
+import time
+import math
+import tty
+import select
+import random
+import argparse
+import termios
+import threading
+import syringe_motor
+
+from syringe_motor import (STATUS_READY, ERR_NONE, ERR_BAD_COMMAND, ERR_BAD_OPERAND,
+                           ERR_NOT_INITIALIZED, ERR_OVERFLOW)
+
+#status byte: 0x40 | ready bit | error code
+STATUS_BASE=0x40
+
+MAX_VELOCITY=2**23
+MAX_POSITION=2**31-1
+MAX_LOOP_DEPTH=4
+#what a controller powers up with, until 'V' or 'L' is sent
+POWER_UP_VELOCITY=305064
+POWER_UP_ACCEL=1000
+#simulated seconds per step while speeding up and slowing down
+TICK=0.0005
+
+#kept apart from syringe_model on purpose: the model is tested against this
+COMMAND_RE=re.compile(r'([A-Za-z&?])(-?[0-9]*)')
+
+def split_commands(body):
+    """'V100A0R' -> [('V', 100), ('A', 0), ('R', 0)].
+
+    Raises:
+        ValueError: if body has anything the controller wouldn't parse.
+
+    """
+    commands=[]
+    end=0
+    while end<len(body):
+        m=COMMAND_RE.match(body, end)
+        if m is None:
+            raise ValueError(body)
+        commands.append((m.group(1), int(m.group(2) or 0)))
+        end=m.end()
+    return commands
+
+class EmulatedMotor:
+    """State and program execution of one addressed controller.
+
+    Moves are stepped through in (scaled) real time, TICK by TICK: the
+    motor speeds up at its acceleration, cruises, and starts slowing down
+    once it could only just stop at the target. Programs run on their own
+    thread, so queries answer while a move or an 'M' wait is in progress.
+    """
+
+    def __init__(self, address='1', version='EZHR17EN AllMotion Emulator', accel_scale=1000.0,
+                 require_init=False, time_scale=1.0):
+        """
+        Args:
+            address (str): address symbol, as in syringe_motor.convertToSymbol.
+            version (str): reply to '&'.
+            accel_scale (float): microsteps/s^2 per unit of 'L'.
+            require_init (bool): reject moves until 'Z' has been run, like
+                a real controller.
+            time_scale (float): simulated seconds per real second.
+
+        """
+        self.address=address
+        self.version=version
+        self.accel_scale=accel_scale
+        self.require_init=require_init
+        self.time_scale=time_scale
+
+        self.position=0.0
+        self.velocity=POWER_UP_VELOCITY
+        self.accel=POWER_UP_ACCEL
+        self.initialized=False
+        #commands received without 'R', run by a bare 'R'
+        self.stored=[]
+        #slot -> tokens stored with 's', run with 'e'
+        self.programs={}
+
+        self._lock=threading.RLock()
+        #[simulated time position is for, target, speed now, top speed, accel] of the current move
+        self._move=None
+        self._thread=None
+        self._terminate=threading.Event()
+        self._t0=time.monotonic()
+
+    def clock(self):
+        """Simulated seconds since the motor was created."""
+        return (time.monotonic()-self._t0)*self.time_scale
+
+    def busy(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def current_position(self):
+        """Position right now, stepping the current move up to now."""
+        with self._lock:
+            self._advance(self.clock())
+            return self.position
+
+    def _advance(self, now):
+        """Steps the current move on to simulated time now. Call with _lock held."""
+        move=self._move
+        if move is None:
+            return
+        t, target, speed, top, accel=move
+        while t<now and self.position!=target:
+            left=abs(target-self.position)
+            if speed>=top and (accel==math.inf or left-top*top/(2*accel)>top*TICK):
+                #cruising, up to where it has to start slowing down
+                dt=min(now-t, max(TICK, (left-(0 if accel==math.inf else top*top/(2*accel)))/top))
+                speed=top
+            else:
+                dt=min(now-t, TICK)
+                if speed*speed/(2*accel)>=left:
+                    #never quite stopping short of the target
+                    speed=max(speed-accel*dt, accel*dt)
+                else:
+                    speed=min(top, speed+accel*dt)
+            if speed*dt>=left:
+                t+=left/speed
+                self.position=target
+                speed=0.0
+            else:
+                t+=dt
+                self.position+=math.copysign(speed*dt, target-self.position)
+        move[0], move[2]=t, speed
+
+    def status(self, error=ERR_NONE):
+        s=STATUS_BASE|error
+        if not self.busy():
+            s|=STATUS_READY
+        return bytes([s])
+
+    def handle(self, body):
+        """Handles one command string with the address removed.
+
+        Returns:
+            (error, data) for the reply frame.
+
+        """
+        try:
+            tokens=split_commands(body)
+        except ValueError:
+            return ERR_BAD_COMMAND, b''
+
+        if not tokens:
+            return ERR_NONE, b''
+
+        op, arg=tokens[0]
+        #queries and terminate are allowed while busy
+        if op=='Q':
+            return ERR_NONE, b''
+        if op=='&':
+            return ERR_NONE, self.version.encode('utf-8')
+        if op=='?':
+            return self.query(arg)
+        if op=='T':
+            self.terminate()
+            return ERR_NONE, b''
+
+        if op=='s':
+            return self.store(arg, tokens[1:-1] if tokens[-1][0]=='R' else tokens[1:])
+
+        if tokens[-1][0]!='R':
+            self.stored=tokens
+            return ERR_NONE, b''
+        if len(tokens)==1:
+            tokens=self.stored+tokens
+        tokens=tokens[:-1]
+
+        expanded=[]
+        for op, arg in tokens:
+            if op!='e':
+                expanded.append((op, arg))
+            elif arg in self.programs:
+                expanded.extend(self.programs[arg])
+            else:
+                return ERR_BAD_COMMAND, b''
+        tokens=expanded
+
+        error=self.check(tokens)
+        if error!=ERR_NONE:
+            return error, b''
+        if self.busy():
+            return ERR_OVERFLOW, b''
+
+        self._terminate.clear()
+        self._thread=threading.Thread(target=self._run, args=(tokens,))
+        self._thread.daemon=True
+        self._thread.start()
+        return ERR_NONE, b''
+
+    def store(self, slot, tokens):
+        """Keeps a program in a slot for 'e', like the controller's EEPROM."""
+        if not 0<=slot<=15:
+            return ERR_BAD_OPERAND, b''
+        error=self.check(tokens)
+        #moves are only refused when they run
+        if error not in (ERR_NONE, ERR_NOT_INITIALIZED):
+            return error, b''
+        self.programs[slot]=tokens
+        return ERR_NONE, b''
+
+    def query(self, arg):
+        if arg==0:
+            return ERR_NONE, str(int(round(self.current_position()))).encode('utf-8')
+        if arg==2:
+            #reported in units of 32 microsteps/sec, see ControllerWindow.checkVelocity
+            return ERR_NONE, str(int(self.velocity//32)).encode('utf-8')
+        return ERR_BAD_OPERAND, b''
+
+    def check(self, tokens):
+        """Validates a program before running it. Returns an error code."""
+        depth=0
+        for op, arg in tokens:
+            if op in 'APD' and self.require_init and not self.initialized:
+                return ERR_NOT_INITIALIZED
+            if op=='g':
+                depth+=1
+                if depth>MAX_LOOP_DEPTH:
+                    return ERR_BAD_COMMAND
+            elif op=='G':
+                depth-=1
+                if depth<0:
+                    return ERR_BAD_COMMAND
+            elif op=='V' and not 0<arg<=MAX_VELOCITY:
+                return ERR_BAD_OPERAND
+            elif op in 'AzZ' and not 0<=arg<=MAX_POSITION:
+                return ERR_BAD_OPERAND
+            elif op not in 'gGVAzZLMPDb':
+                return ERR_BAD_COMMAND
+        return ERR_NONE
+
+    def terminate(self):
+        """Stops the running program where it is."""
+        self._terminate.set()
+        thread=self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _wait(self, seconds):
+        """Waits simulated seconds. Returns False if terminated."""
+        return not self._terminate.wait(seconds/self.time_scale)
+
+    def _move_to(self, target):
+        """Moves from rest to rest. Returns False if terminated on the way."""
+        target=float(target)
+        top=float(self.velocity)
+        accel=self.accel*self.accel_scale
+        with self._lock:
+            self._advance(self.clock())
+            self._move=[self.clock(), target, 0.0, top, float(accel) if accel>0 else math.inf]
+        while True:
+            with self._lock:
+                self._advance(self.clock())
+                left=abs(target-self.position)
+                if left==0:
+                    self._move=None
+                    return True
+            #it can't get there any sooner than at top speed
+            if not self._wait(max(TICK, left/top)):
+                with self._lock:
+                    self._advance(self.clock())
+                    self._move=None
+                return False
+
+    def _run(self, tokens):
+        #[index of 'g', repeats left] for each open loop
+        loops=[]
+        i=0
+        while i<len(tokens):
+            if self._terminate.is_set():
+                return
+            op, arg=tokens[i]
+            if op=='g':
+                loops.append([i, None])
+            elif op=='G':
+                loop=loops[-1]
+                if loop[1] is None:
+                    #G0 repeats forever
+                    loop[1]=arg if arg>0 else -1
+                if loop[1]!=-1:
+                    loop[1]-=1
+                if loop[1]!=0:
+                    i=loop[0]+1
+                    continue
+                loops.pop()
+            elif op=='V':
+                self.velocity=arg
+            elif op=='L':
+                self.accel=arg
+            elif op=='A':
+                if not self._move_to(arg):
+                    return
+            elif op=='P':
+                if not self._move_to(self.current_position()+arg):
+                    return
+            elif op=='D':
+                if not self._move_to(self.current_position()-arg):
+                    return
+            elif op=='z':
+                with self._lock:
+                    self.position=float(arg)
+            elif op=='Z':
+                #home: run back up to arg steps, then call that 0
+                if not self._move_to(max(0.0, self.current_position()-arg)):
+                    return
+                with self._lock:
+                    self.position=0.0
+                self.initialized=True
+            elif op=='M':
+                if not self._wait(arg/1000.0):
+                    return
+            i+=1
+
+
+#termios speed constant -> baud rate
+_TERMIOS_BAUDS=dict((getattr(termios, 'B'+str(b)), b) for b in
+                    (1200, 2400, 4800, 9600, 19200, 38400, 57600, 115200, 230400) if hasattr(termios, 'B'+str(b)))
+
+class Emulator:
+    """A pty whose far end behaves like a chain of EZStepper controllers.
+
+    Knobs for testing the host side under bad conditions:
+        latency: seconds added before every reply.
+        drop_rate: probability of dropping each reply byte.
+        garbage_rate: probability of sending random bytes before a reply.
+        match_baud: ignore commands sent while the host side of the pty is
+            set to another baud rate, as a real controller would only see
+            garbage.
+    """
+
+    #reply bytes written per write(), to pace replies at the baud rate
+    CHUNK=4
+
+    def __init__(self, addresses='1', baud=9600, latency=0.0, drop_rate=0.0, garbage_rate=0.0,
+                 seed=None, match_baud=True, **motor_args):
+        """
+        Args:
+            addresses: address symbols to answer on, e.g. '12'.
+            baud (int): line rate used for byte timing. Changed by 'b'.
+            motor_args: passed to each EmulatedMotor.
+
+        """
+        self.motors={}
+        for a in addresses:
+            self.motors[a]=EmulatedMotor(a, **motor_args)
+        self.baud=baud
+        self.latency=latency
+        self.drop_rate=drop_rate
+        self.garbage_rate=garbage_rate
+        self.match_baud=match_baud
+        self.random=random.Random(seed)
+
+        self.master_fd=None
+        self.slave_fd=None
+        self.slave_path=None
+        self._thread=None
+        self._running=False
+
+    def start(self):
+        """Opens the pty and starts answering. Returns the slave path."""
+        self.master_fd, self.slave_fd=os.openpty()
+        tty.setraw(self.master_fd)
+        tty.setraw(self.slave_fd)
+        self.slave_path=os.ttyname(self.slave_fd)
+        self._running=True
+        self._thread=threading.Thread(target=self._serve)
+        self._thread.daemon=True
+        self._thread.start()
+        return self.slave_path
+
+    def stop(self):
+        self._running=False
+        for m in self.motors.values():
+            m.terminate()
+        if self._thread is not None:
+            self._thread.join()
+        for fd in (self.master_fd, self.slave_fd):
+            if fd is not None:
+                os.close(fd)
+        self.master_fd=self.slave_fd=None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def byte_time(self, n):
+        """Seconds to move n bytes at the current baud rate (8N1)."""
+        return n*10.0/self.baud
+
+    def _serve(self):
+        rx=b''
+        while self._running:
+            ready, _, _=select.select([self.master_fd], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                rx+=os.read(self.master_fd, 1024)
+            except OSError:
+                return
+            while b'\r' in rx:
+                line, rx=rx.split(b'\r', 1)
+                self._answer(line)
+
+    def host_baud(self):
+        """The baud rate the host has set on its end of the pty."""
+        speed=termios.tcgetattr(self.master_fd)[4]
+        return _TERMIOS_BAUDS.get(speed)
+
+    def _answer(self, line):
+        if self.match_baud and self.host_baud()!=self.baud:
+            return
+        start=line.rfind(b'/')
+        if start==-1 or len(line)<start+2:
+            return
+        address=chr(line[start+1])
+        body=line[start+2:].decode('utf-8', 'replace')
+        if address in syringe_motor.GROUP_ADDRESSES:
+            #every member acts on it, and nobody answers
+            for a in syringe_motor.GROUP_ADDRESSES[address]:
+                if a in self.motors:
+                    self.motors[a].handle(body)
+            return
+        motor=self.motors.get(address)
+        if motor is None:
+            #nobody on the bus at that address
+            return
+
+        error, data=motor.handle(body)
+        reply=b'\xff/0'+motor.status(error)+data+b'\x03\r\n'
+
+        if self.garbage_rate and self.random.random()<self.garbage_rate:
+            reply=bytes(self.random.randrange(256) for _ in range(self.random.randint(1, 8)))+reply
+        if self.drop_rate:
+            reply=bytes(b for b in reply if self.random.random()>=self.drop_rate)
+
+        #the command had to arrive, then the reply goes out at line rate
+        time.sleep(self.latency+self.byte_time(len(line)+1))
+        for i in range(0, len(reply), self.CHUNK):
+            chunk=reply[i:i+self.CHUNK]
+            time.sleep(self.byte_time(len(chunk)))
+            os.write(self.master_fd, chunk)
+
+        #a baud change takes effect after the reply
+        for op, arg in split_commands(body) if error==ERR_NONE else []:
+            if op=='b' and arg>0:
+                self.baud=arg
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description="Emulate Silverpak/EZStepper controllers on a pty.")
+    parser.add_argument('--addresses', default='1', help="address symbols to answer on, e.g. 12")
+    parser.add_argument('--baud', type=int, default=9600)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added before every reply")
+    parser.add_argument('--drop-rate', type=float, default=0.0)
+    parser.add_argument('--garbage-rate', type=float, default=0.0)
+    parser.add_argument('--time-scale', type=float, default=1.0, help="simulated seconds per real second")
+    parser.add_argument('--require-init', action='store_true')
+    args=parser.parse_args(argv)
+
+    emu=Emulator(args.addresses, args.baud, args.latency, args.drop_rate, args.garbage_rate,
+                 time_scale=args.time_scale, require_init=args.require_init)
+    print(emu.start())
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    emu.stop()
+
+if __name__ == '__main__':
+    main()
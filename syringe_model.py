@@ -0,0 +1,477 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Predicts where a motor is from the commands it was sent.
+
+The host already knows the velocity, acceleration and target of every
+move, so a MotionModel replays each program the way the controller runs
+it: trapezoidal moves, 'M' waits, g...G loops (including G0 forever),
+stored programs and 'T'. Position and dispensed volume can then be read
+at any time without touching the serial port.
+
+Occasional real readings keep it honest. A '?0' reply taken during a move
+usually differs from the prediction only by when the move really started,
+so the model shifts its clock to match. Differences that timing can't
+explain, like skipped steps or someone else moving the motor, are
+kept in drifted until it is cleared.
+
+Motor.model is fed by the bus, so normally this is only read:
+    motor.predicted_position()
+    motor.dispensed()
+    motor.model.drifted
+
+"""
+import re
+import math
+import bisect
+import threading
+import collections
+
+#what the controller starts with, until 'V' or 'L' is sent
+DEFAULT_VELOCITY=305064
+DEFAULT_ACCEL=1000
+
+#steps a reading may differ from the prediction by without flagging drift
+DRIFT_TOLERANCE=200
+#seconds of move timing a reading may correct
+TIME_WINDOW=1.0
+#segments kept of a long running program, before the oldest are dropped
+MAX_SEGMENTS=4096
+
+TOKEN_RE=re.compile(r'([A-Za-z&?])(-?\d*)')
+
+def parse_tokens(body):
+    """Splits a command body like 'gV100A0M500G3R' into (letter, int) pairs.
+
+    Raises:
+        ValueError: if there is anything that isn't a command.
+
+    """
+    tokens=[]
+    pos=0
+    for m in TOKEN_RE.finditer(body):
+        if m.start()!=pos:
+            raise ValueError(body)
+        tokens.append((m.group(1), int(m.group(2)) if m.group(2) else 0))
+        pos=m.end()
+    if pos!=len(body):
+        raise ValueError(body)
+    return tokens
+
+def trapezoid(distance, velocity, accel, t):
+    """Distance covered t seconds into a trapezoidal move.
+
+    Args:
+        distance (float): total move length, >= 0.
+        velocity (float): top speed, > 0.
+        accel (float): acceleration and deceleration, > 0.
+        t (float): time since the move started.
+
+    Returns:
+        (covered, duration): distance covered by time t, and the total
+        time the move takes.
+
+    """
+    if distance<=0:
+        return 0.0, 0.0
+    if accel==math.inf:
+        #at full speed straight away
+        duration=distance/float(velocity)
+        return min(float(distance), velocity*max(t, 0.0)), duration
+    if distance>=velocity*velocity/accel:
+        t_acc=velocity/accel
+        t_cruise=(distance-velocity*t_acc)/velocity
+    else:
+        #never reaches top speed: triangular profile
+        t_acc=math.sqrt(distance/accel)
+        velocity=accel*t_acc
+        t_cruise=0.0
+    duration=2*t_acc+t_cruise
+
+    if t<=0:
+        return 0.0, duration
+    if t>=duration:
+        return float(distance), duration
+    if t<t_acc:
+        return 0.5*accel*t*t, duration
+    d_acc=0.5*accel*t_acc*t_acc
+    if t<t_acc+t_cruise:
+        return d_acc+velocity*(t-t_acc), duration
+    left=duration-t
+    return distance-0.5*accel*left*left, duration
+
+def trapezoid_time(distance, velocity, accel, covered):
+    """When a trapezoidal move has covered a distance. The inverse of trapezoid."""
+    duration=trapezoid(distance, velocity, accel, 0)[1]
+    lo, hi=0.0, duration
+    for _ in range(50):
+        mid=(lo+hi)/2
+        if trapezoid(distance, velocity, accel, mid)[0]<covered:
+            lo=mid
+        else:
+            hi=mid
+    return (lo+hi)/2
+
+#one move or wait of a running program. start is on the model's program
+# clock. duration is None for a move that can't be timed ('Z'), and p1 is
+# None where it ends is unknown. velocity and accel are the 'V' and 'L'
+# in effect.
+Segment=collections.namedtuple('Segment', ['start', 'duration', 'p0', 'p1', 'velocity', 'accel'])
+
+class MotionModel:
+    """Dead reckoning of one motor's position.
+
+    Times are time.monotonic(). Positions are in steps, and None where
+    the model doesn't know, e.g. before the first reading or while homing.
+    """
+
+    def __init__(self, position=None, velocity=DEFAULT_VELOCITY, accel=DEFAULT_ACCEL,
+                 accel_scale=None, tolerance=DRIFT_TOLERANCE):
+        """
+        Args:
+            position (float): where the motor is, if known.
+            velocity (int): the controller's 'V'.
+            accel (int): the controller's 'L'.
+            accel_scale (float): microsteps/s^2 per unit of 'L', as
+                calibrated for the motor. None models moves as reaching
+                their velocity at once, which is late by about the time
+                the motor takes to get up to speed.
+            tolerance (float): steps of unexplained difference that count
+                as drift.
+
+        """
+        self.accel_scale=accel_scale
+        self.tolerance=tolerance
+        self._lock=threading.RLock()
+        self.reset(position, velocity, accel)
+
+    def _accel(self, accel):
+        """microsteps/s^2 of an 'L' value."""
+        if self.accel_scale is None:
+            return math.inf
+        return accel*self.accel_scale
+
+    def reset(self, position=None, velocity=DEFAULT_VELOCITY, accel=DEFAULT_ACCEL):
+        """Forgets everything, e.g. on connecting to another controller."""
+        with self._lock:
+            #idle state, or the state the running program started from
+            self.position=position
+            self.velocity=velocity
+            self.accel=accel
+            #slot -> tokens stored with 's', and tokens sent without 'R'
+            self.programs={}
+            self.stored=[]
+            #position the running, or last, program started at
+            self.start_position=position
+            #steps the last reading differed from the prediction, and how
+            # many seconds late the motor was found to be running
+            self.drift=None
+            self.lag=None
+            #the last difference timing couldn't explain, until set back to None
+            self.drifted=None
+            self.readings=0
+            self._program=None
+            self._replay=None
+            self._segments=[]
+            self._starts=[]
+            #program clock = time.monotonic() - _offset
+            self._offset=0.0
+
+    def observe(self, body, response, t, broadcast=False):
+        """Follows a command the controller got at time t, and its reply.
+
+        Args:
+            body (str): the command without '/' and address.
+            response (syringe_motor.Response): the reply, or None.
+            broadcast (bool): sent to a group address, which never replies.
+
+        """
+        if body.startswith('?') or body.startswith('&') or body=='Q':
+            if response is not None and not response.error:
+                self.reconcile(response.integer() if body=='?0' else None, response.busy, t)
+        elif response is None and not broadcast:
+            #it may or may not have arrived
+            with self._lock:
+                if body.startswith('s'):
+                    self.programs.clear()
+                elif body.endswith('R'):
+                    self._settle(t)
+                    self.position=None
+                else:
+                    self.stored=[]
+        elif response is None or not response.error:
+            self.command(body, t)
+
+    def command(self, body, t):
+        """Starts following a command the controller accepted at time t."""
+        try:
+            tokens=parse_tokens(body)
+        except ValueError:
+            return
+        if not tokens:
+            return
+        with self._lock:
+            op=tokens[0][0]
+            if op=='T':
+                self._settle(t)
+                return
+            if op=='s':
+                self.programs[tokens[0][1]]=tokens[1:-1] if tokens[-1][0]=='R' else tokens[1:]
+                return
+            if tokens[-1][0]!='R':
+                self.stored=tokens
+                return
+            if len(tokens)==1:
+                tokens=self.stored+tokens
+            expanded=[]
+            for op, arg in tokens[:-1]:
+                if op!='e':
+                    expanded.append((op, arg))
+                elif arg in self.programs:
+                    expanded.extend(self.programs[arg])
+                else:
+                    #stored before we were watching
+                    self._settle(t)
+                    self.position=None
+                    return
+            #the controller only takes a program once the last one is done
+            self._settle(t, finished=True)
+            self._start(expanded, t)
+
+
+    def _start(self, tokens, t):
+        self.start_position=self.position
+        #to run the program again, see end_time
+        self._replay=(tokens, t, self.position, self.velocity, self.accel)
+        self._offset=0.0
+        self._program=self._run(tokens, t, self.position, self.velocity, self.accel)
+        self._segments=[]
+        self._starts=[]
+
+    def _run(self, tokens, t, p, v, a):
+        """Yields the Segments of a program, the way the controller runs it.
+
+        The last one has no length and holds the state the program ends in.
+        """
+        #[index of 'g', repeats left] for each open loop
+        loops=[]
+        i=0
+        #tokens since time last moved on, to get out of loops that never wait
+        idle=0
+        while i<len(tokens) and idle<10000:
+            op, arg=tokens[i]
+            idle+=1
+            segment=None
+            if op=='g':
+                loops.append([i, None])
+            elif op=='G':
+                if not loops:
+                    break
+                loop=loops[-1]
+                if loop[1] is None:
+                    #G0 repeats forever
+                    loop[1]=arg if arg>0 else -1
+                if loop[1]!=-1:
+                    loop[1]-=1
+                if loop[1]!=0:
+                    i=loop[0]+1
+                    continue
+                loops.pop()
+            elif op=='V':
+                v=arg
+            elif op=='L':
+                a=arg
+            elif op in 'APD':
+                if p is None:
+                    segment=Segment(t, None, None, None, v, a)
+                else:
+                    target={'A': arg, 'P': p+arg, 'D': p-arg}[op]
+                    duration=trapezoid(abs(target-p), v, self._accel(a), 0)[1]
+                    segment=Segment(t, duration, p, target, v, a)
+            elif op=='z':
+                segment=Segment(t, 0.0, arg, arg, v, a)
+            elif op=='Z':
+                #homing runs until the sensor, wherever that is, and
+                # calls it 0. What follows can't be timed.
+                segment=Segment(t, None, p, 0 if i==len(tokens)-1 else None, v, a)
+            elif op=='M':
+                segment=Segment(t, arg/1000.0, p, p, v, a)
+            i+=1
+            if segment is None:
+                continue
+            yield segment
+            if segment.duration is None:
+                #can't follow it any further
+                return
+            if segment.duration>0:
+                idle=0
+            t+=segment.duration
+            p=segment.p1
+        yield Segment(t, 0.0, p, p, v, a)
+
+    def _extend(self, clock):
+        """Runs the program forward until a segment starts after clock."""
+        while self._program is not None and (not self._starts or self._starts[-1]<=clock):
+            try:
+                segment=next(self._program)
+            except StopIteration:
+                self._program=None
+                break
+            self._segments.append(segment)
+            self._starts.append(segment.start)
+            if segment.duration is None:
+                self._program=None
+            if len(self._segments)>MAX_SEGMENTS:
+                #programs that loop for a long time: keep the recent past
+                drop=MAX_SEGMENTS//2
+                del self._segments[:drop]
+                del self._starts[:drop]
+
+    def _segment(self, t):
+        """The segment running at monotonic time t, or None before the program starts."""
+        clock=t-self._offset
+        self._extend(clock)
+        i=bisect.bisect_right(self._starts, clock)-1
+        if i<0:
+            return None
+        return self._segments[i]
+
+    def _at(self, segment, t):
+        """Position along a segment at monotonic time t, or None."""
+        if segment.duration is None or segment.p0 is None or segment.p1 is None:
+            return None
+        if segment.p0==segment.p1:
+            return float(segment.p1)
+        covered, _=trapezoid(abs(segment.p1-segment.p0), segment.velocity, self._accel(segment.accel),
+                             t-self._offset-segment.start)
+        return segment.p0+math.copysign(covered, segment.p1-segment.p0)
+
+    def _running(self):
+        return self._program is not None or bool(self._segments)
+
+    def _stop(self, position, segment=None):
+        """Makes the model idle at position, in the state of segment."""
+        self.position=position
+        if segment is not None:
+            self.velocity, self.accel=segment.velocity, segment.accel
+        self._program=None
+        self._segments=[]
+        self._starts=[]
+
+    def _settle(self, t, finished=False):
+        """Ends the running program at time t, as 'T' does.
+
+        With finished, the controller has said it is done, so a move that
+        should still be running is taken to have reached its target.
+        """
+        if not self._running():
+            return
+        segment=self._segment(t)
+        if segment is None:
+            self._stop(self.position)
+        elif finished and segment.duration!=0.0:
+            self._stop(None if segment.p1 is None else float(segment.p1), segment)
+        else:
+            self._stop(self._at(segment, t), segment)
+
+    def predict(self, t):
+        """(position, busy) at monotonic time t.
+
+        busy is whether the program is still running. Either is None
+        where the model doesn't know.
+        """
+        with self._lock:
+            if not self._running():
+                return self.position, False
+            segment=self._segment(t)
+            if segment is None:
+                return self.position, True
+            if segment.duration is None:
+                return None, None
+            if self._program is None and segment is self._segments[-1]:
+                #done, so later calls needn't look at the segments
+                self._stop(None if segment.p1 is None else float(segment.p1), segment)
+                return self.position, False
+            return self._at(segment, t), True
+
+    def end_time(self):
+        """When the running program should finish.
+
+        Returns:
+            a time.monotonic() time, or None if the model is idle, the
+            program loops forever or the model can't tell.
+
+        """
+        with self._lock:
+            if not self._running() or any(op=='G' and arg==0 for op, arg in self._replay[0]):
+                return None
+            #a separate run, so the segments being followed aren't dropped
+            last=None
+            for last in self._run(*self._replay):
+                if last.duration is None:
+                    return None
+            return last.start+self._offset
+
+    def reconcile(self, position, busy, t):
+        """Corrects the model with what the motor reported at time t.
+
+        Args:
+            position (int): a '?0' reading, or None for just a status.
+            busy (bool): whether the motor said it was running a program.
+
+        Returns:
+            the reading minus what was predicted before correcting, in
+            steps, or None.
+
+        """
+        with self._lock:
+            predicted, predicted_busy=self.predict(t)
+            if not busy:
+                if predicted_busy is not False:
+                    #done sooner than predicted
+                    self._settle(t, finished=True)
+                    predicted=self.position
+                if position is None:
+                    return None
+                #idle, so start again from the reading
+                self._stop(float(position))
+                if self.start_position is None:
+                    self.start_position=self.position
+            elif position is None or predicted is None:
+                return None
+            self.readings+=1
+            drift=None if predicted is None else position-predicted
+            self.drift=drift
+            if drift is not None and abs(drift)>self.tolerance:
+                lag=self._relocate(position, t) if busy else None
+                if lag is None:
+                    self.drifted=drift
+                else:
+                    self.lag=lag
+            return drift
+
+    def _relocate(self, position, t):
+        """Shifts the program clock so the prediction passes through position at t.
+
+        Only moves within TIME_WINDOW of the prediction are considered.
+
+        Returns:
+            seconds the motor is behind the model, or None if no nearby
+            move passes through position.
+
+        """
+        clock=t-self._offset
+        self._extend(clock+TIME_WINDOW)
+        best=None
+        for s in self._segments:
+            if not s.duration or s.p0 is None or s.p1 is None or s.p0==s.p1:
+                continue
+            if s.start+s.duration<clock-TIME_WINDOW or s.start>clock+TIME_WINDOW:
+                continue
+            if not min(s.p0, s.p1)<=position<=max(s.p0, s.p1):
+                continue
+            when=s.start+trapezoid_time(abs(s.p1-s.p0), s.velocity, self._accel(s.accel), abs(position-s.p0))
+            if best is None or abs(when-clock)<abs(best-clock):
+                best=when
+        if best is None or abs(best-clock)>TIME_WINDOW:
+            return None
+        self._offset+=clock-best
+        return clock-best
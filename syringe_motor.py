@@ -2,10 +2,27 @@
 import threading
 import serial
 import time
+import math
 import os
 import xml.etree.ElementTree as ET
 import fnmatch
-def scan_ports():
+import re
+import hashlib
+import tempfile
+import stat
+import collections
+import syringe_ports
+import syringe_model
+def scan_ports(known_only=True):
+    """Lists serial ports that may have controllers on them.
+
+    On Linux, sysfs is used to list only the USB adapters in
+    syringe_ports.KNOWN_ADAPTERS, or every USB serial adapter if known_only
+    is False. Elsewhere, /dev is matched by name.
+    """
+    if syringe_ports.has_sysfs():
+        return [a.device for a in syringe_ports.enumerate_adapters(None if known_only else {})]
+
     portNames= []
     if os.name == 'posix' or os.name == 'mac':
         for filename in os.listdir('/dev/'):
@@ -16,83 +33,685 @@ def scan_ports():
 
     return portNames 
 
-def convertToNum(sym):
-    if sym=='@':
-        return '0'
-    elif sym=='1':
-        return '1'
-    elif sym=='2':
-        return '2'
-    elif sym=='3':
-        return '3'
-    elif sym=='4':
-        return '4'
-    elif sym=='5':
-        return '5'
-    elif sym=='6':
-        return '6'
-    elif sym=='7':
-        return '7'
-    elif sym=='8':
-        return '8'
-    elif sym=='9':
-        return '9'
-    elif sym==':':
-        return 'A'
-    elif sym==';':
-        return 'B'
-    elif sym=='<':
-        return 'C'
-    elif sym=='=':
-        return 'D'
-    elif sym=='>':
-        return 'E'
-    elif sym=='?':
-        return 'F' 
+#pump number (hex digit) <-> address symbol sent after '/'
+ADDRESS_SYMBOLS={
+    '0':'@', '1':'1', '2':'2', '3':'3', '4':'4', '5':'5', '6':'6', '7':'7',
+    '8':'8', '9':'9', 'A':':', 'B':';', 'C':'<', 'D':'=', 'E':'>', 'F':'?',
+}
+ADDRESS_NUMBERS=dict((sym, num) for num, sym in ADDRESS_SYMBOLS.items())
 
+def convertToNum(sym):
+    return ADDRESS_NUMBERS.get(sym)
 
 def convertToSymbol(num):
-    if num=='0':
-        return '@'
-    elif num=='1':
-        return '1'
-    elif num=='2':
-        return '2'
-    elif num=='3':
-        return '3'
-    elif num=='4':
-        return '4'
-    elif num=='5':
-        return '5'
-    elif num=='6':
-        return '6'
-    elif num=='7':
-        return '7'
-    elif num=='8':
-        return '8'
-    elif num=='9':
-        return '9'
-    elif num=='A':
-        return ':'
-    elif num=='B':
-        return ';'
-    elif num=='C':
-        return '<'
-    elif num=='D':
-        return '='
-    elif num=='E':
-        return '>'
-    elif num=='F':
-        return '?' 
+    return ADDRESS_SYMBOLS.get(num)
+
+#Group addresses answer on behalf of several controllers at once. They
+# never reply, so several controllers don't talk over each other.
+GROUP_ADDRESSES={
+    'A':'12', 'C':'34', 'E':'56', 'G':'78',
+    'I':'9:', 'K':';<', 'M':'=>', 'O':'?@',
+    'Q':'1234', 'U':'5678', 'Y':'9:;<', ']':'=>?@',
+    '_':'123456789:;<=>?@',
+}
+
+def group_addresses(symbols):
+    """Covers a set of motor addresses with as few addresses as possible.
+
+    A group address is only used if every motor it reaches is in symbols,
+    so nothing outside the set is ever started.
+
+    Args:
+        symbols: motor address symbols, e.g. '1234' or {'1','2','5'}.
+
+    Returns:
+        a list of group and single addresses, largest groups first.
+
+    """
+    left=set(symbols)
+    out=[]
+    for group, members in sorted(GROUP_ADDRESSES.items(), key=lambda kv: -len(kv[1])):
+        if set(members)<=left:
+            out.append(group)
+            left-=set(members)
+    return out+sorted(left)
+
+FRAME_START=b'/0'
+FRAME_END=b'\x03'
+
+def find_frame(buf):
+    """Finds the first complete DT-protocol frame in a byte buffer.
+
+    Args:
+        buf (bytes): bytes received so far.
+
+    Returns:
+        (frame, rest): frame is everything between '/0' and ETX (status byte
+        included), or None if no complete frame is buffered yet. rest is the
+        unconsumed part of the buffer.
+
+    """
+    start=buf.find(FRAME_START)
+    if start==-1:
+        #keep a trailing '/' in case the '0' hasn't arrived yet
+        return None, buf[-1:] if buf.endswith(b'/') else b''
+    end=buf.find(FRAME_END, start+len(FRAME_START))
+    if end==-1:
+        return None, buf[start:]
+    return buf[start+len(FRAME_START):end], buf[end+len(FRAME_END):]
+
+def decode_frame(frame):
+    """Strips the status byte from a frame and decodes the rest to a str."""
+    #0xff is sent as a fill byte by some firmware versions
+    return frame[1:].replace(b'\xff', b'f').decode('utf-8', 'ignore')
+
+#status byte: 0x40 | ready bit | error code
+STATUS_READY=0x20
+STATUS_ERROR_MASK=0x0f
+
+ERR_NONE=0
+ERR_INIT=1
+ERR_BAD_COMMAND=2
+ERR_BAD_OPERAND=3
+ERR_COMMS=5
+ERR_NOT_INITIALIZED=7
+ERR_OVERLOAD=9
+ERR_MOVE_NOT_ALLOWED=11
+ERR_OVERFLOW=15
+
+ERRORS={
+    ERR_NONE:"no error",
+    ERR_INIT:"initialization error",
+    ERR_BAD_COMMAND:"bad command",
+    ERR_BAD_OPERAND:"operand out of range",
+    ERR_COMMS:"communications error",
+    ERR_NOT_INITIALIZED:"not initialized",
+    ERR_OVERLOAD:"overload",
+    ERR_MOVE_NOT_ALLOWED:"move not allowed",
+    ERR_OVERFLOW:"command overflow",
+}
+
+_INT_RE=re.compile(r'-?\d+')
+
+class Response:
+    """A decoded reply frame.
+
+    Attributes:
+        status (int): the raw status byte.
+        ready (bool): False while the controller is running a command.
+        error (int): error code, one of the ERR_ constants.
+        data (str): the payload, e.g. a position or a version string.
+    """
+
+    __slots__=('status', 'ready', 'error', 'data')
+
+    def __init__(self, status, data):
+        self.status=status
+        self.ready=bool(status&STATUS_READY)
+        self.error=status&STATUS_ERROR_MASK
+        self.data=data
+
+    @classmethod
+    def from_frame(cls, frame):
+        """Decodes the bytes between '/0' and ETX, as returned by find_frame."""
+        if not frame:
+            return cls(0, '')
+        return cls(frame[0], decode_frame(frame))
+
+    @property
+    def busy(self):
+        return not self.ready
+
+    @property
+    def error_text(self):
+        return ERRORS.get(self.error, "error "+str(self.error))
+
+    def integer(self):
+        """The payload as an int, e.g. for '?0' or '?2', or None if it has no number."""
+        m=_INT_RE.search(self.data)
+        if m is None:
+            return None
+        return int(m.group())
+
+    @property
+    def value(self):
+        """The payload as an int if it is a number, else as a str, or None if empty."""
+        if not self.data:
+            return None
+        n=self.integer()
+        if n is not None and _INT_RE.fullmatch(self.data.strip('\x00')):
+            return n
+        return self.data
+
+    def __repr__(self):
+        return "Response(ready=%r, error=%r, data=%r)"%(self.ready, self.error, self.data)
+
+#bytes in a reply with no payload: '/0', status, ETX, CR, LF
+QUERY_REPLY_LENGTH=6
+
+#bounds on how often wait_until_idle polls, in seconds
+POLL_MIN=0.005
+POLL_MAX=0.5
+
+#seconds Motor.idle_timeout allows past when the motion model says a move
+#ends, and in all when the model can't tell
+IDLE_MARGIN=5.0
+IDLE_TIMEOUT=60.0
+
+def next_poll_interval(interval, velocity=None, target=None, position=None):
+    """Picks how long to sleep before polling a busy motor again.
+
+    With a velocity, target and current position, sleeps half of the time
+    the move should still take. Otherwise doubles the last interval.
+    """
+    if velocity and target is not None and position is not None:
+        left=abs(target-position)/float(velocity)
+        return min(POLL_MAX, max(POLL_MIN, left/2))
+    return min(POLL_MAX, interval*2)
+
+#command letters that move a motor or change its position count
+MOTION_RE=re.compile(r'[APDzZTeg]')
+
+def is_motion(body):
+    """Whether a command, without its '/' and address, can change a motor's position.
+
+    Commands stored with 's' don't run, and a bare 'R' runs whatever was
+    stored, so it counts as motion.
+    """
+    if body.startswith('s'):
+        return False
+    if body.endswith('R'):
+        body=body[:-1]
+        if not body:
+            return True
+    return MOTION_RE.search(body) is not None
+
+class SerialBus:
+    """One open serial port, shared by every motor address on it.
+
+    A bus owns the serial.Serial and the lock that serializes traffic on it,
+    so several addressed motors on one RS-485 adapter can be driven without
+    reopening the device or fighting over it. Use SerialBus.get() to obtain
+    the bus for a port; it is opened on first use and reused afterwards.
+    """
+
+    MAX_MOTORS=16
+
+    #syringe_recorder.FlightRecorder every frame is written to, or None
+    recorder=None
+
+    _buses={}
+    _buses_lock=threading.Lock()
+
+    def __init__(self, port, baud=9600):
+        self.port=port
+        self.srl_rlock=threading.RLock()
+        self.srl_port=serial.Serial()
+        self.srl_port.bytesize=8
+        self.srl_port.parity=serial.PARITY_NONE
+        self.srl_port.stopbits=serial.STOPBITS_ONE
+        self.srl_port.baudrate=baud
+        #longest gap between reply bytes before a reply counts as lost
+        self.srl_port.timeout=0.02
+
+        self._nextsleep=time.time()
+        #time.monotonic() when the last command started going out
+        self.last_write=None
+
+        #measured by calibrate(); None until then
+        self.delay=None
+        self.turnaround=None
+        self.turnaround_max=None
+
+        #motor_address -> Motor
+        self.motors={}
+
+    @classmethod
+    def get(cls, port, baud=9600):
+        """Returns the open bus for port, opening it if needed.
+
+        A device node can only be opened once, so there is one bus per port.
+        If the bus is already open at another baud rate, it is switched.
+
+        Raises:
+            SerialException: if the port can't be opened.
+
+        """
+        with cls._buses_lock:
+            bus=cls._buses.get(port)
+            if bus is None:
+                bus=cls(port, baud)
+                bus.open()
+            elif bus.srl_port.baudrate!=baud:
+                with bus.srl_rlock:
+                    bus.srl_port.baudrate=baud
+                if bus.recorder is not None:
+                    bus.recorder.opened(port, baud, time.monotonic())
+            return bus
+
+    @classmethod
+    def find(cls, port):
+        """Returns the bus already open for port, or None."""
+        with cls._buses_lock:
+            return cls._buses.get(port)
+
+    def open(self, register=True):
+        """Opens the port, if it isn't already, and registers the bus for it.
+
+        Args:
+            register (bool): False opens the port without registering it, so
+                get() and find() don't hand it out. For a short look at a
+                port, as syringe_discovery does.
+
+        """
+        with self.srl_rlock:
+            if not self.srl_port.isOpen():
+                self.srl_port.port=self.port
+                self.srl_port.open()
+                if self.recorder is not None:
+                    self.recorder.opened(self.port, self.srl_port.baudrate, time.monotonic())
+        if register:
+            SerialBus._buses.setdefault(self.port, self)
+
+    def close(self):
+        """Closes the port and forgets the bus."""
+        with SerialBus._buses_lock:
+            with self.srl_rlock:
+                self._close()
+
+    def _close(self):
+        """close(), with _buses_lock and then srl_rlock already held."""
+        if SerialBus._buses.get(self.port) is self:
+            del SerialBus._buses[self.port]
+        if self.srl_port.isOpen():
+            self.srl_port.close()
+
+    def attach(self, motor, address=None):
+        """Registers a motor on this bus under its address.
+
+        Args:
+            address (str): a new address for the motor. Its old entry on
+                this bus is replaced, so the port stays open.
+
+        Raises:
+            ValueError: if all 16 addresses are taken by other motors.
+
+        """
+        if address is None:
+            address=motor.motor_address
+        with self.srl_rlock:
+            moving=self.motors.get(motor.motor_address) is motor
+            if address not in self.motors and not moving and len(self.motors)>=self.MAX_MOTORS:
+                raise ValueError("bus already has "+str(self.MAX_MOTORS)+" motors")
+            if moving:
+                del self.motors[motor.motor_address]
+            motor.motor_address=address
+            self.motors[address]=motor
+            motor.bus=self
+            reopen=self.port is not None and not self.srl_port.isOpen()
+        if reopen:
+            #a bus that was closed when its last motor left. _buses_lock is
+            # always taken before srl_rlock, as in get() and close().
+            with SerialBus._buses_lock:
+                with self.srl_rlock:
+                    if self.motors:
+                        self.open()
+
+    def detach(self, motor):
+        """Unregisters a motor. The port closes once no motors are attached."""
+        with self.srl_rlock:
+            if self.motors.get(motor.motor_address) is motor:
+                del self.motors[motor.motor_address]
+            unused=not self.motors and self.port is not None
+        if unused:
+            with SerialBus._buses_lock:
+                with self.srl_rlock:
+                    #unless a motor was attached in between
+                    if not self.motors:
+                        self._close()
+
+    def wait(self, delay):
+        """wait for the serial port to do things before you use it."""
+        time.sleep(max(0,self._nextsleep - time.time()))
+        self._nextsleep=time.time() + delay
+
+    def byte_time(self, n):
+        """Seconds to send n bytes at the current baud rate, with start and stop bits."""
+        return n*(self.srl_port.bytesize+2)/float(self.srl_port.baudrate)
+
+    def default_delay(self):
+        """Gap between a reply and the next command: calibrated, or two byte times."""
+        if self.delay is not None:
+            return self.delay
+        return 2*(float(self.srl_port.bytesize)/self.srl_port.baudrate)
+
+    def reply_timeout(self, n):
+        """Seconds to wait for the first reply byte after sending n bytes.
+
+        The command has to go out on the wire before the controller can
+        answer, so long programs get longer than short queries.
+        """
+        turnaround=self.turnaround_max*2 if self.turnaround_max is not None else 0
+        return self.byte_time(n)+turnaround+self.srl_port.timeout
+
+    def calibrate(self, address, samples=8):
+        """Measures this port's reply turnaround and tunes the delays to it.
+
+        First times 'Q' round trips with the default delay, and takes off
+        the time the bytes spend on the wire. Then finds the smallest gap
+        between commands at which the controller still answers every one.
+
+        Args:
+            address (str): a motor on this bus that answers.
+            samples (int): round trips per measurement.
+
+        Returns:
+            the profile dict, or None if the motor never answered.
+
+        """
+        message="/"+address+"Q"
+        with self.srl_rlock:
+            self.delay=None
+            rtts=[]
+            for _ in range(samples):
+                t=time.perf_counter()
+                if self.sendCommand(message) is not None:
+                    rtts.append(time.perf_counter()-t)
+            if not rtts:
+                return None
+
+            rtts.sort()
+            wire=self.byte_time(len(message)+1+QUERY_REPLY_LENGTH)
+            self.turnaround=max(0.0, rtts[len(rtts)//2]-wire)
+            self.turnaround_max=max(0.0, rtts[-1]-wire)
+
+            default=self.default_delay()
+            self.delay=default
+            for delay in [0.0, self.byte_time(1)/4, self.byte_time(1)/2, self.byte_time(1)]:
+                if delay>=default:
+                    break
+                if all(self.sendCommand(message, delay) is not None for _ in range(samples)):
+                    self.delay=delay
+                    break
+        return self.profile()
+
+    def profile(self):
+        """The calibrated timing, for saving with the motor calibration."""
+        return {'turnaround':self.turnaround, 'turnaround_max':self.turnaround_max, 'delay':self.delay}
+
+    def apply_profile(self, profile):
+        """Restores timing measured by calibrate() earlier."""
+        self.turnaround=profile.get('turnaround')
+        self.turnaround_max=profile.get('turnaround_max')
+        self.delay=profile.get('delay')
+
+    def sendBroadcast(self, message, delay=None):
+        """Sends a command to a group address. Group addresses never reply."""
+        if delay==None:
+            delay=self.default_delay()
+
+        with self.srl_rlock:
+            if not self.srl_port.isOpen(): 
+                raise serial.serialutil.SerialException("port not open")
+
+            self.wait(delay)
+            self.last_write=time.monotonic()
+            self.srl_port.write(bytes((message+"\r").encode("utf-8")))
+            if self.recorder is not None:
+                self.recorder.tx(self.port, message, self.last_write)
+            #give the line time to drain before the next command
+            self._nextsleep=time.time()+delay+(len(message)+1)*10.0/self.srl_port.baudrate
+            self._observe(message, None)
+
+    def _observe(self, message, response):
+        """Keeps the cached state of the motors a command reached up to date.
+
+        Motion invalidates what they last reported. Other replies are
+        remembered, see Motor.remember. Everything goes to their motion
+        models, timed from when the controller had the whole command.
+        """
+        address=message[1:2]
+        body=message[2:]
+        motion=is_motion(body)
+        when=self.last_write+self.byte_time(len(message)+1)
+        for a in GROUP_ADDRESSES.get(address, address):
+            motor=self.motors.get(a)
+            if motor is None:
+                continue
+            if motion:
+                motor.invalidate()
+            elif response is not None:
+                motor.remember(body, response)
+            motor.model.observe(body, response, when, address in GROUP_ADDRESSES)
+
+    def sendRawCommand(self, message, delay=None):
+        """Sends a command and returns the payload of its reply as a str, or None.
+
+        See sendCommand.
+        """
+        response=self.sendCommand(message, delay)
+        if response is None:
+            return None
+        return response.data
+
+    def sendCommand(self, message, delay=None):
+        """Sends a command and returns the first reply frame as a Response.
+
+        Stale input is dropped with a single flush before sending. The reply
+        is read in bulk and returned as soon as a complete '/0...ETX' frame
+        has been parsed, instead of waiting for the port to time out.
+
+        Args:
+            message (str): the full command, e.g. '/1?0'. '\\r' is appended.
+            delay (float): minimum time between port operations. Defaults to
+                default_delay().
+
+        Returns:
+            the decoded Response, or None if no reply started within
+            reply_timeout(), or the reply stopped before a complete frame.
+
+        """
+        if delay==None:
+            delay=self.default_delay()
+
+        with self.srl_rlock:
+            if not self.srl_port.isOpen(): 
+                raise serial.serialutil.SerialException("port not open")
+
+            self.wait(delay)
+            self.srl_port.flushInput()
+            self.last_write=time.monotonic()
+            self.srl_port.write(bytes((message+"\r").encode("utf-8")))
+            recorder=self.recorder
+            if recorder is not None:
+                recorder.tx(self.port, message, self.last_write)
+            deadline=time.time()+self.reply_timeout(len(message)+1)
+
+            totalRx=b""
+            while True:
+                #block for at least one byte, then take whatever else is waiting
+                rx=self.srl_port.read(max(1,self.srl_port.inWaiting()))
+                if not rx:
+                    if totalRx or time.time()>=deadline:
+                        #timed out before a full frame arrived
+                        self._nextsleep=time.time()+delay
+                        if recorder is not None:
+                            now=time.monotonic()
+                            recorder.lost(self.port, message, now, now-self.last_write)
+                        self._observe(message, None)
+                        return None
+                    continue
+
+                totalRx+=rx
+                frame,totalRx=find_frame(totalRx)
+                if frame is not None:
+                    self._nextsleep=time.time()+delay
+                    if recorder is not None:
+                        now=time.monotonic()
+                        recorder.rx(self.port, message, FRAME_START+frame+FRAME_END, now, now-self.last_write)
+                    response=Response.from_frame(frame)
+                    self._observe(message, response)
+                    return response
+
+#seconds save_later waits for more changes before writing
+SAVE_DELAY=1.0
+
+#above this, in steps/s, the motor is not accurate
+MAX_VELOCITY=732143
+
+#stored program slots Motor.run_program uses by default. Slot 0 runs when
+# the controller powers up, and the lower slots are left for programs
+# stored by hand. Set per motor with <program_slots> in the calibration file.
+PROGRAM_SLOTS=range(11, 16)
+#longest command the controller will buffer, including address and 'R'
+MAX_COMMAND_LENGTH=255
+#programs run_program remembers seeing once, so only repeats are stored
+PROGRAMS_SEEN=64
+
+def parse_slots(text):
+    """Reads a slot range like '11-15' or '3'. Empty text means no slots.
+
+    Raises:
+        ValueError: for slots outside 1-15.
+
+    """
+    text=(text or '').strip()
+    if not text:
+        return range(0)
+    first, _, last=text.partition('-')
+    slots=range(int(first), int(last or first)+1)
+    if not slots or slots[0]<1 or slots[-1]>15:
+        raise ValueError("program slots must be within 1-15, not "+text)
+    return slots
+
+def format_slots(slots):
+    """The text parse_slots reads back."""
+    if not slots:
+        return ''
+    return str(slots[0])+'-'+str(slots[-1])
 
 class MotorGroup:
     def __init__(self):
         self.motordict={}    
+        self.bus=None
+        #(port, baud) -> SerialBus.profile(), saved with the calibration
+        self.bus_profiles={}
+        #motordict keys changed since the last write. None means the group itself.
+        self.dirty=set()
+        #filename -> bytes last read or written there, so unchanged data isn't rewritten
+        self._saved={}
+        self._save_lock=threading.Lock()
+        self._save_timer=None
+        self._save_filename=None
+        #to_xml() at the last save_later, for when the filename changes
+        self._save_data=None
+
+    def connect(self, port, baud=9600, calibrate=True):
+        """Opens the shared bus for port and attaches every motor in the group to it.
+
+        The bus timing saved for this port and baud rate is restored. If
+        there is none yet, it is measured with the first motor that answers.
+        """
+        self.bus=SerialBus.get(port, baud)
+        for motor in self.motordict.values():
+            self.bus.attach(motor)
+
+        profile=self.bus_profiles.get((port, baud))
+        if profile is not None:
+            self.bus.apply_profile(profile)
+        elif calibrate:
+            for motor in self.motordict.values():
+                profile=self.bus.calibrate(motor.motor_address)
+                if profile is not None:
+                    self.bus_profiles[(port, baud)]=profile
+                    break
+        return self.bus
+
+    def pump_key(self, num):
+        """motordict key for a pump number like 'a' or 'A'.
+
+        load() stores keys lower case while the GUI uses upper case, so
+        both are tried. Returns num if neither is in the group.
+        """
+        for key in (num, num.lower(), num.upper()):
+            if key in self.motordict:
+                return key
+        return num
+
+    def attach(self, motor):
+        """Attaches a motor to the group's bus, if the group is connected."""
+        if self.bus is not None:
+            self.bus.attach(motor)
+
+    def broadcast(self, command, names=None):
+        """Sends the same command to several motors in as few frames as possible.
+
+        Motors covered by a group address get one unacknowledged frame
+        between them. Motors that don't fill a group are sent to one by one.
+
+        Args:
+            command (str): command without an address, e.g. 'TR'.
+            names: keys of motordict to send to. Defaults to all of them.
+
+        Raises:
+            SerialException: if the group is not connected.
+
+        """
+        if self.bus is None:
+            raise serial.serialutil.SerialException("port not open")
+        if names is None:
+            names=self.motordict.keys()
+        symbols=set(self.motordict[n].motor_address for n in names)
+        for address in group_addresses(symbols):
+            if address in GROUP_ADDRESSES:
+                self.bus.sendBroadcast("/"+address+command)
+            else:
+                self.bus.sendRawCommand("/"+address+command)
+
+    def start(self, programs):
+        """Uploads a program to each motor, then starts them all together.
+
+        Each program is stored without running, then a group 'R' starts
+        every motor in as few frames as possible, so their start times
+        aren't skewed by one round trip per pump.
+
+        Args:
+            programs (dict): motordict key to command without address or
+                trailing 'R', e.g. {'1':'V2000A0', '2':'V4000A0'}.
+
+        """
+        for name, program in programs.items():
+            motor=self.motordict[name]
+            motor.sendRawCommand("/"+motor.motor_address+program)
+        self.broadcast("R", programs.keys())
+
+    def reconcile(self, names=None):
+        """Reads back each motor's position after a group command.
 
-    def serialize(self, filename):
-        #make xml
+        Returns:
+            dict of motordict key to position, for the motors that answered.
+
+        """
+        if names is None:
+            names=list(self.motordict.keys())
+        positions={}
+        for n in names:
+            try:
+                positions[n]=self.motordict[n].getPosition()
+            except (IndexError, serial.serialutil.SerialException):
+                continue
+            self.motordict[n].motor_position=positions[n]
+        return positions
+
+    def to_xml(self):
+        """Builds the calibration file contents.
+
+        Returns:
+            the xml document as bytes.
+
+        """
         root=ET.Element('constants')
-        for name, motorClass in self.motordict.items():
+        for name, motorClass in list(self.motordict.items()):
                 motorElement=ET.SubElement(root, 'motor_'+name)
                 mL_per_rad=ET.SubElement(motorElement, 'mL_per_rad')
                 mL_per_rad.text=str(motorClass.mL_per_rad)
@@ -102,10 +721,120 @@ class MotorGroup:
                 motor_pos.text=str(motorClass.motor_position)
                 max_pos=ET.SubElement(motorElement, 'max_pos')
                 max_pos.text=str(motorClass.max_pos)
+                program_slots=ET.SubElement(motorElement, 'program_slots')
+                program_slots.text=format_slots(motorClass.program_slots)
+                accel_scale=ET.SubElement(motorElement, 'accel_scale')
+                accel_scale.text='' if motorClass.accel_scale is None else str(motorClass.accel_scale)
+        for (port, baud), profile in list(self.bus_profiles.items()):
+                busElement=ET.SubElement(root, 'bus')
+                ET.SubElement(busElement, 'port').text=str(port)
+                ET.SubElement(busElement, 'baud').text=str(baud)
+                for key, value in profile.items():
+                    if value is not None:
+                        ET.SubElement(busElement, key).text=str(value)
+        return ET.tostring(root)
+
+    def serialize(self, filename, data=None):
+        """Writes the calibration file, if its contents changed.
+
+        The file is written to a temporary file in the same directory and
+        renamed over the old one, so a crash never leaves half a file. The
+        new file keeps the old one's permissions, or gets the usual ones
+        for a new file.
+
+        Args:
+            data (bytes): what to write. Defaults to to_xml().
+
+        Returns:
+            True if the file was written.
+
+        """
+        if data is None:
+            data=self.to_xml()
+        with self._save_lock:
+            if self._saved.get(filename)==data:
+                return False
+        try:
+            with open(filename, 'rb') as f:
+                if f.read()==data:
+                    with self._save_lock:
+                        self._saved[filename]=data
+                    return False
+        except EnvironmentError:
+            pass
+
+        try:
+            mode=stat.S_IMODE(os.stat(filename).st_mode)
+        except EnvironmentError:
+            #mkstemp makes files only the owner can read
+            umask=os.umask(0)
+            os.umask(umask)
+            mode=0o666&~umask
+        fd, tmp=tempfile.mkstemp(prefix='.'+os.path.basename(filename)+'.', suffix='.tmp',
+                                 dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                os.fchmod(f.fileno(), mode)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, filename)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        with self._save_lock:
+            self._saved[filename]=data
+        return True
 
-        #write xml
-        tree=ET.ElementTree(root)
-        tree.write(filename)
+    def mark_dirty(self, name=None):
+        """Notes that a motor's calibration, or the group, needs saving."""
+        with self._save_lock:
+            self.dirty.add(name)
+
+    def save_later(self, filename, delay=SAVE_DELAY):
+        """Writes the calibration file in the background once changes stop.
+
+        Calls within delay seconds of each other are written together. Only
+        does anything if something was marked dirty.
+        """
+        with self._save_lock:
+            if not self.dirty:
+                return
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+            if self._save_filename is not None and self._save_filename!=filename:
+                #earlier changes were for the other file, so write them there as they were
+                threading.Thread(target=self.serialize, args=(self._save_filename, self._save_data), daemon=True).start()
+            self._save_filename=filename
+            self._save_data=self.to_xml()
+            self._save_timer=threading.Timer(delay, self.flush)
+            self._save_timer.daemon=True
+            self._save_timer.start()
+
+    def flush(self):
+        """Writes any pending save_later now.
+
+        Returns:
+            True if the file was written.
+
+        """
+        with self._save_lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer=None
+            filename, self._save_filename=self._save_filename, None
+            if filename is None or not self.dirty:
+                return False
+            dirty, self.dirty=self.dirty, set()
+        try:
+            return self.serialize(filename)
+        except BaseException:
+            #still unsaved, so a later flush tries again
+            with self._save_lock:
+                self.dirty|=dirty
+                if self._save_filename is None:
+                    self._save_filename=filename
+            raise
  
     def load(self, filename):
         """Gets serialized data that may change between motors.
@@ -121,25 +850,38 @@ class MotorGroup:
         """
 
         xml_good=True
+
+        #pending changes belong to the data being replaced
+        self.flush()
         
         self.motordict.clear()
+        self.bus_profiles.clear()
 
 
         #scan doc
         try:
-            tree=ET.parse(filename)
-            root=tree.getroot()
+            with open(filename, 'rb') as f:
+                data=f.read()
+            root=ET.fromstring(data)
+            with self._save_lock:
+                self._saved[filename]=data
 
             for m in root:
+                if m.tag=='bus':
+                    self.load_bus_profile(m)
+                    continue
                 p=m.tag.lower()
                 num=p[-1:]
                 #check that pump tag ends with a valid number (STOP HERE)
                 if (ord(num)>=ord('0') and ord(num)<=ord('9')) or (ord(num)>=ord('a') and ord(num)<=ord('f')):
                         self.motordict[num]=Motor()
                         self.motordict[num].motor_address=convertToSymbol(num)
+                        self.attach(self.motordict[num])
                 else:
                     continue
+                found=set()
                 for child in m:
+                    found.add(child.tag)
                     if child.tag=='mL_per_rad':
                         self.motordict[num].mL_per_rad=float(child.text)
                     elif child.tag=='pos_per_rad':
@@ -148,19 +890,14 @@ class MotorGroup:
                         self.motordict[num].motor_position=float(child.text)
                     elif child.tag=='max_pos':
                         self.motordict[num].max_pos=float(child.text)
+                    elif child.tag=='program_slots':
+                        self.motordict[num].program_slots=parse_slots(child.text)
+                    elif child.tag=='accel_scale':
+                        self.motordict[num].accel_scale=float(child.text) if child.text else None
                 
-                #check data
-                if not hasattr(self,'mL_per_rad'):
-                    self.motordict[num].mL_per_rad=0.016631691553103064#found experimentally
-                    xml_good=False
-                if not hasattr(self,'pos_per_rad'):
-                    self.motordict[num].motor_position_per_rad=8156.69083345965#found experimentally(on free motor)
-                    xml_good=False
-
-                if not hasattr(self, 'motor_pos'):
-                    xml_good=False
-
-                if not hasattr(self, 'max_pos'):
+                #check data. Missing values keep Motor's defaults.
+                if not found.issuperset(('mL_per_rad', 'pos_per_rad', 'motor_pos', 'max_pos')):
+                    self.mark_dirty(num)
                     xml_good=False
          
 
@@ -170,11 +907,27 @@ class MotorGroup:
         
         #fix doc
         if not xml_good: 
-            self.serialize(filename)
+            self.save_later(filename)
 
         return xml_good
 
 
+    def load_bus_profile(self, element):
+        """Reads one <bus> element written by serialize."""
+        profile={}
+        port=None
+        baud=None
+        for child in element:
+            if child.tag=='port':
+                port=child.text
+            elif child.tag=='baud':
+                baud=int(child.text)
+            else:
+                profile[child.tag]=float(child.text)
+        if port is not None and baud is not None:
+            self.bus_profiles[(port, baud)]=profile
+
+
 class Motor:
     """"""
 
@@ -183,14 +936,8 @@ class Motor:
         
         Also creates default variables used by the calling class.
         """
-        self.srl_rlock=threading.RLock()
-        self.srl_port=serial.Serial()
-        self.srl_port.bytesize=8
-        self.srl_port.parity=serial.PARITY_NONE
-        self.srl_port.stopbits=serial.STOPBITS_ONE
-        self.srl_port.baudrate=9600
-
-        self._nextsleep=time.time()
+        #unopened until connect() attaches this motor to a shared bus
+        self.bus=SerialBus(None)
 
         self.motor_address='1'
         self.motor_position=1073741823#(2^30)-1
@@ -203,114 +950,526 @@ class Motor:
         #last pump operations, for calibration reasons
         self.vol=0
         self.rad=0 
+        #last reply received, with the motor's ready/busy state
+        self.last_response=None
+        #stored program slots this host may overwrite
+        self.program_slots=PROGRAM_SLOTS
+        #stored program slot -> hash of the program uploaded there, least recently run first
+        self.programs=collections.OrderedDict()
+        #hashes of programs run_program has sent once, oldest first
+        self.programs_seen=collections.OrderedDict()
+        #seconds getPosition and status reuse the last reply of an idle motor for
+        self.max_age=1.0
+        #(time.monotonic(), value) of the last reported position and status
+        self._position=None
+        self._status=None
+        #predicts position from the commands sent, see predicted_position
+        self.model=syringe_model.MotionModel()
+
+    @property
+    def accel_scale(self):
+        """microsteps/s^2 per unit of 'L' for this motor, or None if not calibrated.
+
+        Saved with the calibration as <accel_scale>. The motion model uses
+        it to time acceleration. Measure it with measure_accel_scale, or
+        from a shell with 'syringe-pump accel'.
+        """
+        return self.model.accel_scale
+
+    @accel_scale.setter
+    def accel_scale(self, value):
+        self.model.accel_scale=value
+
+    @property
+    def srl_port(self):
+        """The serial.Serial owned by this motor's bus."""
+        return self.bus.srl_port
+
+    @property
+    def srl_rlock(self):
+        """The lock owned by this motor's bus."""
+        return self.bus.srl_rlock
 
     def connect(self,port,baud=9600,motor_address='1'):
-        """"""
-        with self.srl_rlock:
-            
-            try:
-                del self.srl_port
-            except AttributeError:
-                pass #already deleted
-            try:
-                self.srl_port=serial.Serial(port)
-            except serial.serialutil.SerialException as se:
-                #todo: make this call the main window and print to its console
-                print(se.errno)
-                print (se.strerror)
-
-            self.srl_port.bytesize=8
-            self.srl_port.parity=serial.PARITY_NONE
-            self.srl_port.stopbits=serial.STOPBITS_ONE
-            self.srl_port.baudrate=baud
-            self.srl_port.timeout=0.02 
-            #self.srl_port.open() port opens automatically
-            response = self.sendRawCommand("/"+motor_address+"Q")
-            print('/'+motor_address+"Q")
-            print(response)
-            if response != None:
-                self.motor_address=motor_address
-                return True
-
-            
-                pass
-            #ignoring this, because I had a case where I could send and couldn't
-            # receive. It was still useful to send something.
-            #self.disconnect()
-            raise serial.serialutil.SerialException("Did not receive any data")
-            return False #However, I can give a warning
+        """Attaches the motor to the shared bus for port and probes it.
+
+        The port is only opened if no other motor is using it yet.
+
+        Raises:
+            SerialException: if the port can't be opened or nothing answers.
+
+        """
+        try:
+            bus=SerialBus.get(port,baud)
+        except serial.serialutil.SerialException as se:
+            #todo: make this call the main window and print to its console
+            print(se.errno)
+            print (se.strerror)
+            raise
+
+        #probe first, so a motor that doesn't answer stays where it was
+        response = bus.sendCommand("/"+motor_address+"Q")
+        if response != None:
+            self.last_response=response
+            #on the same bus, only the address changes, so the port stays open
+            if bus is not self.bus:
+                self.bus.detach(self)
+            bus.attach(self, motor_address)
+            #this may be a different controller, with other programs stored
+            self.programs.clear()
+            self.model.reset()
+            return True
+
+        if bus is not self.bus and not bus.motors:
+            bus.close()
+        #ignoring this, because I had a case where I could send and couldn't
+        # receive. It was still useful to send something.
+        #self.disconnect()
+        raise serial.serialutil.SerialException("Did not receive any data")
+        return False #However, I can give a warning
 
     def disconnect(self):
-        """"""
-        with self.srl_rlock:
-            if self.srl_port.isOpen():
-                self.srl_port.close()
+        """Detaches from the bus. The port closes once no motors use it."""
+        self.bus.detach(self)
     
     def wait(self, delay):
         """wait for the serial port to do things before you use it."""
-        time.sleep(max(0,self._nextsleep - time.time()))
-        self._nextsleep=time.time() + delay
+        self.bus.wait(delay)
 
     def sendRawCommand(self, message, delay=None):
-        """"""
-        if delay==None:
-            delay=2*(float(self.srl_port.bytesize)/self.srl_port.baudrate)
+        """Sends a command and returns the payload of its reply as a str, or None."""
+        response=self.sendCommand(message, delay)
+        if response is None:
+            return None
+        return response.data
 
-        with self.srl_rlock:
-            if not self.srl_port.isOpen(): 
-                raise serial.serialutil.SerialException("port not open")
-            
-            self.wait(delay)
-            try:
-                garbage = self.srl_port.read()
-            except:
-                garbage = None
+    def sendCommand(self, message, delay=None):
+        """Sends a command through this motor's bus. See SerialBus.sendCommand.
 
-            self.wait(delay)
-            #try:
-            self.srl_port.write(bytes((message+"\r").encode("utf-8")))
-            #except Exception as ex:
-            #    import traceback
-            #    traceback.print_exception(type(ex), ex, ex.__traceback__)
-            
-            totalRx=""
-            responseContent=None
+        The reply is also kept in last_response, so callers can check
+        whether the motor is busy without sending another query.
+        """
+        response=self.bus.sendCommand(message, delay)
+        if response is not None:
+            self.last_response=response
+        return response
 
-            while True:
-                self.wait(delay)
-                try:
-                    rxStr=self.srl_port.read()
-                    if rxStr==b'\xff':
-                        rxStr=b'f'
-                    rxStr=rxStr.decode('utf-8')
-                except:
-                    rxStr=""
-
-                if rxStr == "":
-                    #nothing more to read
-                    return responseContent
-
-                totalRx+=rxStr
-
-                #check completeness
-                if (totalRx.find('\x03')==-1 or totalRx.find("/0")==-1):
-                    continue #keep accumulating
-
-                startTrim = totalRx.find("/0")
-                trimOne = totalRx[startTrim + len("/0"):]
-                finalTrim = trimOne[:trimOne.find("\x03")]
-                
-                responseContent = finalTrim[1:]
-                totalRx=""
+    def program_body(self, program):
+        """Strips the address and trailing 'R' from a command like cycle_program builds."""
+        prefix="/"+self.motor_address
+        if program.startswith(prefix):
+            program=program[len(prefix):]
+        if program.endswith("R"):
+            program=program[:-1]
+        return program
+
+    def store_program(self, program):
+        """Uploads a program to a stored program slot, unless it is already in one.
+
+        Only program_slots are used. The least recently run one this host
+        stored is reused once they are all taken. Each upload is an EEPROM
+        write on the controller.
 
+        Args:
+            program (str): a full command, e.g. '/1gV2000A0V2000A1000G10R',
+                or just its body.
 
+        Returns:
+            the slot number, or None if it wasn't stored: no slots, too long
+            to store, or the motor didn't store it.
 
+        """
+        body=self.program_body(program)
+        digest=hashlib.sha1(body.encode("utf-8")).hexdigest()
+        slot=self._stored_slot(digest)
+        if slot is not None:
+            return slot
 
+        slots=[s for s in self.program_slots if s not in self.programs]
+        if not slots:
+            slots=[s for s in self.programs if s in self.program_slots]
+        if not slots:
+            return None
+        slot=slots[0]
+        command="/"+self.motor_address+"s"+str(slot)+body+"R"
+        if len(command)>MAX_COMMAND_LENGTH:
+            return None
+        self.programs.pop(slot, None)
+        response=self.sendCommand(command)
+        if response is None or response.error:
+            return None
+        self.programs[slot]=digest
+        return slot
 
+    def _stored_slot(self, digest):
+        """The slot holding a program, marked as just used, or None."""
+        for slot, stored in self.programs.items():
+            if stored==digest:
+                self.programs.move_to_end(slot)
+                return slot
+        return None
 
+    def run_program(self, program):
+        """Runs a program, from a stored slot if it has been run before.
 
+        The first run of a program is sent as an ordinary command, so
+        one-off programs don't wear the controller's EEPROM. Repeats are
+        stored, then started with a short 'e' command instead of sending
+        the whole program again. If it can't be stored, it is sent as an
+        ordinary command.
 
+        Returns:
+            the Response to the command that started it, or None.
 
-                
+        """
+        body=self.program_body(program)
+        digest=hashlib.sha1(body.encode("utf-8")).hexdigest()
+        slot=self._stored_slot(digest)
+        if slot is None and digest in self.programs_seen:
+            slot=self.store_program(program)
+        if slot is None:
+            self.programs_seen[digest]=True
+            self.programs_seen.move_to_end(digest)
+            while len(self.programs_seen)>PROGRAMS_SEEN:
+                self.programs_seen.popitem(last=False)
+            return self.sendCommand("/"+self.motor_address+body+"R")
+        response=self.sendCommand("/"+self.motor_address+"e"+str(slot)+"R")
+        if response is not None and response.error==ERR_BAD_COMMAND:
+            #the slot was changed behind our back
+            del self.programs[slot]
+        return response
+
+    def upload_profile(self, profile, duration, tolerance=0.001, dt=None, start=True):
+        """Stores a flow profile in a program slot, and starts it.
 
+        See syringe_program.profile_program for profile, duration,
+        tolerance and dt.
 
+        Args:
+            start (bool): False only stores it, to be started later with
+                'e' and the slot number.
+
+        Returns:
+            (slot, warnings): the slot number and a list of warning strings.
+
+        Raises:
+            ValueError: for profiles the motor can't follow, if it couldn't
+                be stored, or the motor rejected the start.
+            IndexError: if the motor did not answer the start.
+
+        """
+        #syringe_program imports this module
+        import syringe_program
+        exe, warnings=syringe_program.profile_program(self, profile, duration, tolerance, dt)
+        slot=self.store_program(exe)
+        if slot is None:
+            raise ValueError("could not store the profile in a program slot.")
+        if start:
+            self._accepted("/"+self.motor_address+"e"+str(slot)+"R")
+        return slot, warnings
+
+    def measure_accel_scale(self, steps=20000, accel=100, timeout=IDLE_TIMEOUT):
+        """Measures accel_scale by watching the motor speed up.
+
+        Runs a move of steps at a top speed it can't reach in that
+        distance, so it speeds up for the first half and slows down for the
+        second. While speeding up it has moved accel*accel_scale/2*t*t
+        steps, so the square root of the position grows in a straight line,
+        whatever the moment the move really started. The motor then goes
+        back where it was and gets its old 'V' and 'L' again.
+
+        The motor has to be initialized and free to move steps, up or down.
+        The result is not kept; set accel_scale to it.
+
+        Args:
+            steps (int): length of the test move.
+            accel (int): the 'L' to measure with. Pick one that takes a
+                good part of a second to cover steps/2.
+
+        Returns:
+            microsteps/s^2 per unit of 'L'.
+
+        Raises:
+            ValueError: if the motor rejected the move, or there were too
+                few readings while it sped up.
+            IndexError: if the motor did not answer.
+
+        """
+        address="/"+self.motor_address
+        start=self.getPosition(fresh=True)
+        target=start+steps if start+steps<=self.max_pos else start-steps
+        velocity, previous=self.model.velocity, self.model.accel
+        self._accepted(address+"L"+str(int(accel))+"V"+str(MAX_VELOCITY)+"R")
+        self._accepted(address+"A"+str(int(target))+"R")
+        times=[]
+        roots=[]
+        deadline=time.monotonic()+timeout
+        try:
+            while time.monotonic()<deadline:
+                response=self.sendCommand(address+"?0")
+                position=None if response is None else response.integer()
+                if position is None:
+                    continue
+                covered=abs(position-start)
+                if covered>=steps/2 or not response.busy:
+                    break
+                #small positions are mostly rounding
+                if covered>=steps/100:
+                    times.append(self.bus.last_write+self.bus.byte_time(len(address)+3))
+                    roots.append(math.sqrt(covered))
+        finally:
+            self.wait_until_idle(timeout)
+            self._accepted(address+"A"+str(int(start))+"R")
+            self.wait_until_idle(timeout)
+            self._accepted(address+"L"+str(int(previous))+"V"+str(int(velocity))+"R")
+        if len(times)<3:
+            raise ValueError("only "+str(len(times))+" readings while the motor sped up. Use more steps or a lower accel.")
+        #least squares slope of sqrt(position) over time
+        mean_t=sum(times)/len(times)
+        mean_r=sum(roots)/len(roots)
+        slope=(sum((t-mean_t)*(r-mean_r) for t, r in zip(times, roots))
+               /sum((t-mean_t)**2 for t in times))
+        return 2*slope*slope/accel
+
+    def invalidate_programs(self):
+        """Forgets what is stored, e.g. after another program used the controller."""
+        self.programs.clear()
+
+    def invalidate(self):
+        """Forgets the cached position and status. The bus calls this on motion."""
+        self._position=None
+        self._status=None
+
+    def remember(self, body, response):
+        """Caches what a reply to body said about the motor. The bus calls this."""
+        now=time.monotonic()
+        self._status=(now, response)
+        if body=='?0':
+            n=response.integer()
+            if n is not None:
+                self._position=(now, n)
+                self.motor_position=n
+
+    def _cached(self, entry):
+        """The value of a cache entry, if it is recent and the motor was idle."""
+        status=self._status
+        if entry is None or status is None or status[1].busy:
+            return None
+        if time.monotonic()-entry[0]>=self.max_age:
+            return None
+        return entry[1]
+
+    def status(self, fresh=False):
+        """The motor's last status reply, or a new one if it may be out of date.
+
+        Args:
+            fresh (bool): always ask the motor.
+
+        Returns:
+            a Response, or None if the motor didn't answer.
+
+        """
+        if not fresh:
+            response=self._cached(self._status)
+            if response is not None:
+                return response
+        return self.sendCommand("/"+self.motor_address+"Q")
+
+    @property
+    def busy(self):
+        """Whether the last reply said the motor was running a command, or None if unknown."""
+        if self.last_response is None:
+            return None
+        return self.last_response.busy
+
+    def wait_until_idle(self, timeout=None, velocity=None, target=None, cancel=None):
+        """Polls the motor until it is ready for another command.
+
+        With a velocity and target, polls '?0' and sleeps about half of the
+        estimated time left, so long moves cost few queries and short ones
+        finish with little dead time. Otherwise backs off exponentially.
+
+        Args:
+            timeout (float): seconds to give up after. None waits forever.
+            velocity (float): commanded velocity, in steps/s.
+            target (float): commanded position, in steps.
+            cancel (threading.Event): stops waiting early when set.
+
+        Returns:
+            True once the motor reports ready, False on timeout or cancel.
+
+        """
+        deadline=None if timeout is None else time.time()+timeout
+        interval=POLL_MIN
+        while True:
+            if cancel is not None and cancel.is_set():
+                return False
+            if target is not None:
+                response=self.sendCommand("/"+self.motor_address+"?0")
+            else:
+                response=self.sendCommand("/"+self.motor_address+"Q")
+
+            if response is not None:
+                if response.ready:
+                    return True
+                interval=next_poll_interval(interval, velocity, target, response.integer() if target is not None else None)
+            else:
+                interval=next_poll_interval(interval)
+
+            if deadline is not None:
+                if time.time()>=deadline:
+                    return False
+                interval=min(interval, max(0, deadline-time.time()))
+            if cancel is not None:
+                if cancel.wait(interval):
+                    return False
+            else:
+                time.sleep(interval)
+
+    def idle_timeout(self, t=None):
+        """Seconds to wait for the motor to finish what it's running.
+
+        The motion model times the running moves from their distances and
+        velocities. Loops that run forever, or a model with no readings
+        yet, get IDLE_TIMEOUT.
+
+        Args:
+            t (float): a time.monotonic() time. Defaults to now.
+
+        """
+        t=time.monotonic() if t is None else t
+        position, busy=self.model.predict(t)
+        if busy is False and position is not None:
+            return IDLE_MARGIN
+        end=self.model.end_time()
+        if end is None:
+            return IDLE_TIMEOUT
+        return max(0.0, end-t)+IDLE_MARGIN
+
+    def wait_for_position(self, target, velocity=None, tolerance=0, timeout=None, cancel=None):
+        """Waits until the motor is idle at target, give or take tolerance steps.
+
+        Returns:
+            True if it got there, False on timeout, cancel, or if it stopped
+            somewhere else.
+
+        """
+        if not self.wait_until_idle(timeout, velocity, target, cancel):
+            return False
+        return abs(self.getPosition()-target)<=tolerance
+
+    def getPosition(self, fresh=False):
+        """Gets the current position of the motor
+
+        An idle motor's position is reused for max_age seconds, until
+        anything is sent that could move it.
+
+        Args:
+            fresh (bool): always ask the motor.
+
+        Returns:
+            the position of the motor in steps from 0.
+        Raises:
+            IndexError: if motor is not responding correctly
+
+        """
+        if not fresh:
+            position=self._cached(self._position)
+            if position is not None:
+                return position
+        response=self.sendCommand("/"+self.motor_address+"?0")
+        n=None if response is None else response.integer()
+        if n is None:
+            raise IndexError("motor did not report a position")
+
+        return n
+
+    def predicted_position(self, t=None):
+        """Where the motion model puts the motor, without asking it.
+
+        Args:
+            t (float): a time.monotonic() time. Defaults to now.
+
+        Returns:
+            the position in steps. Falls back to motor_position until the
+            model has had a reading.
+
+        """
+        position=self.model.predict(time.monotonic() if t is None else t)[0]
+        return self.motor_position if position is None else position
+
+    def dispensed(self, t=None):
+        """mL injected since the current or last program started, by the motion model.
+
+        Draws are negative. None if the model doesn't know.
+        """
+        start=self.model.start_position
+        position=self.model.predict(time.monotonic() if t is None else t)[0]
+        if start is None or position is None:
+            return None
+        return (position-start)/self.motor_position_per_rad*self.mL_per_rad
+
+    def inject(self, vol, seconds, cancel=None, timeout=None):
+        """Moves vol mL over seconds, once the motor is done with what it's doing.
+
+        Negative volumes draw. The move stops at 0 and max_pos.
+
+        Args:
+            vol (float): mL to move.
+            seconds (float): time the move should take.
+            cancel (threading.Event): gives up waiting for the motor when set.
+            timeout (float): seconds to wait for the motor. Defaults to
+                idle_timeout().
+
+        Returns:
+            (target, warnings): the position the motor was sent to and a
+            list of warning strings, or None if cancelled. The motor is
+            still moving there, see wait_for_position.
+
+        Raises:
+            ValueError: if the move would be too fast, the motor is still
+                busy after timeout, or it rejected the move.
+            IndexError: if the motor did not answer, or did not report its
+                position.
+
+        """
+        steps=vol/self.mL_per_rad*self.motor_position_per_rad
+        vel=abs(steps)/seconds
+        if vel>MAX_VELOCITY:
+            raise ValueError("motor is not accurate at high speeds.")
+
+        warnings=[]
+        #the motor refuses new moves until the current one is done
+        if timeout is None:
+            timeout=self.idle_timeout()
+        if not self.wait_until_idle(timeout, cancel=cancel):
+            if cancel is not None and cancel.is_set():
+                return None
+            raise ValueError("motor is still busy after %.1f s. Stop it before moving it."%timeout)
+        self._accepted("/"+self.motor_address+"V"+str(int(vel))+"R")
+        target=self.getPosition()+steps
+        if target<0:
+            warnings.append("warn: could not go past 0 position.")
+            target=0
+        if target>self.max_pos:
+            warnings.append("Warn: could not go past max position. Will not inject correct volume!")
+            target=self.max_pos
+
+        target=int(target)
+        self._accepted("/"+self.motor_address+"A"+str(target)+"R")
+        return target, warnings
+
+    def _accepted(self, command):
+        """Sends a command that must be accepted.
+
+        Raises:
+            IndexError: if the motor did not answer.
+            ValueError: if the motor rejected it.
+
+        """
+        response=self.sendCommand(command)
+        if response is None:
+            raise IndexError("motor did not answer "+command)
+        if response.error:
+            raise ValueError("motor rejected "+command+": "+response.error_text)
+        return response
@@ -0,0 +1,388 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""asyncio versions of the syringe_motor classes.
+
+One event loop can drive every pump on every adapter: each AsyncSerialBus
+registers its file descriptor with the loop and parses response frames as
+bytes arrive, so no thread is needed per device. Commands are the same
+strings ControllerWindow sends, e.g. '/1A1000R', '/1?0' and '/1TR'.
+
+Example:
+    group=AsyncMotorGroup(motorGroup)
+    await group.connect('/dev/ttyUSB0')
+    await asyncio.gather(*(m.move_to(0) for m in group.motors()))
+
+"""
+import time
+import asyncio
+import serial
+import syringe_motor
+
+
+class AsyncSerialBus:
+    """One open serial port read through the event loop.
+
+    Like syringe_motor.SerialBus, there is one bus per port, shared by every
+    motor address on it. Commands on a bus are serialized with an
+    asyncio.Lock, while commands on different buses run concurrently.
+    """
+
+    _buses={}
+    #syringe_recorder.FlightRecorder every frame is written to, or None
+    recorder=None
+
+    #reply timing is worked out as for a syringe_motor.SerialBus
+    byte_time=syringe_motor.SerialBus.byte_time
+    reply_timeout=syringe_motor.SerialBus.reply_timeout
+    #and every command and reply updates the motors' caches and models the same way
+    _observe=syringe_motor.SerialBus._observe
+
+    def __init__(self, port, baud=9600, timeout=0.1):
+        self.port=port
+        self.baud=baud
+        #seconds to wait for a complete response frame, once the command is sent
+        self.timeout=timeout
+        #slowest reply measured by syringe_motor.SerialBus.calibrate, or None
+        self.turnaround_max=None
+        self.srl_port=None
+        self._lock=None
+        self._loop=None
+        self._rx=b""
+        self._waiter=None
+        #the last complete reply frame, for the recorder
+        self._frame=b""
+        self._nextsleep=0
+        #time.monotonic() when the last command started going out
+        self.last_write=None
+        #motor_address -> syringe_motor.Motor, kept up to date by _observe
+        self.motors={}
+
+    @classmethod
+    async def get(cls, port, baud=9600):
+        """Returns the open bus for port, opening it if needed."""
+        bus=cls._buses.get(port)
+        if bus is None:
+            bus=cls(port, baud)
+            cls._buses[port]=bus
+        await bus.open()
+        if bus.srl_port.baudrate!=baud:
+            bus.srl_port.baudrate=baud
+            bus.baud=baud
+        return bus
+
+    async def open(self):
+        """Opens the port in non-blocking mode and starts watching it."""
+        if self.srl_port is not None and self.srl_port.isOpen():
+            return
+        self._loop=asyncio.get_running_loop()
+        self._lock=asyncio.Lock()
+        self.srl_port=serial.Serial()
+        self.srl_port.port=self.port
+        self.srl_port.bytesize=8
+        self.srl_port.parity=serial.PARITY_NONE
+        self.srl_port.stopbits=serial.STOPBITS_ONE
+        self.srl_port.baudrate=self.baud
+        self.srl_port.timeout=0
+        self.srl_port.open()
+        self._loop.add_reader(self.srl_port.fileno(), self._on_readable)
+        if self.recorder is not None:
+            self.recorder.opened(self.port, self.baud, time.monotonic())
+
+    def close(self):
+        """Stops watching the port and closes it."""
+        if AsyncSerialBus._buses.get(self.port) is self:
+            del AsyncSerialBus._buses[self.port]
+        if self.srl_port is not None and self.srl_port.isOpen():
+            self._loop.remove_reader(self.srl_port.fileno())
+            self.srl_port.close()
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_exception(serial.serialutil.SerialException("port closed"))
+
+    def _on_readable(self):
+        """Called by the loop when bytes are waiting. Completes the pending command."""
+        try:
+            self._rx+=self.srl_port.read(max(1,self.srl_port.inWaiting()))
+        except serial.serialutil.SerialException as se:
+            #most likely unplugged, so the port would stay readable forever
+            self._loop.remove_reader(self.srl_port.fileno())
+            if self._waiter is not None and not self._waiter.done():
+                self._waiter.set_exception(se)
+            return
+
+        if self._waiter is None or self._waiter.done():
+            #nobody is waiting, so these are stale bytes
+            self._rx=b""
+            return
+
+        frame,self._rx=syringe_motor.find_frame(self._rx)
+        if frame is not None:
+            self._frame=syringe_motor.FRAME_START+frame+syringe_motor.FRAME_END
+            self._waiter.set_result(syringe_motor.Response.from_frame(frame))
+
+    async def sendRawCommand(self, message, delay=None):
+        """Sends a command and returns the payload of its reply as a str, or None."""
+        response=await self.sendCommand(message, delay)
+        if response is None:
+            return None
+        return response.data
+
+    async def sendCommand(self, message, delay=None):
+        """Sends a command and returns the first reply frame as a Response.
+
+        Args:
+            message (str): the full command, e.g. '/1?0'. '\\r' is appended.
+            delay (float): minimum time between commands on this bus.
+                Defaults to two byte times at the current baud rate.
+
+        Returns:
+            the decoded syringe_motor.Response, or None if no complete frame
+            arrived within self.timeout of the command going out.
+
+        Raises:
+            SerialException: if the port is not open.
+
+        """
+        if self.srl_port is None or not self.srl_port.isOpen():
+            raise serial.serialutil.SerialException("port not open")
+        if delay==None:
+            delay=2*(float(self.srl_port.bytesize)/self.srl_port.baudrate)
+
+        async with self._lock:
+            await asyncio.sleep(max(0,self._nextsleep-self._loop.time()))
+
+            self._rx=b""
+            self._waiter=self._loop.create_future()
+            data=bytes((message+"\r").encode("utf-8"))
+            #a command is a few bytes, so this never blocks on the kernel buffer
+            self.last_write=sent=time.monotonic()
+            self.srl_port.write(data)
+            recorder=self.recorder
+            if recorder is not None:
+                recorder.tx(self.port, message, sent)
+            try:
+                #long programs take a while to go out at low baud rates
+                response=await asyncio.wait_for(self._waiter, self.reply_timeout(len(data))+self.timeout)
+            except asyncio.TimeoutError:
+                if recorder is not None:
+                    now=time.monotonic()
+                    recorder.lost(self.port, message, now, now-sent)
+                self._observe(message, None)
+                return None
+            else:
+                if recorder is not None:
+                    now=time.monotonic()
+                    recorder.rx(self.port, message, self._frame, now, now-sent)
+                self._observe(message, response)
+                return response
+            finally:
+                self._waiter=None
+                self._nextsleep=self._loop.time()+delay
+
+
+class AsyncMotor:
+    """An addressed motor on an AsyncSerialBus.
+
+    Calibration values are shared with the syringe_motor.Motor it wraps, so
+    the same MotorGroup can be saved and loaded as usual.
+    """
+
+    def __init__(self, motor=None, bus=None):
+        if motor is None:
+            motor=syringe_motor.Motor()
+        self.motor=motor
+        self.bus=bus
+        self._move_lock=None
+
+    @property
+    def motor_address(self):
+        return self.motor.motor_address
+
+    @property
+    def move_lock(self):
+        """Held while a move is worked out and sent, so two moves don't interleave.
+
+        Made on first use, inside the event loop, like AsyncSerialBus._lock.
+        """
+        if self._move_lock is None:
+            self._move_lock=asyncio.Lock()
+        return self._move_lock
+
+    async def connect(self, port, baud=9600):
+        """Attaches to the bus for port and probes the motor with 'Q'.
+
+        Returns:
+            True if the motor answered.
+
+        """
+        self.bus=await AsyncSerialBus.get(port, baud)
+        self.bus.motors[self.motor.motor_address]=self.motor
+        return await self.send("Q") is not None
+
+    async def send(self, command):
+        """Sends a command to this motor, e.g. send('V2000R').
+
+        Returns:
+            the reply payload as a str, or None if the motor didn't answer.
+
+        """
+        response=await self.sendCommand(command)
+        if response is None:
+            return None
+        return response.data
+
+    async def sendCommand(self, command):
+        """Like send, but returns the whole syringe_motor.Response."""
+        response=await self.bus.sendCommand("/"+self.motor.motor_address+command)
+        if response is not None:
+            self.motor.last_response=response
+        return response
+
+    async def accepted(self, command):
+        """Sends a command that must be accepted. See syringe_motor.Motor._accepted.
+
+        Raises:
+            IndexError: if the motor did not answer.
+            ValueError: if the motor rejected it.
+
+        """
+        response=await self.sendCommand(command)
+        if response is None:
+            raise IndexError("motor did not answer "+command)
+        if response.error:
+            raise ValueError("motor rejected "+command+": "+response.error_text)
+        return response
+
+    async def query_position(self):
+        """Gets the current position of the motor.
+
+        Raises:
+            IndexError: if the motor did not report a position.
+
+        """
+        response=await self.sendCommand("?0")
+        n=None if response is None else response.integer()
+        if n is None:
+            raise IndexError("motor did not report a position")
+        self.motor.motor_position=n
+        return n
+
+    async def wait_until_idle(self, timeout=None, velocity=None, target=None):
+        """Polls until the motor is ready. See syringe_motor.Motor.wait_until_idle.
+
+        Returns:
+            True once the motor reports ready, False on timeout.
+
+        """
+        loop=asyncio.get_running_loop()
+        deadline=None if timeout is None else loop.time()+timeout
+        interval=syringe_motor.POLL_MIN
+        while True:
+            response=await self.sendCommand("?0" if target is not None else "Q")
+            if response is not None:
+                if response.ready:
+                    return True
+                position=response.integer() if target is not None else None
+                interval=syringe_motor.next_poll_interval(interval, velocity, target, position)
+            else:
+                interval=syringe_motor.next_poll_interval(interval)
+
+            if deadline is not None:
+                if loop.time()>=deadline:
+                    return False
+                interval=min(interval, max(0, deadline-loop.time()))
+            await asyncio.sleep(interval)
+
+    async def set_velocity(self, velocity):
+        return await self.send("V"+str(int(velocity))+"R")
+
+    async def move_to(self, position, velocity=None):
+        """Moves to an absolute position, optionally setting the velocity first."""
+        if velocity is not None:
+            await self.set_velocity(velocity)
+        return await self.send("A"+str(int(position))+"R")
+
+    async def stop(self):
+        """Stops the motor. Not held up by move_lock, so it can stop a move being sent.
+
+        Raises:
+            IndexError: if the motor did not answer.
+            ValueError: if the motor rejected it.
+
+        """
+        await self.accepted("TR")
+
+    async def inject(self, vol, seconds):
+        """Moves vol mL over seconds once the motor is idle. See syringe_motor.Motor.inject.
+
+        Holds move_lock from waiting for the motor until the move is sent.
+
+        Returns:
+            (target, warnings): the position the motor was sent to, which
+            it is still moving to, and a list of warning strings.
+
+        Raises:
+            ValueError: if the move would be too fast, the motor is still
+                busy after syringe_motor.Motor.idle_timeout(), or it
+                rejected the move.
+            IndexError: if the motor did not answer.
+
+        """
+        motor=self.motor
+        steps=vol/motor.mL_per_rad*motor.motor_position_per_rad
+        vel=abs(steps)/seconds
+        if vel>syringe_motor.MAX_VELOCITY:
+            raise ValueError("motor is not accurate at high speeds.")
+
+        warnings=[]
+        async with self.move_lock:
+            timeout=motor.idle_timeout()
+            if not await self.wait_until_idle(timeout):
+                raise ValueError("motor is still busy after %.1f s. Stop it before moving it."%timeout)
+            await self.accepted("V"+str(int(vel))+"R")
+            target=await self.query_position()+steps
+            if target<0:
+                warnings.append("warn: could not go past 0 position.")
+                target=0
+            if target>motor.max_pos:
+                warnings.append("Warn: could not go past max position. Will not inject correct volume!")
+                target=motor.max_pos
+            target=int(target)
+            await self.accepted("A"+str(target)+"R")
+        return target, warnings
+
+
+class AsyncMotorGroup:
+    """asyncio view of a syringe_motor.MotorGroup."""
+
+    def __init__(self, motorGroup=None):
+        if motorGroup is None:
+            motorGroup=syringe_motor.MotorGroup()
+        self.motorGroup=motorGroup
+        self.motordict={}
+
+    async def connect(self, port, baud=9600):
+        """Puts every motor in the group on the bus for port, without probing."""
+        bus=await AsyncSerialBus.get(port, baud)
+        profile=self.motorGroup.bus_profiles.get((port, baud))
+        if profile is not None:
+            bus.turnaround_max=profile.get('turnaround_max')
+        for name, motor in self.motorGroup.motordict.items():
+            self.motordict[name]=AsyncMotor(motor, bus)
+            bus.motors[motor.motor_address]=motor
+        return bus
+
+    def motors(self):
+        return list(self.motordict.values())
+
+    async def query_positions(self):
+        """Gets every motor's position concurrently.
+
+        Returns:
+            dict of motor name to position, or to the exception raised.
+
+        """
+        names=list(self.motordict.keys())
+        results=await asyncio.gather(*(self.motordict[n].query_position() for n in names), return_exceptions=True)
+        return dict(zip(names, results))
+
+    async def stop_all(self):
+        await asyncio.gather(*(m.stop() for m in self.motordict.values()))
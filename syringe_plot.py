@@ -0,0 +1,254 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Live plot of a run, for the Plot tab.
+
+Samples are kept in fixed-size NumPy chunks. Each full chunk is
+downsampled once with Largest-Triangle-Three-Buckets into the next
+coarser level, and so on, so drawing a span only touches the coarsest
+level that still has enough points for the width of the widget. A ten
+day run costs about as much to redraw as a ten second one.
+
+Example:
+    plot.add_trace("Flow", "mL/min")
+    plot.append(time.monotonic(), [flow])
+"""
+import bisect
+import numpy as np
+
+try:
+    from PyQt5 import QtCore, QtGui
+    from PyQt5.QtWidgets import QWidget
+except ImportError:
+    from PyQt4 import QtCore, QtGui
+    from PyQt4.QtGui import QWidget
+
+#samples per chunk, and how many times fewer each coarser level keeps
+CHUNK=1024
+FACTOR=8
+
+def lttb(x, y, n):
+    """Picks n points that keep the shape of a line, by Largest-Triangle-Three-Buckets.
+
+    The first and last points are kept. The rest are split into n-2
+    buckets, and from each the point making the largest triangle with the
+    point picked before it and the mean of the next bucket is kept.
+
+    Returns:
+        indices into x and y, in order.
+
+    """
+    size=len(x)
+    if n>=size:
+        return np.arange(size)
+    if n<3:
+        return np.array([0, size-1][:max(n, 0)], dtype=int)
+    edges=np.linspace(1, size-1, n-1).astype(int)
+    picked=np.empty(n, dtype=int)
+    picked[0]=0
+    picked[-1]=size-1
+    a=0
+    for i in range(n-2):
+        lo, hi=edges[i], edges[i+1]
+        if i+2<len(edges):
+            next_x=x[hi:edges[i+2]].mean()
+            next_y=y[hi:edges[i+2]].mean()
+        else:
+            next_x, next_y=x[-1], y[-1]
+        area=np.abs((x[a]-next_x)*(y[lo:hi]-y[a])-(x[a]-x[lo:hi])*(next_y-y[a]))
+        a=lo+int(np.argmax(area))
+        picked[i+1]=a
+    return picked
+
+class _Level:
+    """Chunks of (time, value) rows at one resolution."""
+
+    def __init__(self, chunk):
+        self.full=[]
+        #first time of each full chunk
+        self.starts=[]
+        self.buffer=np.empty((chunk, 2))
+        self.count=0
+
+    def partial(self):
+        return self.buffer[:self.count]
+
+class ChunkedSeries:
+    """Append-only (time, value) samples, with coarser copies for drawing long spans."""
+
+    def __init__(self, chunk=CHUNK, factor=FACTOR):
+        self.chunk=chunk
+        self.factor=factor
+        self.levels=[_Level(chunk)]
+
+    def __len__(self):
+        level=self.levels[0]
+        return len(level.full)*self.chunk+level.count
+
+    def clear(self):
+        self.levels=[_Level(self.chunk)]
+
+    def append(self, t, value):
+        self._push(0, np.array([[t, value]], dtype=float))
+
+    def _push(self, k, rows):
+        level=self.levels[k]
+        while len(rows):
+            n=min(len(rows), self.chunk-level.count)
+            level.buffer[level.count:level.count+n]=rows[:n]
+            level.count+=n
+            rows=rows[n:]
+            if level.count==self.chunk:
+                full=level.buffer
+                level.full.append(full)
+                level.starts.append(full[0, 0])
+                level.buffer=np.empty((self.chunk, 2))
+                level.count=0
+                if k+1==len(self.levels):
+                    self.levels.append(_Level(self.chunk))
+                self._push(k+1, full[lttb(full[:, 0], full[:, 1], self.chunk//self.factor)])
+
+    def _span(self, level, t0, t1):
+        """Indices of the full chunks of a level that may hold times in [t0, t1]."""
+        first=max(0, bisect.bisect_right(level.starts, t0)-1)
+        return first, bisect.bisect_right(level.starts, t1)
+
+    def window(self, t0, t1, n):
+        """Up to n points between t0 and t1, for drawing.
+
+        Reads the coarsest level with at least 2n points in the span, so
+        the work doesn't grow with the length of the run.
+
+        Returns:
+            (times, values) arrays.
+
+        """
+        k=0
+        for j in range(len(self.levels)-1, 0, -1):
+            first, last=self._span(self.levels[j], t0, t1)
+            if (last-first)*self.chunk>=2*n:
+                k=j
+                break
+        level=self.levels[k]
+        first, last=self._span(level, t0, t1)
+        #samples not yet copied to a coarser level are the newest, finest last
+        parts=level.full[first:last]+[level.partial()]+[self.levels[j].partial() for j in range(k-1, -1, -1)]
+        rows=np.concatenate(parts) if parts else np.empty((0, 2))
+        rows=rows[(rows[:, 0]>=t0)&(rows[:, 0]<=t1)]
+        if len(rows)>n:
+            rows=rows[lttb(rows[:, 0], rows[:, 1], n)]
+        return rows[:, 0], rows[:, 1]
+
+    def first_time(self):
+        level=self.levels[0]
+        if level.full:
+            return level.full[0][0, 0]
+        return level.buffer[0, 0] if level.count else None
+
+    def last_time(self):
+        level=self.levels[0]
+        if level.count:
+            return level.buffer[level.count-1, 0]
+        return level.full[-1][-1, 0] if level.full else None
+
+
+def format_elapsed(seconds):
+    """Like '1d 02:03:04' or '02:03'."""
+    seconds=int(max(0, seconds))
+    days, seconds=divmod(seconds, 86400)
+    hours, seconds=divmod(seconds, 3600)
+    minutes, seconds=divmod(seconds, 60)
+    text="%02d:%02d"%(minutes, seconds)
+    if hours or days:
+        text="%02d:"%hours+text
+    if days:
+        text="%dd "%days+text
+    return text
+
+COLORS=[QtGui.QColor(31, 119, 180), QtGui.QColor(214, 39, 40), QtGui.QColor(44, 160, 44), QtGui.QColor(148, 103, 189)]
+
+class PlotWidget(QWidget):
+    """Stacked line plots of traces sharing one time axis.
+
+    Times are time.monotonic(), and are shown as time since the first
+    sample.
+    """
+
+    def __init__(self, parent=None):
+        super(PlotWidget, self).__init__(parent)
+        #(name, unit, ChunkedSeries, QColor)
+        self.traces=[]
+        #seconds shown up to the last sample, None for the whole run
+        self.span=None
+        self.setMinimumSize(200, 120)
+
+    def add_trace(self, name, unit, color=None):
+        if color is None:
+            color=COLORS[len(self.traces)%len(COLORS)]
+        self.traces.append((name, unit, ChunkedSeries(), color))
+        self.update()
+
+    def append(self, t, values):
+        """Adds one sample of every trace, in the order they were added."""
+        for trace, value in zip(self.traces, values):
+            trace[2].append(t, value)
+        if self.isVisible():
+            self.update()
+
+    def clear(self):
+        for trace in self.traces:
+            trace[2].clear()
+        self.update()
+
+    def set_span(self, seconds):
+        self.span=seconds
+        self.update()
+
+    def paintEvent(self, event):
+        painter=QtGui.QPainter(self)
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        painter.fillRect(self.rect(), self.palette().base())
+        metrics=painter.fontMetrics()
+        text_h=metrics.height()
+        if not self.traces:
+            return
+
+        starts=[t[2].first_time() for t in self.traces if t[2].first_time() is not None]
+        ends=[t[2].last_time() for t in self.traces if t[2].last_time() is not None]
+        if not starts:
+            painter.drawText(self.rect(), QtCore.Qt.AlignCenter, "No data yet")
+            return
+        origin=min(starts)
+        t1=max(ends)
+        t0=origin if self.span is None else max(origin, t1-self.span)
+        if t1<=t0:
+            t1=t0+1
+
+        margin=metrics.boundingRect("-0000.000").width()+8
+        panel_h=(self.height()-text_h-4)/float(len(self.traces))
+        width=max(2, self.width()-margin-4)
+        for i, (name, unit, series, color) in enumerate(self.traces):
+            top=i*panel_h
+            area=QtCore.QRectF(margin, top+text_h, width, max(1, panel_h-text_h-4))
+            painter.setPen(self.palette().text().color())
+            painter.drawRect(area)
+            painter.drawText(QtCore.QPointF(margin, top+text_h-3), name+" ("+unit+")")
+
+            times, values=series.window(t0, t1, int(width))
+            if len(values)==0:
+                continue
+            low, high=float(values.min()), float(values.max())
+            if high<=low:
+                low, high=low-1, high+1
+            painter.drawText(QtCore.QPointF(2, area.top()+text_h), "%.3f"%high)
+            painter.drawText(QtCore.QPointF(2, area.bottom()), "%.3f"%low)
+
+            xs=area.left()+(times-t0)/(t1-t0)*area.width()
+            ys=area.bottom()-(values-low)/(high-low)*area.height()
+            line=QtGui.QPolygonF([QtCore.QPointF(x, y) for x, y in zip(xs, ys)])
+            painter.setPen(QtGui.QPen(color, 1.5))
+            painter.drawPolyline(line)
+
+        painter.setPen(self.palette().text().color())
+        bottom=self.height()-4
+        painter.drawText(QtCore.QPointF(margin, bottom), format_elapsed(t0-origin))
+        right=format_elapsed(t1-origin)
+        painter.drawText(QtCore.QPointF(self.width()-4-metrics.boundingRect(right).width(), bottom), right)
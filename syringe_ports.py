@@ -0,0 +1,236 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Finds Silverpak USB serial adapters through sysfs, and watches for replugs.
+
+Only adapters whose USB vendor:product id is in KNOWN_ADAPTERS are
+listed, instead of every tty node in /dev. PortWatcher reports adapters
+as they are plugged in and out, using inotify on /dev where available and
+polling sysfs otherwise, as on Windows, where select() only takes
+sockets.
+
+Note:
+    A Silverpak adapter is only given a ttyUSB node once ftdi_sio knows its
+    id. See detect-motor.sh.
+"""
+import os
+import fnmatch
+import select
+import threading
+import collections
+
+#(vid, pid) -> description, as lower case hex strings like sysfs uses
+KNOWN_ADAPTERS={
+    ('0403', 'e0b0'):"Silverpak/EZStepper FTDI adapter",
+    ('0403', '6001'):"FTDI FT232R USB-RS485",
+    ('0403', '6015'):"FTDI FT-X USB-RS485",
+}
+
+#tty names USB serial adapters get
+TTY_PATTERNS=['ttyUSB*', 'ttyACM*']
+
+Adapter=collections.namedtuple('Adapter', ['device', 'vid', 'pid', 'serial', 'description'])
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except EnvironmentError:
+        return None
+
+def _usb_device(path):
+    """Walks up from a tty's sysfs device to the USB device that has the ids."""
+    path=os.path.realpath(path)
+    while path and path!=os.path.dirname(path):
+        if os.path.exists(os.path.join(path, 'idVendor')):
+            return path
+        path=os.path.dirname(path)
+    return None
+
+def adapter_info(name, sysfs='/sys', dev='/dev'):
+    """Looks up the USB ids of one tty, e.g. 'ttyUSB0'.
+
+    Returns:
+        an Adapter, or None if the tty isn't a USB device.
+
+    """
+    usb=None
+    for link in (os.path.join(sysfs, 'bus', 'usb-serial', 'devices', name),
+                 os.path.join(sysfs, 'class', 'tty', name, 'device')):
+        if os.path.exists(link):
+            usb=_usb_device(link)
+            if usb is not None:
+                break
+    if usb is None:
+        return None
+    vid=(_read(os.path.join(usb, 'idVendor')) or '').lower()
+    pid=(_read(os.path.join(usb, 'idProduct')) or '').lower()
+    description=KNOWN_ADAPTERS.get((vid, pid)) or _read(os.path.join(usb, 'product'))
+    return Adapter(os.path.join(dev, name), vid, pid, _read(os.path.join(usb, 'serial')), description)
+
+def _tty_names(sysfs='/sys'):
+    names=set()
+    for d in (os.path.join(sysfs, 'bus', 'usb-serial', 'devices'), os.path.join(sysfs, 'class', 'tty')):
+        try:
+            for n in os.listdir(d):
+                if any(fnmatch.fnmatch(n, p) for p in TTY_PATTERNS):
+                    names.add(n)
+        except EnvironmentError:
+            continue
+    return sorted(names)
+
+def has_sysfs(sysfs='/sys'):
+    return os.path.isdir(os.path.join(sysfs, 'class', 'tty'))
+
+def enumerate_adapters(known=None, sysfs='/sys', dev='/dev'):
+    """Lists the USB serial adapters with known ids.
+
+    Args:
+        known: dict like KNOWN_ADAPTERS. None uses KNOWN_ADAPTERS, and an
+            empty dict lists every USB serial adapter.
+
+    Returns:
+        a list of Adapter, sorted by device.
+
+    """
+    if known is None:
+        known=KNOWN_ADAPTERS
+    adapters=[]
+    for name in _tty_names(sysfs):
+        a=adapter_info(name, sysfs, dev)
+        if a is not None and (not known or (a.vid, a.pid) in known):
+            adapters.append(a)
+    return adapters
+
+
+#from <sys/inotify.h>
+IN_CREATE=0x100
+IN_DELETE=0x200
+IN_MOVED_FROM=0x40
+IN_MOVED_TO=0x80
+IN_NONBLOCK=os.O_NONBLOCK
+IN_CLOEXEC=getattr(os, 'O_CLOEXEC', 0o2000000)
+_EVENT_HEADER=16
+
+def _inotify():
+    """Returns libc if it has inotify, else None."""
+    #ctypes.util pulls in subprocess, so only load it when watching
+    import ctypes
+    import ctypes.util
+    name=ctypes.util.find_library('c')
+    if name is None:
+        return None
+    try:
+        libc=ctypes.CDLL(name, use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+class PortWatcher(threading.Thread):
+    """Calls back when known adapters are plugged in or out.
+
+    callback(action, adapter) runs on the watcher thread, with action
+    'add' or 'remove'. For 'remove', the adapter is the one last seen on
+    that device.
+
+    Example:
+        watcher=PortWatcher(lambda action, a: print(action, a.device))
+        watcher.start()
+        ...
+        watcher.stop()
+
+    """
+
+    def __init__(self, callback, known=None, sysfs='/sys', dev='/dev', poll_interval=1.0):
+        """
+        Args:
+            poll_interval (float): seconds between rescans when inotify is
+                not available.
+
+        """
+        super(PortWatcher, self).__init__()
+        self.daemon=True
+        self.callback=callback
+        self.known=known
+        self.sysfs=sysfs
+        self.dev=dev
+        self.poll_interval=poll_interval
+        self.adapters=dict((a.device, a) for a in enumerate_adapters(known, sysfs, dev))
+        self._stopping=threading.Event()
+        #wakes select() in _watch. run() closes it, under _pipe_lock.
+        self._pipe_lock=threading.Lock()
+        if os.name=='nt':
+            self._stop_r=self._stop_w=None
+        else:
+            self._stop_r, self._stop_w=os.pipe()
+
+    def stop(self):
+        """Ends the watcher thread. Safe to call more than once."""
+        self._stopping.set()
+        with self._pipe_lock:
+            if self._stop_w is not None:
+                os.write(self._stop_w, b'x')
+
+    def rescan(self):
+        """Compares the adapters present now with the last scan and reports changes."""
+        now=dict((a.device, a) for a in enumerate_adapters(self.known, self.sysfs, self.dev))
+        for device in sorted(set(self.adapters)-set(now)):
+            self.callback('remove', self.adapters[device])
+        for device in sorted(set(now)-set(self.adapters)):
+            self.callback('add', now[device])
+        self.adapters=now
+
+    def run(self):
+        libc=_inotify() if self._stop_r is not None else None
+        fd=-1
+        if libc is not None:
+            fd=libc.inotify_init1(IN_NONBLOCK|IN_CLOEXEC)
+            if fd>=0 and libc.inotify_add_watch(fd, self.dev.encode(), IN_CREATE|IN_DELETE|IN_MOVED_FROM|IN_MOVED_TO)<0:
+                os.close(fd)
+                fd=-1
+        try:
+            #anything plugged in since __init__ scanned, before the watch began
+            self.rescan()
+            if fd<0:
+                self._poll()
+            else:
+                self._watch(fd)
+        finally:
+            if fd>=0:
+                os.close(fd)
+            with self._pipe_lock:
+                if self._stop_r is not None:
+                    os.close(self._stop_r)
+                    os.close(self._stop_w)
+                    self._stop_r=self._stop_w=None
+
+    def _poll(self):
+        while not self._stopping.wait(self.poll_interval):
+            self.rescan()
+
+    def _watch(self, fd):
+        while not self._stopping.is_set():
+            ready, _, _=select.select([fd, self._stop_r], [], [])
+            if self._stop_r in ready:
+                return
+            try:
+                data=os.read(fd, 4096)
+            except BlockingIOError:
+                continue
+            if self._tty_event(data):
+                #udev may still be filling in sysfs when the node appears
+                self._stop_event_wait(0.1)
+                self.rescan()
+
+    def _stop_event_wait(self, seconds):
+        self._stopping.wait(seconds)
+
+    def _tty_event(self, data):
+        """Whether a batch of inotify events touches a tty adapters use."""
+        i=0
+        while i+_EVENT_HEADER<=len(data):
+            length=int.from_bytes(data[i+12:i+16], 'little')
+            name=data[i+_EVENT_HEADER:i+_EVENT_HEADER+length].rstrip(b'\0').decode('utf-8', 'replace')
+            i+=_EVENT_HEADER+length
+            if any(fnmatch.fnmatch(name, p) for p in TTY_PATTERNS):
+                return True
+        return False
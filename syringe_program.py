@@ -0,0 +1,407 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Builds DT command strings for pumping cycles.
+
+A cycle draws, waits, injects and waits again, repeated n times. Waits
+longer than one 'M' allows are built from nested g...G loops, picking the
+shortest encoding, so multi-day protocols still fit in one command.
+
+Flow profiles (ramps, sinusoids, steps in mL/min) are fitted with the
+fewest constant-velocity moves that stay within a volume tolerance, so
+the controller runs them without the host streaming commands.
+"""
+import math
+import functools
+import numpy as np
+from syringe_model import trapezoid
+#the limits the rest of the package checks against
+from syringe_motor import MAX_COMMAND_LENGTH, MAX_VELOCITY
+
+#longest single wait, in ms
+MAX_WAIT=30000
+#largest G repeat count
+MAX_REPEATS=30000
+#controllers nest at most this many g...G loops
+MAX_LOOP_DEPTH=4
+MAX_POSITION=2**31-1
+
+#repeat counts tried for each nested loop, see _loop_counts: this many
+#from the fewest that fit, and this many that divide the wait exactly,
+#searched this far above the fewest
+NESTED_COUNTS=2
+NESTED_DIVISORS=3
+DIVISOR_SPAN=4096
+
+@functools.lru_cache(maxsize=4096)
+def encode_wait(ms, depth=MAX_LOOP_DEPTH):
+    """Shortest command found that waits ms milliseconds.
+
+    One loop level is solved exactly: a wait of 'gM<chunk>G<n>M<rest>'
+    with every n from the fewest repeats up is scored at once with NumPy.
+    Deeper waits try a few counts at each level, so the search is bounded
+    however long the wait is.
+
+    Args:
+        ms (int): time to wait.
+        depth (int): loop levels available for nesting.
+
+    Returns:
+        the command string, '' for no wait.
+
+    Raises:
+        ValueError: if ms can't be reached with depth loop levels.
+
+    """
+    ms=int(ms)
+    if ms<0:
+        raise ValueError("negative wait")
+    if ms==0:
+        return ''
+    if ms<=MAX_WAIT:
+        return 'M'+str(ms)
+    if depth<=0:
+        raise ValueError("wait of "+str(ms)+" ms needs too many nested loops")
+
+    flat=-(-ms//MAX_WAIT)
+    if flat<=MAX_REPEATS:
+        return _flat_wait(ms, flat)
+    best=None
+    for n in _loop_counts(ms, depth):
+        chunk, rest=divmod(ms, n)
+        try:
+            #rest<n<=MAX_REPEATS, so it fits one M
+            s='g'+encode_wait(chunk, depth-1)+'G'+str(n)+encode_wait(rest, 0)
+        except ValueError:
+            continue
+        if best is None or len(s)<len(best):
+            best=s
+    if best is None:
+        raise ValueError("wait of "+str(ms)+" ms needs too many nested loops")
+    return best
+
+_COUNTS=np.arange(MAX_REPEATS+1, dtype=np.int64)
+
+def _digits(a):
+    """Decimal digits of each int in a, all at most MAX_WAIT."""
+    return 1+(a>=10)+(a>=100)+(a>=1000)+(a>=10000)
+
+_COUNT_DIGITS=_digits(_COUNTS)
+
+def _flat_wait(ms, flat):
+    """Shortest single loop 'gM<ms//n>G<n>M<ms%n>' over every n from flat on."""
+    n=_COUNTS[flat:]
+    chunk, rest=np.divmod(np.int64(ms), n)
+    length=_digits(chunk)+_COUNT_DIGITS[flat:]+np.where(rest>0, _digits(rest)+1, 0)
+    n=int(n[np.argmin(length)])
+    chunk, rest=divmod(ms, n)
+    return 'gM'+str(chunk)+'G'+str(n)+encode_wait(rest, 0)
+
+def _loop_counts(ms, depth):
+    """Repeat counts worth trying for an outer loop of a ms wait that needs nesting.
+
+    For the fewest loop levels that can reach ms, and for all depth
+    levels, the fewest repeats that fit leave the most room inside, and
+    counts that divide ms exactly need no remainder wait. A few of each
+    are tried.
+    """
+    counts=[]
+    levels=[depth]
+    for k in range(2, depth):
+        if -(-ms//(MAX_WAIT*MAX_REPEATS**(k-1)))<=MAX_REPEATS:
+            levels.insert(0, k)
+            break
+    for k in levels:
+        #the fewest repeats that get the inner wait within what k-1 loops can do
+        low=max(2, -(-ms//(MAX_WAIT*MAX_REPEATS**(k-1))))
+        if low>MAX_REPEATS:
+            continue
+        high=min(low+DIVISOR_SPAN, MAX_REPEATS)
+        found=list(range(low, min(low+NESTED_COUNTS, high+1)))
+        divisors=0
+        for n in range(low, high+1):
+            if divisors>=NESTED_DIVISORS:
+                break
+            if ms%n==0:
+                divisors+=1
+                found.append(n)
+        counts.extend(n for n in found if n not in counts)
+    return counts
+
+@functools.lru_cache(maxsize=256)
+def compile_cycle(address, draw_pos, inject_pos, pull_vel, push_vel, top_wait, bottom_wait, repeats):
+    """Builds the command for a pumping cycle.
+
+    All arguments are ints, so compiled programs are cached by parameters.
+
+    Args:
+        address (str): motor address symbol.
+        draw_pos, inject_pos: positions at the top and bottom of a stroke.
+        pull_vel, push_vel: velocities of the draw and inject strokes.
+        top_wait, bottom_wait: waits after each stroke, in ms.
+        repeats: number of cycles. 0 repeats forever.
+
+    Raises:
+        ValueError: if a value is out of range or the program is too long.
+
+    """
+    for v in (pull_vel, push_vel):
+        if not 0<v<=MAX_VELOCITY:
+            raise ValueError("velocity "+str(v)+" out of range. The motor is not accurate at high speeds.")
+    for p in (draw_pos, inject_pos):
+        if not 0<=p<=MAX_POSITION:
+            raise ValueError("position "+str(p)+" out of range.")
+    if not 0<=repeats<=MAX_REPEATS:
+        raise ValueError("number of pumps must be between 0 and "+str(MAX_REPEATS)+".")
+
+    #the repeat loop takes one level of nesting
+    exe=("/"+address+"gV"+str(pull_vel)+"A"+str(draw_pos)+encode_wait(top_wait, MAX_LOOP_DEPTH-1)
+         +"V"+str(push_vel)+"A"+str(inject_pos)+encode_wait(bottom_wait, MAX_LOOP_DEPTH-1)
+         +"G"+str(repeats)+"R")
+    if len(exe)>MAX_COMMAND_LENGTH:
+        raise ValueError("program is "+str(len(exe))+" characters, more than the controller's "+str(MAX_COMMAND_LENGTH)+".")
+    return exe
+
+def cycle_program(motor, vol, pull_time, top_wait_time, push_time, bottom_wait_time, no_pumps):
+    """Builds the pumping cycle command for a motor from user units.
+
+    Args:
+        motor (syringe_motor.Motor): gives address, position and calibration.
+        vol (float): mL drawn and injected per cycle.
+        pull_time, push_time (float): seconds per stroke.
+        top_wait_time, bottom_wait_time (float): waits in ms.
+        no_pumps (float): number of cycles.
+
+    Returns:
+        (exe, warnings): the command and a list of warning strings.
+
+    Raises:
+        ValueError: for values the motor can't do.
+
+    """
+    if vol<0 or no_pumps<0 or pull_time<0 or top_wait_time<0 or push_time<0 or bottom_wait_time<0:
+        raise ValueError("negative values not allowed.")
+    if pull_time==0 or push_time==0:
+        raise ValueError("pull and push times must be more than 0.")
+
+    warnings=[]
+    steps=(vol/motor.mL_per_rad)*motor.motor_position_per_rad
+    pos1=motor.motor_position
+    pos2=pos1-steps
+    if pos2<0:
+        warnings.append("warn: could not go past 0 position. Volume will not be as specified!")
+        pos2=0
+
+    pull_vel=abs(steps/pull_time)
+    push_vel=abs(steps/push_time)
+
+    exe=compile_cycle(motor.motor_address, int(pos2), int(pos1), int(pull_vel), int(push_vel),
+                      int(round(top_wait_time)), int(round(bottom_wait_time)), int(no_pumps))
+    return exe, warnings
+
+def sample_profile(profile, duration, dt=None):
+    """Samples a flow profile on an even time grid.
+
+    Args:
+        profile: flow in mL/min, either a function of time in seconds
+            (numpy-aware or not), or an array of flows evenly spaced from 0
+            to duration, with straight lines between them.
+        duration (float): seconds the profile runs.
+        dt (float): seconds between samples. Defaults to duration/1000.
+
+    Returns:
+        (t, flow): numpy arrays of times and mL/min.
+
+    """
+    if duration<=0:
+        raise ValueError("profile duration must be more than 0.")
+    if dt is None:
+        dt=duration/1000.0
+    n=max(2, int(np.ceil(duration/dt))+1)
+    t=np.linspace(0.0, duration, n)
+    if callable(profile):
+        try:
+            flow=np.asarray(profile(t), dtype=float)
+        except (TypeError, ValueError):
+            flow=None
+        if flow is None or flow.shape!=t.shape:
+            flow=np.array([profile(x) for x in t], dtype=float)
+    else:
+        samples=np.asarray(profile, dtype=float)
+        if samples.ndim!=1 or len(samples)<2:
+            raise ValueError("a sampled profile needs at least 2 flows.")
+        #straight lines between samples, so the fit is checked between them too
+        flow=np.interp(t, np.linspace(0.0, duration, len(samples)), samples)
+    if not np.all(np.isfinite(flow)):
+        raise ValueError("profile has non-finite flows.")
+    return t, flow
+
+def fit_segments(t, steps, tolerance, max_velocity=MAX_VELOCITY):
+    """Fewest constant-velocity moves that follow a cumulative step curve.
+
+    Each move starts where the last one ended and is extended as long as
+    some velocity keeps it within tolerance of every sample it spans
+    (the slopes allowed by each sample are intersected as it goes).
+
+    Args:
+        t: sample times, seconds.
+        steps: steps moved by each sample time, starting at 0.
+        tolerance (float): largest allowed error, in steps.
+        max_velocity (float): fastest allowed move, steps/s.
+
+    Returns:
+        (knot_times, knot_steps): numpy arrays of where each move ends,
+        starting with (t[0], steps[0]).
+
+    Raises:
+        ValueError: if the profile needs more than max_velocity.
+
+    """
+    knot_t=[t[0]]
+    knot_s=[float(steps[0])]
+    anchor=0
+    lo, hi=-max_velocity, max_velocity
+    k=1
+    while k<len(t):
+        h=t[k]-knot_t[-1]
+        new_lo=max(lo, (steps[k]-tolerance-knot_s[-1])/h)
+        new_hi=min(hi, (steps[k]+tolerance-knot_s[-1])/h)
+        if new_lo<=new_hi:
+            lo, hi=new_lo, new_hi
+            k+=1
+            continue
+        if k-1==anchor:
+            raise ValueError("flow at %.3g s needs more than the motor's %d steps/s."%(t[k], max_velocity))
+        #end this move at the last sample it covered, as close to the curve as allowed
+        h=t[k-1]-knot_t[-1]
+        slope=min(hi, max(lo, (steps[k-1]-knot_s[-1])/h))
+        knot_s.append(knot_s[-1]+slope*h)
+        knot_t.append(t[k-1])
+        anchor=k-1
+        lo, hi=-max_velocity, max_velocity
+    h=t[-1]-knot_t[-1]
+    if h>0:
+        slope=min(hi, max(lo, (steps[-1]-knot_s[-1])/h))
+        knot_s.append(knot_s[-1]+slope*h)
+        knot_t.append(t[-1])
+    return np.array(knot_t), np.array(knot_s)
+
+def ramp_velocity(distance, seconds, accel):
+    """Top speed at which a move of distance steps takes seconds, ramps included.
+
+    The controller speeds up from rest and slows to a stop at accel
+    steps/s^2, so a move takes distance/v+v/accel seconds.
+
+    Returns:
+        steps/s, or None if even a move that never stops speeding up
+        takes longer.
+
+    """
+    if accel==math.inf:
+        return distance/seconds
+    discriminant=(accel*seconds)**2-4*accel*distance
+    if discriminant<0:
+        return None
+    #the slower root is the one that reaches its top speed
+    return (accel*seconds-math.sqrt(discriminant))/2
+
+def compile_profile(address, start_pos, knot_times, knot_steps, max_pos=MAX_POSITION, accel=math.inf):
+    """Builds one command that runs fitted moves back to back.
+
+    Moves of 0 steps become waits. Moves past 0 or max_pos stop there at
+    the velocity asked for, and wait out the rest of their time.
+
+    Each move starts and ends at rest, so with a finite accel its velocity
+    is raised to make up for the ramps, and each move still ends on time.
+    Within a move the pump is then behind the fitted line while it speeds
+    up and ahead of it while it slows down, by at most v*v/(2*accel) steps.
+    Left at infinity, as when the motor has no accel_scale, each move
+    really ends late by v/accel of the motor's actual acceleration, and the
+    lateness adds up from move to move.
+
+    Args:
+        accel (float): the motor's acceleration in steps/s^2. See
+            syringe_motor.Motor.accel_scale.
+
+    Returns:
+        (exe, warnings): the command and a list of warning strings.
+
+    Raises:
+        ValueError: if the program is too long for the controller.
+
+    """
+    warnings=[]
+    parts=[]
+    pos=int(round(start_pos))
+    #time the program has taken so far, with velocities in whole steps/s
+    elapsed=knot_times[0]
+    for i in range(1, len(knot_times)):
+        seconds=knot_times[i]-elapsed
+        target=int(round(start_pos+knot_steps[i]))
+        #steps the move should take seconds for, past the limits or not
+        requested=abs(target-pos)
+        if target<0 or target>max_pos:
+            if not warnings:
+                warnings.append("warn: profile goes past the position limits. Volume will not be as specified!")
+            target=min(max(target, 0), int(max_pos))
+        distance=abs(target-pos)
+        if distance==0:
+            ms=max(0, int(round(seconds*1000)))
+            parts.append(encode_wait(ms))
+            elapsed+=ms/1000.0
+            continue
+        #round up and wait out the difference, so slow moves don't drift late or early.
+        #A move cut short at a limit keeps the flow asked for, and waits there.
+        vel=ramp_velocity(requested, max(seconds, 1e-3), accel)
+        if vel is None:
+            warnings.append("warn: a move of %d steps can't ramp up and down in %.3g s. The profile will run late."
+                            %(requested, seconds))
+            vel=math.sqrt(accel*requested)
+        vel=min(MAX_VELOCITY, max(1, int(np.ceil(vel))))
+        duration=trapezoid(distance, vel, accel, 0)[1]
+        ms=max(0, int(round((seconds-duration)*1000)))
+        parts.append("V"+str(vel)+"A"+str(target)+encode_wait(ms))
+        elapsed+=duration+ms/1000.0
+        pos=target
+
+    exe="/"+address+"".join(parts)+"R"
+    if len(exe)>MAX_COMMAND_LENGTH:
+        raise ValueError("profile needs "+str(len(parts))+" moves, "+str(len(exe))+" characters, more than the controller's "
+                         +str(MAX_COMMAND_LENGTH)+". Try a larger tolerance.")
+    return exe, warnings
+
+def profile_program(motor, profile, duration, tolerance=0.001, dt=None):
+    """Builds one command that follows a flow profile.
+
+    Positive flows inject, like handleInject, and negative flows draw.
+    Once motor.accel_scale is calibrated, the moves make up for the time
+    the motor spends speeding up and slowing down. See compile_profile.
+
+    Example:
+        #ramp from 0 to 2 mL/min over a minute
+        exe, warnings=profile_program(motor, lambda t: 2*t/60, 60)
+        motor.sendRawCommand(exe)
+
+    Args:
+        motor (syringe_motor.Motor): gives address, position and calibration.
+        profile: mL/min over time. See sample_profile.
+        duration (float): seconds the profile runs.
+        tolerance (float): largest allowed volume error at any time, mL.
+        dt (float): sample spacing, seconds.
+
+    Returns:
+        (exe, warnings): the command and a list of warning strings.
+
+    Raises:
+        ValueError: for profiles the motor can't follow in one program.
+
+    """
+    if tolerance<=0:
+        raise ValueError("tolerance must be more than 0.")
+    steps_per_mL=motor.motor_position_per_rad/motor.mL_per_rad
+    t, flow=sample_profile(profile, duration, dt)
+    #mL/min -> steps moved since the start
+    rate=flow*steps_per_mL/60.0
+    steps=np.concatenate(([0.0], np.cumsum((rate[1:]+rate[:-1])*0.5*np.diff(t))))
+    knot_times, knot_steps=fit_segments(t, steps, tolerance*steps_per_mL)
+    #the 'L' the motor was last sent
+    accel=math.inf if motor.accel_scale is None else motor.model.accel*motor.accel_scale
+    return compile_profile(motor.motor_address, motor.motor_position, knot_times, knot_steps, motor.max_pos, accel)
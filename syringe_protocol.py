@@ -0,0 +1,311 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Runs timed actions across every pump in a MotorGroup.
+
+A protocol is a list of Action, each saying what one pump does and when,
+in seconds from the start. Every action is compiled to its command before
+anything moves, so a bad volume or velocity fails up front instead of
+halfway through an experiment.
+
+Each bus gets its own thread, which sleeps on the monotonic clock until
+just before an action is due and starts sending early by the time the
+command takes on the wire, so the controller has all of it at the
+deadline. Actions due at the same time on one bus are uploaded ahead of
+time and started together with group 'R' frames, see MotorGroup.start.
+
+Example:
+    actions=load_protocol('mix.json')
+    runner=ProtocolRunner(motorGroup, actions)
+    for d in runner.run():
+        print(d.action.pump, d.action.kind, d.skew)
+
+where mix.json is like:
+    [{"time": 0, "pump": "1", "action": "inject", "ml": 0.5, "secs": 10},
+     {"time": 0, "pump": "2", "action": "draw", "ml": 0.5, "secs": 10},
+     {"time": 5, "pump": "2", "action": "stop"}]
+
+"""
+import re
+import json
+import time
+import itertools
+import threading
+import collections
+import serial
+import syringe_motor
+import syringe_program
+
+ACTIONS=('inject', 'draw', 'cycle', 'profile', 'stop')
+
+#last stretch before a deadline is busy-waited, since sleeps overshoot
+SPIN=0.002
+#extra time allowed for uploading programs that start together
+UPLOAD_MARGIN=0.02
+
+#Motor attributes compile_action reads, copied to follow each pump's position
+CALIBRATION_FIELDS=('motor_address', 'mL_per_rad', 'motor_position_per_rad', 'motor_position', 'max_pos')
+
+Action=collections.namedtuple('Action', ['time', 'pump', 'kind', 'params'])
+
+#an action compiled for its motor. body is the command without address or 'R', None for stop.
+Step=collections.namedtuple('Step', ['action', 'motor', 'body'])
+
+#what happened to an action. sent and deadline are time.monotonic(); skew
+# is how late the controller had the whole command, in seconds.
+Dispatch=collections.namedtuple('Dispatch', ['action', 'deadline', 'sent', 'skew', 'error'])
+
+def load_protocol(filename):
+    """Reads a protocol from a json list of actions.
+
+    Each entry has "time", "pump" and "action", and the action's
+    parameters as other keys. See compile_action.
+    """
+    with open(filename) as f:
+        entries=json.load(f)
+    actions=[]
+    for e in entries:
+        e=dict(e)
+        actions.append(Action(float(e.pop('time')), str(e.pop('pump')), e.pop('action'), e))
+    return actions
+
+_LAST_TARGET_RE=re.compile(r'A(\d+)(?!.*A\d)')
+
+def compile_action(motor, action):
+    """Builds the command body for one action.
+
+    Parameters by action:
+        inject, draw: ml, secs.
+        cycle: ml, pull_secs, push_secs, top_wait_ms, bottom_wait_ms, repeats,
+            as in syringe_program.cycle_program.
+        profile: flow (mL/min samples spread over secs), secs, tolerance,
+            as in syringe_program.profile_program.
+        stop: none.
+
+    Args:
+        motor (syringe_motor.Motor): a stand-in whose motor_position is
+            where the pump is expected to be, as expected_motor makes. It is
+            moved to where the action ends.
+
+    Returns:
+        (body, warnings)
+
+    Raises:
+        ValueError: for actions the motor can't do.
+
+    """
+    p=action.params
+    if action.kind in ('inject', 'draw'):
+        ml=float(p['ml'])
+        secs=float(p['secs'])
+        if ml<=0 or secs<=0:
+            raise ValueError("ml and secs must be more than 0.")
+        steps=int(round(ml/motor.mL_per_rad*motor.motor_position_per_rad))
+        vel=int(round(steps/secs))
+        if not 0<vel<=syringe_program.MAX_VELOCITY:
+            raise ValueError("velocity "+str(vel)+" out of range. The motor is not accurate at high speeds.")
+        target=motor.motor_position+(steps if action.kind=='inject' else -steps)
+        if not 0<=target<=motor.max_pos:
+            raise ValueError("would move to "+str(int(target))+", past the position limits.")
+        motor.motor_position=target
+        return "V"+str(vel)+("P" if action.kind=='inject' else "D")+str(steps), []
+    if action.kind=='cycle':
+        exe, warnings=syringe_program.cycle_program(motor, float(p['ml']), float(p['pull_secs']),
+                                                    float(p.get('top_wait_ms', 0)), float(p['push_secs']),
+                                                    float(p.get('bottom_wait_ms', 0)), float(p.get('repeats', 1)))
+        #cycles end back at the top of the stroke
+        return motor.program_body(exe), warnings
+    if action.kind=='profile':
+        exe, warnings=syringe_program.profile_program(motor, p['flow'], float(p['secs']),
+                                                      float(p.get('tolerance', 0.001)))
+        m=_LAST_TARGET_RE.search(exe)
+        if m is not None:
+            motor.motor_position=int(m.group(1))
+        return motor.program_body(exe), warnings
+    if action.kind=='stop':
+        return None, []
+    raise ValueError("unknown action '"+str(action.kind)+"', expected one of "+", ".join(ACTIONS))
+
+def expected_motor(motor):
+    """A detached Motor with motor's calibration, to compile actions against.
+
+    Only CALIBRATION_FIELDS are copied, so nothing compiling does reaches
+    the live motor's bus, caches or motion model.
+    """
+    expected=syringe_motor.Motor()
+    for name in CALIBRATION_FIELDS:
+        setattr(expected, name, getattr(motor, name))
+    return expected
+
+def compile_actions(motorGroup, actions):
+    """Compiles a protocol, following each pump's position from action to action.
+
+    Returns:
+        (steps, warnings): Steps sorted by time, and warning strings.
+
+    Raises:
+        ValueError: naming the first action that can't be done.
+
+    """
+    expected={}
+    steps=[]
+    warnings=[]
+    for action in sorted(actions, key=lambda a: a.time):
+        motor=motorGroup.motordict.get(action.pump)
+        if motor is None:
+            raise ValueError("pump "+str(action.pump)+" does not exist")
+        if action.time<0:
+            raise ValueError("action at negative time "+str(action.time))
+        if action.pump not in expected:
+            expected[action.pump]=expected_motor(motor)
+        try:
+            body, w=compile_action(expected[action.pump], action)
+        except (KeyError, ValueError) as e:
+            raise ValueError("pump %s %s at %g s: %s"%(action.pump, action.kind, action.time, e))
+        warnings.extend("pump %s at %g s: %s"%(action.pump, action.time, x) for x in w)
+        steps.append(Step(action, motor, body))
+    return steps, warnings
+
+def sleep_until(deadline, cancel=None):
+    """Sleeps until time.monotonic() reaches deadline, busy-waiting the last SPIN.
+
+    Returns:
+        False if cancel was set first.
+
+    """
+    left=deadline-time.monotonic()-SPIN
+    if left>0:
+        if cancel is not None:
+            if cancel.wait(left):
+                return False
+        else:
+            time.sleep(left)
+    while time.monotonic()<deadline:
+        pass
+    return cancel is None or not cancel.is_set()
+
+def _covered(address, steps):
+    """The steps whose motor a single or group address reaches."""
+    members=syringe_motor.GROUP_ADDRESSES.get(address, address)
+    return [s for s in steps if s.motor.motor_address in members]
+
+def skew_report(dispatches):
+    """Sums up how close a run came to its deadlines.
+
+    Returns:
+        dict with the number of actions and errors, and the mean, worst
+        and worst absolute skew in ms.
+
+    """
+    skews=[d.skew*1000 for d in dispatches if d.skew is not None]
+    return {
+        'actions': len(dispatches),
+        'errors': sum(1 for d in dispatches if d.error is not None),
+        'mean_skew_ms': sum(skews)/len(skews) if skews else None,
+        'max_skew_ms': max(skews) if skews else None,
+        'max_abs_skew_ms': max(abs(s) for s in skews) if skews else None,
+    }
+
+class ProtocolRunner:
+    """Runs a protocol on a connected MotorGroup."""
+
+    def __init__(self, motorGroup, actions):
+        """
+        Raises:
+            ValueError: if any action can't be compiled.
+
+        """
+        self.motorGroup=motorGroup
+        self.steps, self.warnings=compile_actions(motorGroup, actions)
+
+    def run(self, start_delay=0.5, cancel=None):
+        """Runs every action at its time, measured from start_delay seconds from now.
+
+        Returns once every action has been sent, which may be before the
+        pumps finish moving.
+
+        Args:
+            cancel (threading.Event): stops sending further actions when set.
+
+        Returns:
+            a list of Dispatch, in the order of the actions. Actions not
+            sent because of cancel have error 'cancelled'.
+
+        """
+        buses=collections.OrderedDict()
+        for step in self.steps:
+            buses.setdefault(step.motor.bus, []).append(step)
+
+        t0=time.monotonic()+start_delay
+        results={}
+        threads=[threading.Thread(target=self._run_bus, args=(bus, steps, t0, cancel, results))
+                 for bus, steps in buses.items()]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return [results[id(step)] for step in self.steps if id(step) in results]
+
+    def _run_bus(self, bus, steps, t0, cancel, results):
+        for when, batch in itertools.groupby(steps, key=lambda s: s.action.time):
+            batch=list(batch)
+            deadline=t0+when
+            try:
+                if not self._run_batch(bus, batch, deadline, cancel, results):
+                    for step in steps:
+                        results.setdefault(id(step), Dispatch(step.action, t0+step.action.time, None, None, 'cancelled'))
+                    return
+            except serial.serialutil.SerialException as e:
+                for step in batch:
+                    results.setdefault(id(step), Dispatch(step.action, deadline, None, None, str(e)))
+
+    def _upload_lead(self, bus, starts):
+        """Seconds needed to upload programs before they start together."""
+        turnaround=bus.turnaround if bus.turnaround is not None else 0.005
+        return sum(bus.byte_time(len(s.motor.motor_address)+len(s.body)+2)+turnaround
+                   +bus.byte_time(syringe_motor.QUERY_REPLY_LENGTH)+bus.default_delay()
+                   for s in starts)+UPLOAD_MARGIN
+
+    def _run_batch(self, bus, batch, deadline, cancel, results):
+        """Sends the actions on one bus that share a deadline. Returns False if cancelled."""
+        stops=[s for s in batch if s.body is None]
+        starts=[s for s in batch if s.body is not None]
+
+        #(message, steps it covers)
+        frames=[]
+        for address in syringe_motor.group_addresses(set(s.motor.motor_address for s in stops)):
+            frames.append(("/"+address+"TR", _covered(address, stops)))
+        if len(starts)==1:
+            s=starts[0]
+            frames.append(("/"+s.motor.motor_address+s.body+"R", starts))
+        elif starts:
+            #store each program without 'R', then start them all at once
+            if not sleep_until(deadline-self._upload_lead(bus, starts)-bus.byte_time(4), cancel):
+                return False
+            for s in starts:
+                response=s.motor.sendCommand("/"+s.motor.motor_address+s.body)
+                if response is None or response.error:
+                    error="no reply" if response is None else response.error_text
+                    results[id(s)]=Dispatch(s.action, deadline, None, None, error)
+            pending=[s for s in starts if id(s) not in results]
+            for address in syringe_motor.group_addresses(set(s.motor.motor_address for s in pending)):
+                frames.append(("/"+address+"R", _covered(address, pending)))
+
+        for message, covered in frames:
+            if not sleep_until(deadline-bus.byte_time(len(message)+1), cancel):
+                return False
+            error=None
+            if message[1] in syringe_motor.GROUP_ADDRESSES:
+                bus.sendBroadcast(message)
+            else:
+                response=bus.sendCommand(message)
+                if response is None:
+                    error="no reply"
+                elif response.error:
+                    error=response.error_text
+                if response is not None:
+                    for s in covered:
+                        s.motor.last_response=response
+            sent=bus.last_write
+            skew=sent+bus.byte_time(len(message)+1)-deadline
+            for s in covered:
+                results[id(s)]=Dispatch(s.action, deadline, sent, skew, error)
+        return True
@@ -1,15 +1,12 @@
 #!/usr/bin/env python3
 # vim: set expandtab tabstop=4:
 
-import imp
 try:
-    imp.find_module('PyQt5')
     from PyQt5 import QtCore
     from PyQt5.QtCore import QObject, pyqtSignal
     from PyQt5.QtWidgets import QApplication, QMainWindow, QDialog
 except ImportError:
     try:
-        imp.find_module('PyQt4')
         from PyQt4 import QtGui, QtCore
         from PyQt4.QtCore import pyqtSignal
         from PyQt4.QtGui import QApplication, QMainWindow, QDialog
@@ -18,12 +15,17 @@ except ImportError:
 from syringe_pump_controller_ui import Ui_MainWindow
 #from syringe_pump_init_ui import Ui_InitWindow
 import syringe_motor
+import syringe_telemetry
+import syringe_program
+import syringe_ports
+import syringe_catalog
 import optparse
 import math
 import threading
 import time
 import os
 import serial
+import concurrent.futures
 
 class ControllerWindow(QMainWindow):
     """This class creats a dialogue window for interacting with the silverpak motor when it's part of a syringe pump. 
@@ -40,7 +42,17 @@ class ControllerWindow(QMainWindow):
     #INIT FUNCTIONS#
     #--------------#
 
+    #seconds between Plot tab samples while the motor moves, and while it doesn't
+    PLOT_PERIOD=0.4
+    PLOT_IDLE_PERIOD=10.0
+    #seconds shown for each choice of plot_span, None for the whole run
+    PLOT_SPANS=[None, 600, 3600, 86400]
+
     sig=pyqtSignal()
+    #(future, callback) of a finished background job, delivered on the GUI thread
+    jobDone=pyqtSignal(object, object)
+    #(action, syringe_ports.Adapter) from the hotplug watcher
+    portChanged=pyqtSignal(str, object)
     def __init__(self):
         """Initializes the class, initializes the motor, and connects all the buttons."""
         #UI INIT
@@ -50,6 +62,29 @@ class ControllerWindow(QMainWindow):
        
         #variables
         self.xml_filename='syringe_pump_data.xml' 
+        #calibration files under the working directory
+        self.catalog=syringe_catalog.CalibrationCatalog('.')
+
+        #serial I/O runs on one worker thread, in the order it was queued
+        self.executor=concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.jobDone.connect(self._job_done)
+        #position/velocity poller for the current motor, started on connect
+        self.telemetry=None
+        #set by stop() to end any wait_until_idle running on the I/O thread
+        self.cancel_wait=threading.Event()
+        #keeps the port list current as adapters are plugged in and out
+        self.portChanged.connect(self._port_changed)
+        self.port_watcher=syringe_ports.PortWatcher(self.portChanged.emit)
+        self.port_watcher.start()
+        #the volume indicators follow the motion model while the motor moves
+        self.display_timer=QtCore.QTimer(self)
+        self.display_timer.timeout.connect(self.update_display)
+        self.display_timer.start(200)
+        self._was_busy=False
+        #the Plot tab follows the same model: (motor, time, mL) of the last sample
+        self.ui.plot.add_trace("Position", "mL")
+        self.ui.plot.add_trace("Flow", "mL/min")
+        self._plot_last=None
 
         #MOTOR CLASS INIT
         self.motorGroup=syringe_motor.MotorGroup()
@@ -103,7 +138,9 @@ class ControllerWindow(QMainWindow):
         self.ui.portswitch_button.clicked.connect(self.switch_port)
         try:
             self.scan_ports()#also triggers select_port def and connects
-            self.switch_port()
+            #connects in the background. Errors go to the console.
+            if self.ui.port_select.count():
+                self.switch_port()
         except:
             pass #ignore any serial errors and init the ui no matter what
         #self.ui.baud_select.currentIndexChanged[str].connect(self.select_baud)
@@ -113,6 +150,8 @@ class ControllerWindow(QMainWindow):
         self.ui.cal_expect_unit.currentIndexChanged[str].connect(self.calResultUnit)
         self.ui.cal_file_list.currentIndexChanged[str].connect(self.xmlDefaultSaveName)
         self.ui.cal_scan_button.clicked.connect(self.populate_xml)
+        self.ui.plot_span.currentIndexChanged[int].connect(self.plot_span_changed)
+        self.ui.plot_clear_button.clicked.connect(self.ui.plot.clear)
         self.ui.cal_load_button.clicked.connect(self.load_xml)
         self.ui.cal_save_button.clicked.connect(self.save_xml)
         self.populate_xml()
@@ -121,7 +160,6 @@ class ControllerWindow(QMainWindow):
         #USER NOTIFICATION
         self.ui.console.appendPlainText("No motors connected yet. Use the connection tab to connect motors.")
 
-        self.ui.console.appendPlainText("Warning: Once you initialize, you may have to reset the max/min injection amounts, because the motor sometimes refuses commands immediately after initialization.")
 
     def init_motor(self):
         """Initializes the motor using the silverpak init command and sets valid velocity and acceleration values."""
@@ -132,11 +170,22 @@ class ControllerWindow(QMainWindow):
         self.ui.console.appendPlainText("...")
 
         #Acceleration. Needed for motor to actually move.
-        self.motor.sendRawCommand("/"+self.motor.motor_address+"L5000R")
+        self.send("/"+self.motor.motor_address+"L5000R")
         #Velocity. Needs to be set low for motor to move without slipping.
-        self.motor.sendRawCommand("/"+self.motor.motor_address+"V200000R")
+        self.send("/"+self.motor.motor_address+"V200000R")
         #default init command. Todo: allow user to set rotations allowed.
-        self.motor.sendRawCommand("/"+self.motor.motor_address+"Z10000R")
+        motor=self.motor
+        def job():
+            motor.sendCommand("/"+motor.motor_address+"Z10000R")
+            #the motor refuses commands until homing is done
+            return motor.wait_until_idle(timeout=60, cancel=self.cancel_wait)
+        self.run_in_background(job, self._init_motor_done)
+
+    def _init_motor_done(self, idle):
+        """Finishes init_motor once the motor is done homing."""
+        if not idle:
+            self.ui.console.appendPlainText("warn: motor did not finish initializing.")
+            return
 
         #go back to starting position. It's usually two rotations, so go back that amount.
         #zero="/"+self.motor.motor_address+"z"+str(int(self.motor.motor_position_per_rad*2*math.pi))+"R"
@@ -151,13 +200,76 @@ class ControllerWindow(QMainWindow):
         self.no_min()
         self.show_max_draw()
         self.show_max_inject()
-        self.checkStatus()
 
         self.ui.calib_ml_per_rad_line.setText(str(self.motor.mL_per_rad))
         self.ui.calib_pos_per_rad_line.setText(str(self.motor.motor_position_per_rad))
 
         #done
         self.ui.console.appendPlainText("Motor initialized.")
+        self.checkStatus()
+
+    #--------------------#
+    #BACKGROUND MOTOR I/O#
+    #--------------------#
+
+    def run_in_background(self, job, done=None):
+        """Queues job on the motor I/O thread so the GUI never waits on the port.
+
+        Args:
+            job: callable run on the I/O thread. Must not touch the ui.
+            done: optional callable given job's result on the GUI thread.
+
+        Returns:
+            the concurrent.futures.Future for job.
+
+        """
+        future=self.executor.submit(job)
+        future.add_done_callback(lambda f: self.jobDone.emit(f, done))
+        return future
+
+    def send(self, command, done=None):
+        """Queues a raw command for the current motor. See run_in_background.
+
+        done is given the reply payload as a str, or None if there was no
+        reply. Errors the motor reports are printed to the console.
+        """
+        motor=self.motor
+        return self.run_in_background(lambda: motor.sendCommand(command), lambda r: self._sent(command, r, done))
+
+    def _sent(self, command, response, done):
+        if response is not None and response.error:
+            self.ui.console.appendPlainText("err: motor rejected "+command+": "+response.error_text)
+        if done is not None:
+            done(None if response is None else response.data)
+
+    def _job_done(self, future, done):
+        """Reports a finished background job on the GUI thread."""
+        try:
+            result=future.result()
+        except Exception as e:
+            self.ui.console.appendPlainText("err: "+str(e))
+            return
+        if done is not None:
+            done(result)
+
+    def closeEvent(self, event):
+        """Lets queued motor commands finish without holding up the window."""
+        self.stop_telemetry()
+        self.port_watcher.stop()
+        self.executor.shutdown(wait=False)
+        self.motorGroup.flush()
+        super(ControllerWindow, self).closeEvent(event)
+
+    def start_telemetry(self):
+        """(Re)starts background position/velocity polling for the current motor."""
+        self.stop_telemetry()
+        self.telemetry=syringe_telemetry.TelemetrySampler(self.motor)
+        self.telemetry.start()
+
+    def stop_telemetry(self):
+        if self.telemetry is not None:
+            self.telemetry.stop()
+            self.telemetry=None
 
     #---------------#
     #DISPLAY HELPERS#
@@ -171,7 +283,7 @@ class ControllerWindow(QMainWindow):
         
         """
 
-        max_draw=(-self.motor.motor_position/self.motor.motor_position_per_rad)*self.motor.mL_per_rad
+        max_draw=(-self.motor.predicted_position()/self.motor.motor_position_per_rad)*self.motor.mL_per_rad
 
         self.ui.max_draw_i.setText(str(max_draw))
         self.ui.max_draw_p.setText(str(max_draw))
@@ -185,11 +297,50 @@ class ControllerWindow(QMainWindow):
         
         """
 
-        max_inject=((self.motor.max_pos-self.motor.motor_position)/self.motor.motor_position_per_rad)*self.motor.mL_per_rad
+        max_inject=((self.motor.max_pos-self.motor.predicted_position())/self.motor.motor_position_per_rad)*self.motor.mL_per_rad
 
         self.ui.max_inject_i.setText(str(max_inject))
         self.ui.max_inject_c.setText(str(max_inject))
 
+    def update_display(self):
+        """Refreshes the volume indicators from the motion model, without serial traffic."""
+        if self.motor is None:
+            return
+        model=self.motor.model
+        drift=model.drifted
+        if drift is not None:
+            model.drifted=None
+            self.ui.console.appendPlainText("warn: motor was %d steps from where it should be. It may have stalled or been moved by hand."%drift)
+        busy=model.predict(time.monotonic())[1]
+        if busy or self._was_busy:
+            self.show_max_draw()
+            self.show_max_inject()
+        self.sample_plot(busy or self._was_busy)
+        self._was_busy=busy
+
+    def sample_plot(self, moving):
+        """Adds the current motor's predicted position and flow to the Plot tab."""
+        now=time.monotonic()
+        motor=self.motor
+        if motor is None:
+            return
+        last=self._plot_last
+        if last is not None and last[0] is not motor:
+            #another pump's run
+            self.ui.plot.clear()
+            last=None
+        if last is not None and now-last[1]<(self.PLOT_PERIOD if moving else self.PLOT_IDLE_PERIOD):
+            return
+        ml=motor.predicted_position(now)/motor.motor_position_per_rad*motor.mL_per_rad
+        flow=0.0
+        if last is not None:
+            flow=(ml-last[2])/(now-last[1])*60
+        self.ui.plot.append(now, [ml, flow])
+        self._plot_last=(motor, now, ml)
+
+    def plot_span_changed(self, index):
+        self.ui.plot.set_span(self.PLOT_SPANS[index])
+
     def calResultUnit(self, text):
         self.ui.cal_expect_unit_label.setText(text)
 
@@ -214,10 +365,20 @@ class ControllerWindow(QMainWindow):
         self.ui.calib_pos_per_rad_line.setText(str(self.motor.motor_position_per_rad))
 
         
-    def write_xml(self,filename):
-        """Calls the motorGroup serialize routine"""
+    def write_xml(self,filename,later=False):
+        """Calls the motorGroup serialize routine
+
+        Args:
+            later (bool): write in the background once changes settle,
+                instead of now.
+
+        """
         #call
-        self.motorGroup.serialize(filename)
+        if later:
+            self.motorGroup.mark_dirty()
+            self.motorGroup.save_later(filename)
+        else:
+            self.motorGroup.serialize(filename)
 
         #update calibration display data
         self.ui.calib_default_radio.setChecked(False)
@@ -225,19 +386,15 @@ class ControllerWindow(QMainWindow):
         self.ui.calib_pos_per_rad_line.setText(str(self.motor.motor_position_per_rad))
 
     def populate_xml(self):
-        """checks the current directory for xml files and adds 
+        """checks the current directory for calibration files and adds 
             the paths."""
 
         self.ui.cal_file_list.clear()#remove everything
         
-        #thanks to: http://stackoverflow.com/a/3207973/782170
-        for(path, names, fnames) in os.walk('.'):
-            for n in fnames:
-                d=path+n
-                end=d[-4:]
-                if end.lower()=='.xml':
-                    self.ui.cal_file_list.addItem("")
-                    self.ui.cal_file_list.setItemText(self.ui.cal_file_list.count()-1, QtCore.QCoreApplication.translate("MainWindow", d[1:]))
+        #only directories and files that changed since the last scan are read again
+        for d in self.catalog.scan():
+            self.ui.cal_file_list.addItem("")
+            self.ui.cal_file_list.setItemText(self.ui.cal_file_list.count()-1, QtCore.QCoreApplication.translate("MainWindow", d))
 
     def load_xml(self):
         """handles load xml button. Switches calibration data."""
@@ -265,13 +422,17 @@ class ControllerWindow(QMainWindow):
         try:
             self.motor=self.motorGroup.motordict[num]
             self.ui.pump_exists.setText("Exists. In use.")
-            #self.motor.connect(self.ui.port_select.currentText(),self.motor.srl_port.baudrate,self.motor.motor_address)
+            #the group's bus stays open, so switching pumps doesn't reconnect
+            self.motorGroup.attach(self.motor)
+            if self.motor.srl_port.isOpen():
+                self.start_telemetry()
         except KeyError:
             self.ui.console.appendPlainText("err: motor does not exist")
                    
         
         
-        self.motorGroup.serialize(self.xml_filename) 
+        self.motorGroup.mark_dirty(num)
+        self.motorGroup.save_later(self.xml_filename)
 
     def new_pump(self):
         """Creates a new pump."""
@@ -283,11 +444,13 @@ class ControllerWindow(QMainWindow):
         if self.motorGroup.motordict.get(num, None)==None:
             self.motorGroup.motordict[num]=syringe_motor.Motor()
             self.motorGroup.motordict[num].motor_address=sym
+            self.motorGroup.attach(self.motorGroup.motordict[num])
             self.ui.pump_exists.setText("Exists.")
         else:
             self.ui.console.appendPlainText("err: motor already exists")
         
-        self.motorGroup.serialize(self.xml_filename) 
+        self.motorGroup.mark_dirty(num)
+        self.motorGroup.save_later(self.xml_filename)
    
     def delete_pump(self):
         "Deletes an existing pump."
@@ -297,15 +460,19 @@ class ControllerWindow(QMainWindow):
         sym=syringe_motor.convertToSymbol(num)
 
         if self.motorGroup.motordict.get(num,None)!=None:
+            self.motorGroup.motordict[num].disconnect()
             if self.motorGroup.motordict[num]==self.motor:
-                del self.motor
+                #the display timer keeps running, and checks for no motor
+                self.stop_telemetry()
+                self.motor=None
             del self.motorGroup.motordict[num]
             self.ui.pump_exists.setText("Does Not Exist.")
             #gc.collect()
         else:
             self.ui.console.appendPlainText("err: Motor does not exist")
 
-        self.motorGroup.serialize(self.xml_filename) 
+        self.motorGroup.mark_dirty(num)
+        self.motorGroup.save_later(self.xml_filename)
 
 
     def select_pump(self, text):
@@ -339,7 +506,7 @@ class ControllerWindow(QMainWindow):
         """Sets the motor value to somewhere near the middle of possible motor.motor_positions."""
         if self.motor.is_max_set:
             self.motor.motor_position=1073741824+self.motor.motor_position
-            self.motor.sendRawCommand("/"+self.motor.motor_address+"z"+str(self.motor.motor_position)+"R")
+            self.send("/"+self.motor.motor_address+"z"+str(self.motor.motor_position)+"R")
             self.motor.max_pos=1073741824+self.motor.max_pos
             self.ui.no_max_button.setChecked(True)
             self.ui.set_max_button.setChecked(False)
@@ -355,7 +522,7 @@ class ControllerWindow(QMainWindow):
         if not self.motor.is_max_set:
             self.motor.max_pos=abs(self.motor.max_pos-self.motor.motor_position)
             self.motor.motor_position=0
-            self.motor.sendRawCommand("/"+self.motor.motor_address+"z0R")
+            self.send("/"+self.motor.motor_address+"z0R")
             self.ui.set_max_button.setChecked(True)
             self.ui.no_max_button.setChecked(False)
             self.motor.is_max_set=True
@@ -368,15 +535,18 @@ class ControllerWindow(QMainWindow):
     def set_min(self):
         """Sets the current position to the minimum cc."""
         if not self.motor.is_min_set:
-            self.motor.max_pos=self.getPosition()
+            motor=self.motor
+            self.run_in_background(lambda: self.getPosition(motor), lambda pos: self._min_set(motor, pos))
             self.ui.set_min_button.setChecked(True)
             self.ui.no_min_button.setChecked(False)
             self.motor.is_min_set=True
             self.ui.set_max_button.setChecked(self.motor.is_max_set)
             self.ui.no_max_button.setChecked(not self.motor.is_max_set)
 
-            self.show_max_draw()
-            self.show_max_inject()
+    def _min_set(self, motor, pos):
+        motor.max_pos=pos
+        self.show_max_draw()
+        self.show_max_inject()
 
     def no_min(self):
         """Sets the max position to a high value that you'll never reach."""
@@ -400,6 +570,20 @@ class ControllerWindow(QMainWindow):
         for p in syringe_motor.scan_ports():
             self.ui.port_select.addItem(p)
 
+    def _port_changed(self, action, adapter):
+        index=self.ui.port_select.findText(adapter.device)
+        if action=='add':
+            if index<0:
+                self.ui.port_select.addItem(adapter.device)
+            self.ui.console.appendPlainText("Adapter plugged in: "+adapter.device+" ("+str(adapter.description)+", serial "+str(adapter.serial)+")")
+        else:
+            if index>=0:
+                self.ui.port_select.removeItem(index)
+            self.ui.console.appendPlainText("Adapter unplugged: "+adapter.device)
+            if self.motor is not None and self.motor.bus.port==adapter.device:
+                self.stop_telemetry()
+                self.ui.console.appendPlainText("WARNING: the current pump's adapter was unplugged. Plug it back in and switch port.")
+
     def switch_port(self):
         string=str(self.ui.port_select.currentText())
         baud=int(self.ui.baud_select.currentText())
@@ -407,22 +591,42 @@ class ControllerWindow(QMainWindow):
         num=text[-1:]
         sym=syringe_motor.convertToSymbol(num)
 
-                
-        if not self.motor.connect(string,baud,sym):
+        #opening the port and measuring its timing takes many round trips
+        motor=self.motor
+        group=self.motorGroup
+        def job():
+            #one shared connection for every pump on this port
+            calibrated=(string,baud) in group.bus_profiles
+            group.connect(string,baud)
+            measured=not calibrated and (string,baud) in group.bus_profiles
+            try:
+                motor.connect(string,baud,sym)
+            except serial.serialutil.SerialException:
+                #the port opened above, so nothing answered
+                return measured, False
+            return measured, True
+        self.run_in_background(job, lambda result: self._port_switched(motor, *result))
+
+    def _port_switched(self, motor, measured, responded):
+        if measured:
+            #keep the measured timing with the calibration data
+            self.motorGroup.mark_dirty()
+            self.motorGroup.save_later(self.xml_filename)
+        if not responded:
             self.ui.console.appendPlainText("WARNING: Motor did not respond!")
-        
-        print(self.motor.motor_address)
-        print(self.motor.srl_port.baudrate)
-        print(string)
-
+            return
+        if motor is self.motor:
+            self.start_telemetry()
 
         self.ui.console.appendPlainText("Port changed. Pleas initialize.")
 
     def switch_baud(self):
         baudrate=int(str(self.ui.baud_select.currentText()))
-        self.motor.sendRawCommand("/"+self.motor.motor_address+"b"+str(baudrate)+"R")
-        self.motor.srl_port.baudrate=baudrate
-        self.ui.console.appendPlainText("Baud changed. Please initialize.")
+        motor=self.motor
+        def job():
+            motor.sendRawCommand("/"+motor.motor_address+"b"+str(baudrate)+"R")
+            motor.srl_port.baudrate=baudrate
+        self.run_in_background(job, lambda r: self.ui.console.appendPlainText("Baud changed. Please initialize."))
    #-------------------------#
    #IMPORTANT MOTOR FUNCTIONS#
    #-------------------------#
@@ -432,37 +636,19 @@ class ControllerWindow(QMainWindow):
         
         Note:
             This function may not be useful for motors with no encoder wheels.
-        Depricated:
-            Too quick to be accurate.
-            Needs to be implemented using a callback to be accurate.
+            Velocities come from the telemetry sampler, so this doesn't
+            touch the serial port.
         
         """
-        pos1txt=self.motor.sendRawCommand("/"+self.motor.motor_address+"?0")
-        t1=time.clock()
-        pos2txt=self.motor.sendRawCommand("/"+self.motor.motor_address+"?0")
-        t2=time.clock()
-
-        p1=[int(s) for s in pos1txt.split('\x00') if s.isdigit()]
-        p2=[int(s) for s in pos2txt.split('\x00') if s.isdigit()]
-
-        #print(pos1txt)
-        #print(pos2txt)
-        #print(t1)
-        #print(t2)
-        #print(p1[0])
-        #print(p2[0])
-
-        vMeasured=(p2[0]-p1[0])/(t2-t1)#measure velocity in microsteps / sec
-
-        vReptxt=self.motor.sendRawCommand("/"+self.motor.motor_address+"?2")
-
-        #print(vReptxt)
-
-        vRep=[int(s) for s in vReptxt.split('\x00') if s.isdigit()]
-        vReported=vRep[0]*32
+        snap=None
+        if self.telemetry is not None:
+            snap=self.telemetry.snapshot()
+        if snap is None or snap.velocity is None:
+            self.ui.console.appendPlainText("No velocity data yet. Connect the motor and try again in a moment.")
+            return
 
-        #print(vRep)
-        #print(vReported)
+        vMeasured=snap.velocity#fitted velocity in microsteps / sec
+        vReported=snap.reported_velocity
 
         if vMeasured>0:
             direction="injecting"
@@ -470,7 +656,7 @@ class ControllerWindow(QMainWindow):
             direction="drawing"
 
         #check if velocity is withing 5% of reuested
-        if vMeasured==0:
+        if vMeasured==0 or vReported==0:
             self.ui.console.appendPlainText("motor is not moving.")
         elif (abs(vMeasured)-vReported) < 0.05*vReported:
             percent=100*((abs(vMeasured)-vReported)/vReported)
@@ -484,34 +670,49 @@ class ControllerWindow(QMainWindow):
         
     def checkStatus(self):
         """Checks if the motor is working"""
-        motor_name=self.motor.sendRawCommand("/"+self.motor.motor_address+"&")
+        self.send("/"+self.motor.motor_address+"&", self._report_status)
 
+    def _report_status(self, motor_name):
         if motor_name==None:
             self.ui.console.appendPlainText("Motor did not respond.")
         else:
             self.ui.console.appendPlainText("Motor: "+motor_name+" is working.")
 
-    def getPosition(self):
+    def getPosition(self, motor=None, fresh=False):
         """Gets the current position of the motor
         
+        Note:
+            This may block on the serial port. From the GUI thread, use it
+            inside a run_in_background job.
+
+        Args:
+            motor: the motor to ask. Defaults to the current motor.
+            fresh (bool): ask the motor even if an idle motor's position
+                was reported recently. See syringe_motor.Motor.getPosition.
+
         Returns:
             the position of the motor in steps from 0.
         Raises:
-            AttributeError: if motor is not responding correctly
+            IndexError: if motor is not responding correctly
 
         """
-        txt=self.motor.sendRawCommand("/"+self.motor.motor_address+"?0")
-        #print(str(txt))
-        n=[int(s) for s in txt.split('\x00') if s.isdigit()]
-        #print(n)
-
-        return int(n[0])
+        if motor is None:
+            motor=self.motor
+        return motor.getPosition(fresh)
 
     def stop(self):
         """Stops the motor."""
-        self.motor.sendRawCommand("/"+self.motor.motor_address+"TR")
-        self.motor.motor_position=self.getPosition()
-
+        motor=self.motor
+        self.cancel_wait.set()
+        def job():
+            #anything queued before the stop has been skipped by now
+            self.cancel_wait.clear()
+            motor.sendRawCommand("/"+motor.motor_address+"TR")
+            return self.getPosition(motor)
+        self.run_in_background(job, lambda pos: self._stopped(motor, pos))
+
+    def _stopped(self, motor, pos):
+        motor.motor_position=pos
         self.show_max_draw()
         self.show_max_inject()
 
@@ -529,60 +730,27 @@ class ControllerWindow(QMainWindow):
         push_time=float(self.ui.pumping_push_time_num.text())
         bottom_wait_time=float(self.ui.pumping_bottom_wait_time_num.text())*1000
         
-        #check info
-        if self.vol<0 or no_pumps<0 or pull_time<0 or top_wait_time<0 or push_time<0 or bottom_wait_time<0:
-            self.ui.console.appendPlainText("err: negative values not allowed.")
-            return
-
-           
         self.motor.rad = self.vol/self.motor.mL_per_rad
-        pos1=self.motor.motor_position
-        pos2=self.motor.motor_position-self.motor.rad*self.motor.motor_position_per_rad
-
-        #check info again...
-        if pos2<0:
-            self.ui.console.appendPlainText("warn: could not go past 0 position. Volume will not be as specified!")
-            pos2=0
-
-        #Impossible. Pumping cycle always starts by drawing.
-        #if pos1>self.max_pos:
-        #    self.ui.console.appendPlainTest("Warn: could not go past max position. Volume will not be as specififed!")
-
-        pull_vel=abs((self.motor.rad*self.motor.motor_position_per_rad)/pull_time)
-        push_vel=abs((self.motor.rad*self.motor.motor_position_per_rad)/push_time)
-
-        if pull_vel>732143 or push_vel>732143:
-            self.ui.console.appendPlainText("err: motor is not accurate at high speeds.")
-            return
-        
-        large_note=False
-        #wait time has a max of 30 seconds in the documentation
-        #but the motors allow (4 lvl) nested loops for as many as 30000 repeats
-        #This will give us a maximum wait time of 10 days. If a longer time is
-        # needed, you can nest another loop for a max wait of 850 years.
-        if top_wait_time>30000:
-            top_wait_string="gM30000"
-            div=top_wait_time//30000
-            top_wait_string+="G"+str(int(div))
-            mod=top_wait_time%30000
-            top_wait_string+="M"+str(int(mod))
-            large_note=True
-        else:
-            top_wait_string="M"+str(int(top_wait_time))
-        if bottom_wait_time>30000:
-            bottom_wait_string="gM30000"
-            bdiv=bottom_wait_time//30000
-            bottom_wait_string+="G"+str(int(bdiv))
-            bmod=bottom_wait_time%30000
-            bottom_wait_string+="M"+str(int(bmod))
-            large_note=True
-        else:
-            bottom_wait_string="M"+str(int(bottom_wait_time))
 
-        #Send!
-        exe="/"+self.motor.motor_address+"gV"+str(int(pull_vel))+"A"+str(int(pos2))+top_wait_string+"V"+str(int(push_vel))+"A"+str(int(pos1))+bottom_wait_string+"G"+str(int(no_pumps))+"R"
-        print(exe)
-        self.motor.sendRawCommand(exe)
+        #long waits are nested g...G loops, see syringe_program.encode_wait
+        large_note=top_wait_time>syringe_program.MAX_WAIT or bottom_wait_time>syringe_program.MAX_WAIT
+
+        #Pumping cycle always starts by drawing, so it can't go past max position.
+        #Compiling long waits takes a moment, so it's done with the I/O.
+        #Repeats of the same cycle start from the motor's stored program.
+        motor=self.motor
+        vol=self.vol
+        def job():
+            exe, warnings=syringe_program.cycle_program(motor, vol, pull_time, top_wait_time,
+                                                        push_time, bottom_wait_time, no_pumps)
+            return exe, warnings, motor.run_program(exe)
+        self.run_in_background(job, lambda result: self._pumping(result, large_note))
+
+    def _pumping(self, result, large_note):
+        exe, warnings, response=result
+        for w in warnings:
+            self.ui.console.appendPlainText(w)
+        self._sent(exe, response, None)
 
         self.show_max_draw()
         self.show_max_inject()
@@ -602,24 +770,33 @@ class ControllerWindow(QMainWindow):
         vel=(abs(self.motor.rad*self.motor.motor_position_per_rad)/time)
 
         #check user input
-        if vel>732143:
+        if vel>syringe_motor.MAX_VELOCITY:
             self.ui.console.appendPlainText("err: motor is not accurate at high speeds.")
             return
         
-        #set velocity
-        self.motor.sendRawCommand("/"+self.motor.motor_address+"V"+str(int(vel))+"R")
-        self.motor.motor_position=self.getPosition()+self.motor.rad*self.motor.motor_position_per_rad
-        #more checking...
-        if self.motor.motor_position <0:
-            self.ui.console.appendPlainText("warn: could not go past 0 position.")
-            self.motor.motor_position=0
-        if self.motor.motor_position>self.motor.max_pos:
-            self.ui.console.appendPlainText("Warn: could not go past max position. Will not inject correct volume!")
-            self.motor.motor_position=self.motor.max_pos
-
-        #Inject!
-        self.motor.sendRawCommand("/"+self.motor.motor_address+"A"+str(int(self.motor.motor_position))+"R")
-
+        motor=self.motor
+        vol=motor.vol
+        #inject works out how long to wait once the jobs ahead of it have run
+        if motor.idle_timeout()>syringe_motor.IDLE_MARGIN:
+            #the motion model says it's busy, or doesn't know
+            self.ui.console.appendPlainText("Waiting for the pump to finish its last command...")
+        self.run_in_background(lambda: motor.inject(vol, time, self.cancel_wait),
+                               lambda result: result and self._injected(motor, vel, *result))
+
+    def _injected(self, motor, vel, target, warnings):
+        for w in warnings:
+            self.ui.console.appendPlainText(w)
+        self.show_max_draw()
+        self.show_max_inject()
+        #the position is only kept once the motor reports getting there
+        self.run_in_background(lambda: motor.wait_for_position(target, vel, timeout=motor.idle_timeout(), cancel=self.cancel_wait),
+                               lambda there: self._arrived(motor, target, there))
+
+    def _arrived(self, motor, target, there):
+        if there:
+            motor.motor_position=target
+        elif not self.cancel_wait.is_set():
+            self.ui.console.appendPlainText("warn: the pump did not reach position "+str(target)+".")
         self.show_max_draw()
         self.show_max_inject()
 
@@ -649,13 +826,20 @@ class ControllerWindow(QMainWindow):
             mpos = expRad*self.motor.motor_position_per_rad
             self.motor.motor_position_per_rad=mpos/actRad
 
-        self.write_xml(self.xml_filename)
+        self.write_xml(self.xml_filename, later=True)
         self.show_max_draw()
         self.show_max_inject()
 
 if __name__ == '__main__':
     import sys
     
+    parser = optparse.OptionParser()
+    parser.add_option('--record', metavar='FILE', help="keep a flight recording of serial traffic, see syringe_recorder.py")
+    options, args = parser.parse_args()
+    if options.record:
+        import syringe_recorder
+        syringe_recorder.install(options.record)
+
     app = QApplication(sys.argv)
     
     wind = ControllerWindow()
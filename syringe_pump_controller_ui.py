@@ -526,6 +526,37 @@ class Ui_MainWindow(object):
         self.horizontalLayout_5.addItem(spacerItem24)
         self.verticalLayout_4.addLayout(self.horizontalLayout_5)
         self.tabWidget.addTab(self.Calibration_tab, "")
+        self.Plot_tab = QtWidgets.QWidget()
+        self.Plot_tab.setObjectName("Plot_tab")
+        self.verticalLayout_11 = QtWidgets.QVBoxLayout(self.Plot_tab)
+        self.verticalLayout_11.setObjectName("verticalLayout_11")
+        self.horizontalLayout_12 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_12.setObjectName("horizontalLayout_12")
+        self.label_29 = QtWidgets.QLabel(self.Plot_tab)
+        self.label_29.setObjectName("label_29")
+        self.horizontalLayout_12.addWidget(self.label_29)
+        self.plot_span = QtWidgets.QComboBox(self.Plot_tab)
+        self.plot_span.setObjectName("plot_span")
+        self.plot_span.addItem("")
+        self.plot_span.addItem("")
+        self.plot_span.addItem("")
+        self.plot_span.addItem("")
+        self.horizontalLayout_12.addWidget(self.plot_span)
+        spacerItem25 = QtWidgets.QSpacerItem(40, 20, QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Minimum)
+        self.horizontalLayout_12.addItem(spacerItem25)
+        self.plot_clear_button = QtWidgets.QPushButton(self.Plot_tab)
+        self.plot_clear_button.setObjectName("plot_clear_button")
+        self.horizontalLayout_12.addWidget(self.plot_clear_button)
+        self.verticalLayout_11.addLayout(self.horizontalLayout_12)
+        self.plot = PlotWidget(self.Plot_tab)
+        sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Expanding)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.plot.sizePolicy().hasHeightForWidth())
+        self.plot.setSizePolicy(sizePolicy)
+        self.plot.setObjectName("plot")
+        self.verticalLayout_11.addWidget(self.plot)
+        self.tabWidget.addTab(self.Plot_tab, "")
         self.verticalLayout.addWidget(self.tabWidget)
         self.horizontalLayout = QtWidgets.QHBoxLayout()
         self.horizontalLayout.setObjectName("horizontalLayout")
@@ -682,6 +713,13 @@ class Ui_MainWindow(object):
         self.cal_expect_unit_label.setText(_translate("MainWindow", "mL"))
         self.calibrate_button.setText(_translate("MainWindow", "Calibrate"))
         self.tabWidget.setTabText(self.tabWidget.indexOf(self.Calibration_tab), _translate("MainWindow", "Calibration"))
+        self.label_29.setText(_translate("MainWindow", "Show:"))
+        self.plot_span.setItemText(0, _translate("MainWindow", "Whole run"))
+        self.plot_span.setItemText(1, _translate("MainWindow", "Last 10 minutes"))
+        self.plot_span.setItemText(2, _translate("MainWindow", "Last hour"))
+        self.plot_span.setItemText(3, _translate("MainWindow", "Last day"))
+        self.plot_clear_button.setText(_translate("MainWindow", "Clear"))
+        self.tabWidget.setTabText(self.tabWidget.indexOf(self.Plot_tab), _translate("MainWindow", "Plot"))
         self.check_velocity_button.setText(_translate("MainWindow", "Check Velocity"))
         self.check_status_button.setText(_translate("MainWindow", "Check Status"))
         self.STOP.setText(_translate("MainWindow", "STOP"))
@@ -690,3 +728,4 @@ class Ui_MainWindow(object):
         self.set_max_button.setText(_translate("MainWindow", "Set Max Draw"))
         self.no_max_button.setText(_translate("MainWindow", "No Max Draw"))
 
+from syringe_plot import PlotWidget
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Flight recorder of every frame on the serial ports.
+
+A FlightRecorder keeps the last few thousand frames in a fixed-size,
+memory-mapped ring file. The OS writes the pages back, so recording
+costs a struct.pack_into per frame. The file survives crashes and can
+be read while the recorder is running.
+
+Each record has the time.time() and time.monotonic() times, what
+happened (a command sent, a reply, a lost reply, or a port opening), the
+bus, the address, the reply's latency, and the frame. Frames longer than
+RECORD_DATA bytes go on in the records after it.
+
+The bus is a small number the recorder gives each port when it opens, so
+frames on several ports can be told apart, and each command paired with
+the reply on its own port. The port opening record names the port.
+
+Monotonic times only compare within a session, as a recording may hold
+several runs, and several boots. A session ends where a port opens again.
+
+Record with:
+    syringe_recorder.install('/var/tmp/syringe-pump.ring')
+or the --record option of syringe_pump_controller.py, syringe_cli.py and
+syringe_server.py. Then look at it, or send the same commands to an
+emulator with the same timing:
+
+    python3 syringe_recorder.py dump /var/tmp/syringe-pump.ring
+    python3 syringe_recorder.py replay /var/tmp/syringe-pump.ring
+
+Each port is replayed against an emulator of its own, or against the
+device given for it with --port RECORDED=DEVICE.
+
+"""
+import os
+import sys
+import time
+import mmap
+import math
+import struct
+import argparse
+import datetime
+import threading
+import collections
+import concurrent.futures
+
+MAGIC=b'SPFR'
+VERSION=3
+#magic, version, record size, record count, records written
+_HEADER=struct.Struct('<4sHHIQ')
+HEADER_SIZE=64
+#time.time(), time.monotonic(), latency, sequence number, kind, bus,
+# address, frame length
+_RECORD=struct.Struct('<ddfIBBBH')
+RECORD_SIZE=128
+RECORD_DATA=RECORD_SIZE-_RECORD.size
+#1 MiB, about 8000 frames
+DEFAULT_SIZE=HEADER_SIZE+8191*RECORD_SIZE
+
+#record kinds
+TX=0
+RX=1
+LOST=2
+OPEN=3
+#the next RECORD_DATA bytes of the frame in the record before
+MORE=4
+KINDS={TX: 'tx', RX: 'rx', LOST: 'lost', OPEN: 'open'}
+
+#wall is time.time() and time is time.monotonic(). bus is the number given
+# to the port when it opened. data is shorter than length if the end of
+# the frame was overwritten.
+Record=collections.namedtuple('Record', ['seq', 'wall', 'time', 'kind', 'bus', 'address', 'latency', 'length', 'data'])
+
+class FlightRecorder:
+    """Ring of the latest frames, in a memory-mapped file.
+
+    Opening an existing recording with the same size keeps its records
+    and adds after them.
+    """
+
+    def __init__(self, path, size=DEFAULT_SIZE):
+        """
+        Args:
+            path (str): the ring file. Created if needed.
+            size (int): file size in bytes.
+
+        """
+        self.path=path
+        self.count=(size-HEADER_SIZE)//RECORD_SIZE
+        if self.count<1:
+            raise ValueError("a recording needs room for at least one record")
+        size=HEADER_SIZE+self.count*RECORD_SIZE
+        self._lock=threading.Lock()
+        fd=os.open(path, os.O_RDWR|os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size!=size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self._map=mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, version, record_size, count, written=_HEADER.unpack_from(self._map, 0)
+        if (magic, version, record_size, count)!=(MAGIC, VERSION, RECORD_SIZE, self.count):
+            written=0
+        self.written=written
+        #port -> bus number, 1 to 255
+        self._bus_numbers={}
+        _HEADER.pack_into(self._map, 0, MAGIC, VERSION, RECORD_SIZE, self.count, self.written)
+
+    def bus_number(self, port):
+        """The bus number frames on port are recorded with."""
+        with self._lock:
+            bus=self._bus_numbers.get(port)
+            if bus is None:
+                bus=self._bus_numbers[port]=len(self._bus_numbers)%255+1
+            return bus
+
+    def record(self, kind, bus, address, data, t, latency=float('nan')):
+        """Adds one record, overwriting the oldest once the ring is full.
+
+        Args:
+            kind (int): TX, RX, LOST or OPEN.
+            bus (int): bus number, from bus_number().
+            address (str): the address symbol, e.g. '1' or 'A'.
+            data (bytes): the frame.
+            t (float): time.monotonic() time.
+            latency (float): seconds from the command to its reply.
+
+        """
+        a=ord(address[:1]) if address else 0
+        wall=time.time()
+        with self._lock:
+            length=len(data)
+            start=0
+            while True:
+                offset=HEADER_SIZE+(self.written%self.count)*RECORD_SIZE
+                _RECORD.pack_into(self._map, offset, wall, t, latency, self.written&0xffffffff, kind, bus, a, length)
+                end=offset+_RECORD.size
+                chunk=data[start:start+RECORD_DATA]
+                self._map[end:end+len(chunk)]=chunk
+                self.written+=1
+                start+=RECORD_DATA
+                if start>=len(data):
+                    break
+                kind=MORE
+                length=len(data)-start
+            struct.pack_into('<Q', self._map, 12, self.written)
+
+    def tx(self, port, message, t):
+        """Records a command as it goes out on port, e.g. '/1?0'."""
+        self.record(TX, self.bus_number(port), message[1:2], message.encode('utf-8'), t)
+
+    def rx(self, port, message, frame, t, latency):
+        """Records the reply frame to a command."""
+        self.record(RX, self.bus_number(port), message[1:2], frame, t, latency)
+
+    def lost(self, port, message, t, latency):
+        """Records that a command got no complete reply."""
+        self.record(LOST, self.bus_number(port), message[1:2], b'', t, latency)
+
+    def opened(self, port, baud, t):
+        self.record(OPEN, self.bus_number(port), '', (str(port)+" "+str(baud)).encode('utf-8'), t)
+
+    def close(self):
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+
+
+def install(path, size=DEFAULT_SIZE):
+    """Records every SerialBus in this process to path. Returns the FlightRecorder."""
+    import syringe_motor
+    recorder=FlightRecorder(path, size)
+    syringe_motor.SerialBus.recorder=recorder
+    return recorder
+
+def read_records(path):
+    """Reads a recording.
+
+    Returns:
+        Records oldest first, with long frames put back together.
+
+    Raises:
+        ValueError: if path isn't a recording.
+
+    """
+    with open(path, 'rb') as f:
+        buf=f.read()
+    if len(buf)<HEADER_SIZE:
+        raise ValueError(path+" is not a flight recording")
+    magic, version, record_size, count, written=_HEADER.unpack_from(buf, 0)
+    if magic!=MAGIC or record_size!=RECORD_SIZE:
+        raise ValueError(path+" is not a flight recording")
+    if version!=VERSION:
+        raise ValueError(path+" is a version "+str(version)+" flight recording. This reads version "+str(VERSION)+".")
+    records=[]
+    #sequence number a MORE record needs to continue the last record
+    more=None
+    for n in range(max(0, written-count), written):
+        offset=HEADER_SIZE+(n%count)*RECORD_SIZE
+        if offset+RECORD_SIZE>len(buf):
+            break
+        wall, t, latency, seq, kind, bus, address, length=_RECORD.unpack_from(buf, offset)
+        if seq!=n&0xffffffff:
+            #torn by a crash mid-write
+            more=None
+            continue
+        start=offset+_RECORD.size
+        data=buf[start:start+min(length, RECORD_DATA)]
+        if kind==MORE:
+            #the start of the frame may have been overwritten already
+            if more==n:
+                records[-1]=records[-1]._replace(data=records[-1].data+data)
+                more=n+1
+            continue
+        records.append(Record(n, wall, t, kind, bus, chr(address) if address else '',
+                              None if math.isnan(latency) else latency, length, data))
+        more=n+1
+    return records
+
+def sessions(records):
+    """Splits records into runs whose time.monotonic() times compare.
+
+    A run may use several ports. A new session starts where a bus already
+    seen in the run opens again, as after a restart, which numbers the
+    buses from 1 again. And wherever the times go backwards, e.g. at a
+    reboot whose opening was overwritten. Frames on different ports may
+    be recorded a little out of order, so times are compared on each bus,
+    and with the start of the run.
+    """
+    runs=[]
+    for r in records:
+        if not runs or (r.kind==OPEN and r.bus in last) or r.time<last.get(r.bus, runs[-1][0].time):
+            runs.append([])
+            last={}
+        runs[-1].append(r)
+        last[r.bus]=r.time
+    return runs
+
+def pair_replies(run):
+    """Pairs each command in a session with its reply.
+
+    A bus sends one command at a time, so the reply to a command is the
+    next record on the same bus, if that is a reply or a lost reply.
+
+    Returns:
+        (command, reply or None) for each TX record, in order.
+
+    """
+    pairs=[]
+    #bus -> index in pairs of its command still waiting for a reply
+    waiting={}
+    for r in run:
+        k=waiting.pop(r.bus, None)
+        if r.kind==TX:
+            waiting[r.bus]=len(pairs)
+            pairs.append((r, None))
+        elif r.kind in (RX, LOST) and k is not None and pairs[k][0].address==r.address:
+            pairs[k]=(pairs[k][0], r)
+    return pairs
+
+def port_names(records):
+    """The port and baud rate each bus of a session opened with.
+
+    Returns:
+        dict of bus number to (port, baud). A bus whose opening was
+        overwritten is called '#<bus>', with baud None.
+
+    """
+    names={}
+    for r in records:
+        if r.kind==OPEN:
+            port, _, baud=r.data.decode('utf-8', 'replace').rpartition(" ")
+            names[r.bus]=(port, int(baud) if baud.isdigit() else None)
+        elif r.bus not in names:
+            names[r.bus]=("#"+str(r.bus), None)
+    return names
+
+def format_record(record):
+    """One line describing a record."""
+    stamp=datetime.datetime.fromtimestamp(record.wall).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    latency="" if record.latency is None else "%8.2fms"%(record.latency*1000)
+    data=record.data.decode('utf-8', 'backslashreplace')
+    if record.length>len(record.data):
+        data+="...(%d bytes)"%record.length
+    return "%s %8d %-4s %3d %1s %10s %r"%(stamp, record.seq, KINDS.get(record.kind, '?'), record.bus, record.address,
+                                          latency, data)
+
+def replay(records, ports=None, baud=None, speed=1.0, out=sys.stdout):
+    """Sends the recorded commands again with the same timing, and compares the replies.
+
+    Each port's commands go out on their own port, from a thread of their
+    own, so a slow reply on one port doesn't hold up the others. Each
+    session is replayed straight after the one before, without the time
+    between them.
+
+    Args:
+        records: Records, as from read_records.
+        ports (dict): recorded port -> the device to replay its commands
+            against. Recorded ports not in it get a syringe_emulator with
+            the addresses that answered on them.
+        baud (int): None uses the baud rate recorded when each port opened.
+        speed (float): how many times faster than recorded to replay.
+
+    Returns:
+        dict summing up the replay: frames sent, replies that differ,
+        how late the sends were, and recorded and replayed latencies in ms.
+
+    """
+    import syringe_motor
+    import syringe_emulator
+    ports=dict(ports or {})
+    #session number -> recorded port -> [(command, its reply or None)]
+    runs=[]
+    bauds={}
+    for run in sessions(records):
+        names=port_names(run)
+        for port, port_baud in names.values():
+            if port_baud is not None or port not in bauds:
+                bauds[port]=port_baud
+        commands=collections.OrderedDict()
+        for r, reply in pair_replies(run):
+            if r.length>len(r.data):
+                print("skipping truncated command %d"%r.seq, file=out)
+                continue
+            commands.setdefault(names[r.bus][0], []).append((r, reply))
+        if commands:
+            runs.append(commands)
+    if not runs:
+        return {'frames': 0}
+
+    emulators=[]
+    buses={}
+    try:
+        for port in sorted(set(port for commands in runs for port in commands)):
+            port_baud=baud or bauds.get(port) or 9600
+            device=ports.get(port)
+            if device is None:
+                #only the addresses that answered in the recording
+                addresses=sorted(set(r.address for commands in runs for r, reply in commands.get(port, ())
+                                     if reply is not None and reply.kind==RX))
+                emulator=syringe_emulator.Emulator(''.join(addresses) or '1', baud=port_baud, time_scale=speed)
+                emulators.append(emulator)
+                device=emulator.start()
+            bus=syringe_motor.SerialBus(device, port_baud)
+            bus.open()
+            buses[port]=bus
+
+        results=[]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(buses)) as pool:
+            for commands in runs:
+                t0=time.monotonic()
+                first=min(pairs[0][0].time for pairs in commands.values())
+                futures=[pool.submit(_replay_port, buses[port], pairs, t0, first, speed, out)
+                         for port, pairs in commands.items()]
+                results.extend(future.result() for future in futures)
+    finally:
+        for bus in buses.values():
+            bus.close()
+        for emulator in emulators:
+            emulator.stop()
+
+    def stats(values):
+        if not values:
+            return None
+        return {'mean': sum(values)/len(values), 'max': max(values)}
+    return {
+        'frames': sum(len(pairs) for commands in runs for pairs in commands.values()),
+        'replies_differ': sum(x['differ'] for x in results),
+        'late_ms': stats([x*1000 for result in results for x in result['late']]),
+        'recorded_latency_ms': stats([x for result in results for x in result['recorded_ms']]),
+        'replayed_latency_ms': stats([x for result in results for x in result['replayed_ms']]),
+    }
+
+def _replay_port(bus, pairs, t0, first, speed, out):
+    """Replays one port's commands of a session, for replay()."""
+    import syringe_motor
+    result={'late': [], 'differ': 0, 'recorded_ms': [], 'replayed_ms': []}
+    for r, reply in pairs:
+        deadline=t0+(r.time-first)/speed
+        time.sleep(max(0, deadline-time.monotonic()))
+        message=r.data.decode('utf-8')
+        if r.address in syringe_motor.GROUP_ADDRESSES:
+            bus.sendBroadcast(message)
+            result['late'].append(bus.last_write-deadline)
+            continue
+        response=bus.sendCommand(message)
+        result['late'].append(bus.last_write-deadline)
+        got=None
+        if response is not None:
+            result['replayed_ms'].append((time.monotonic()-bus.last_write)*1000)
+            got=(response.status, response.data)
+        expected=None
+        if reply is not None and reply.kind==RX:
+            result['recorded_ms'].append(reply.latency*1000)
+            frame, _=syringe_motor.find_frame(reply.data)
+            if frame is not None:
+                response=syringe_motor.Response.from_frame(frame)
+                expected=(response.status, response.data)
+        if reply is not None and got!=expected:
+            result['differ']+=1
+            print("%d %s on %s: recorded %r, replayed %r"%(r.seq, message, bus.port, expected, got), file=out)
+    return result
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description="Read or replay a serial flight recording.")
+    sub=parser.add_subparsers(dest='command')
+    sub.required=True
+    p=sub.add_parser('dump', help="print the recorded frames, oldest first")
+    p.add_argument('recording')
+    p.add_argument('--last', type=int, help="only the last N frames")
+    p=sub.add_parser('replay', help="send the recorded commands again, with the recorded timing")
+    p.add_argument('recording')
+    p.add_argument('--port', action='append', default=[], metavar='[RECORDED=]DEVICE',
+                   help="device to replay a recorded port's commands against, e.g. /dev/ttyUSB0=/dev/ttyUSB1. "
+                        "Just DEVICE if one port was recorded. Ports not given get an emulator")
+    p.add_argument('--baud', type=int, help="defaults to the recorded baud rate")
+    p.add_argument('--speed', type=float, default=1.0, help="times faster than recorded")
+    args=parser.parse_args(argv)
+
+    try:
+        records=read_records(args.recording)
+    except (ValueError, EnvironmentError) as e:
+        print("err: "+str(e), file=sys.stderr)
+        return 1
+    if args.command=='dump':
+        for r in records[-args.last:] if args.last else records:
+            print(format_record(r))
+        return 0
+    ports={}
+    recorded=set(port for run in sessions(records) for port, baud in port_names(run).values())
+    for arg in args.port:
+        port, _, device=arg.rpartition("=")
+        if not port:
+            if len(recorded)!=1:
+                print("err: the recording has %d ports. Give --port RECORDED=DEVICE"%len(recorded), file=sys.stderr)
+                return 1
+            port=next(iter(recorded))
+        ports[port]=device
+    result=replay(records, ports, args.baud, args.speed)
+    for key, value in result.items():
+        print("%s: %s"%(key, value))
+    return 1 if result.get('replies_differ') else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
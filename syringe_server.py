@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""JSON-RPC server that shares one serial port between many local clients.
+
+Only one process can own a port, so this one does, and LIMS, dashboards
+and scripts talk to it instead. Requests and replies are JSON-RPC 2.0
+objects, one per line, over a Unix socket or a localhost TCP port.
+
+Reads are coalesced: identical queries that arrive while one is on the
+wire wait for its answer, and answers are reused for one tick. Ten clients
+polling positions cost the bus about what one does. Moves and stops drop
+the cached answers for their pump.
+
+Example:
+    python3 syringe_server.py --port /dev/ttyUSB0 --socket /tmp/syringe-pump.sock
+
+The socket is made readable and writable by its owner only, or with
+--shared by its group too.
+
+    $ echo '{"jsonrpc":"2.0","id":1,"method":"position","params":{"pump":"1"}}' | nc -U /tmp/syringe-pump.sock
+    {"jsonrpc": "2.0", "id": 1, "result": 1073741824}
+
+Methods:
+    pumps()                                 pump numbers in the group
+    position(pump), positions()             steps
+    status(pump)                            {"ready", "error", "error_text"}
+    inject(pump, ml, secs), draw(...)       position moved to
+    pump(pump, ml, pull_secs, push_secs, top_wait_ms=0, bottom_wait_ms=0, repeats=1)
+    stop(pump), stop_all()
+    stats()                                 queries asked for and sent
+
+"""
+import os
+import sys
+import json
+import stat
+import asyncio
+import argparse
+import serial
+import syringe_motor
+import syringe_motor_async
+
+#seconds an answer is reused for
+TICK=0.05
+#who may connect to the Unix socket: the owner, or with --shared the group too
+SOCKET_MODE=0o600
+SHARED_SOCKET_MODE=0o660
+
+#JSON-RPC error codes
+PARSE_ERROR=-32700
+INVALID_REQUEST=-32600
+METHOD_NOT_FOUND=-32601
+INVALID_PARAMS=-32602
+PUMP_ERROR=-32000
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        super(RPCError, self).__init__(message)
+        self.code=code
+
+class QueryCache:
+    """Shares in-flight and recent answers between identical queries.
+
+    Keys are (query, pump). Each pump has a generation that invalidate()
+    bumps, so an answer that was already on its way when the pump was
+    told to move isn't cached.
+    """
+
+    def __init__(self, tick=TICK):
+        self.tick=tick
+        #key -> (loop time, answer)
+        self._answers={}
+        #key -> future of the query on the wire
+        self._inflight={}
+        self._generation={}
+        #queries asked for, and queries actually sent
+        self.requests=0
+        self.fetches=0
+
+    async def get(self, key, fetch):
+        """Returns a recent answer for key, or awaits fetch() for a new one."""
+        loop=asyncio.get_running_loop()
+        self.requests+=1
+        answer=self._answers.get(key)
+        if answer is not None and loop.time()-answer[0]<self.tick:
+            return answer[1]
+        future=self._inflight.get(key)
+        if future is None:
+            self.fetches+=1
+            future=asyncio.ensure_future(fetch())
+            self._inflight[key]=future
+            generation=self._generation.get(key[1], 0)
+            future.add_done_callback(lambda f: self._fetched(key, generation, f))
+        #one client giving up mustn't cancel the query for the others
+        return await asyncio.shield(future)
+
+    def _fetched(self, key, generation, future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        if future.cancelled() or future.exception() is not None:
+            return
+        if self._generation.get(key[1], 0)==generation:
+            self._answers[key]=(asyncio.get_running_loop().time(), future.result())
+
+    def invalidate(self, pump):
+        """Forgets answers about pump, e.g. once it has been told to move."""
+        self._generation[pump]=self._generation.get(pump, 0)+1
+        for key in [k for k in self._answers if k[1]==pump]:
+            del self._answers[key]
+        for key in [k for k in self._inflight if k[1]==pump]:
+            #later callers get a fresh query
+            del self._inflight[key]
+
+
+class PumpServer:
+    """Serves a MotorGroup's pumps over JSON-RPC."""
+
+    def __init__(self, motorGroup, tick=TICK, calibration=None):
+        """
+        Args:
+            motorGroup (syringe_motor.MotorGroup): pumps to serve.
+            tick (float): seconds an answer is reused for.
+            calibration (str): xml file positions are saved to after moves.
+
+        """
+        self.motorGroup=motorGroup
+        self.group=syringe_motor_async.AsyncMotorGroup(motorGroup)
+        self.cache=QueryCache(tick)
+        self.calibration=calibration
+        self.methods={
+            'pumps': self.pumps,
+            'position': self.position,
+            'positions': self.positions,
+            'status': self.status,
+            'inject': self.inject,
+            'draw': self.draw,
+            'pump': self.pump,
+            'stop': self.stop,
+            'stop_all': self.stop_all,
+            'stats': self.stats,
+        }
+
+    async def connect(self, port, baud=9600):
+        return await self.group.connect(port, baud)
+
+    def _motor(self, pump):
+        key=self.motorGroup.pump_key(str(pump))
+        motor=self.group.motordict.get(key)
+        if motor is None:
+            raise RPCError(INVALID_PARAMS, "pump "+str(pump)+" does not exist")
+        return key, motor
+
+    def _moved(self, key):
+        self.cache.invalidate(key)
+        if self.calibration is not None:
+            self.motorGroup.mark_dirty(key)
+            self.motorGroup.save_later(self.calibration)
+
+    async def pumps(self):
+        return sorted(self.group.motordict.keys())
+
+    async def position(self, pump):
+        key, motor=self._motor(pump)
+        return await self.cache.get(('position', key), motor.query_position)
+
+    async def positions(self):
+        keys=sorted(self.group.motordict.keys())
+        results=await asyncio.gather(*(self.position(k) for k in keys), return_exceptions=True)
+        return dict((k, None if isinstance(r, Exception) else r) for k, r in zip(keys, results))
+
+    async def status(self, pump):
+        key, motor=self._motor(pump)
+        async def fetch():
+            response=await motor.sendCommand("Q")
+            if response is None:
+                raise IndexError("motor did not respond")
+            return {'ready': response.ready, 'error': response.error, 'error_text': response.error_text}
+        return await self.cache.get(('status', key), fetch)
+
+    async def inject(self, pump, ml, secs):
+        key, motor=self._motor(pump)
+        try:
+            target, warnings=await motor.inject(float(ml), float(secs))
+        finally:
+            #a rejected A may still have come after an accepted V
+            self._moved(key)
+        return {'target': target, 'warnings': warnings}
+
+    async def draw(self, pump, ml, secs):
+        return await self.inject(pump, -float(ml), secs)
+
+    async def pump(self, pump, ml, pull_secs, push_secs, top_wait_ms=0, bottom_wait_ms=0, repeats=1):
+        import syringe_program
+        key, motor=self._motor(pump)
+        #the cycle starts from where the motor is, so no other move may come between
+        async with motor.move_lock:
+            await motor.query_position()
+            exe, warnings=syringe_program.cycle_program(motor.motor, float(ml), float(pull_secs), float(top_wait_ms),
+                                                        float(push_secs), float(bottom_wait_ms), float(repeats))
+            try:
+                await motor.accepted(motor.motor.program_body(exe)+"R")
+            finally:
+                self._moved(key)
+        return {'program': exe, 'warnings': warnings}
+
+    async def stop(self, pump):
+        key, motor=self._motor(pump)
+        await motor.stop()
+        self._moved(key)
+        return await self.position(key)
+
+    async def stop_all(self):
+        await self.group.stop_all()
+        for key in self.group.motordict:
+            self._moved(key)
+        return await self.positions()
+
+    async def stats(self):
+        return {'requests': self.cache.requests, 'fetches': self.cache.fetches}
+
+    async def call(self, request):
+        """Runs one decoded JSON-RPC request. Returns the reply, or None for notifications."""
+        if not isinstance(request, dict) or request.get('jsonrpc')!='2.0' or 'method' not in request:
+            return _error(None, INVALID_REQUEST, "invalid request")
+        rid=request.get('id')
+        method=self.methods.get(request['method'])
+        if method is None:
+            return _error(rid, METHOD_NOT_FOUND, "no method "+str(request['method']))
+        params=request.get('params', {})
+        try:
+            if isinstance(params, dict):
+                result=await method(**params)
+            elif isinstance(params, list):
+                result=await method(*params)
+            else:
+                raise TypeError("params must be an object or a list")
+        except RPCError as e:
+            return _error(rid, e.code, str(e))
+        except TypeError as e:
+            return _error(rid, INVALID_PARAMS, str(e))
+        except (ValueError, IndexError, serial.serialutil.SerialException) as e:
+            return _error(rid, PUMP_ERROR, str(e))
+        if 'id' not in request:
+            return None
+        return {'jsonrpc': '2.0', 'id': rid, 'result': result}
+
+    async def handle_client(self, reader, writer):
+        """Answers one connection's requests, one per line, as they come in."""
+        async def answer(line):
+            try:
+                request=json.loads(line)
+            except ValueError:
+                reply=_error(None, PARSE_ERROR, "parse error")
+            else:
+                reply=await self.call(request)
+            if reply is not None:
+                writer.write((json.dumps(reply)+"\n").encode('utf-8'))
+
+        pending=set()
+        try:
+            while True:
+                line=await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    #requests on one connection don't wait for each other
+                    task=asyncio.ensure_future(answer(line))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.wait(pending)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path=None, host='127.0.0.1', port=None, socket_mode=SOCKET_MODE):
+        """Listens on a Unix socket, or on host:port if socket_path is None.
+
+        A socket left at socket_path by an earlier run is replaced, but
+        anything else there is left alone.
+
+        Args:
+            socket_mode (int): permissions for the socket. Anyone who can
+                connect can move the pumps.
+
+        Raises:
+            FileExistsError: if socket_path is something other than a socket.
+
+        """
+        if socket_path is not None:
+            try:
+                st=os.lstat(socket_path)
+            except FileNotFoundError:
+                pass
+            else:
+                if not stat.S_ISSOCK(st.st_mode):
+                    raise FileExistsError(socket_path+" exists and is not a socket")
+                os.unlink(socket_path)
+            listener=await asyncio.start_unix_server(self.handle_client, path=socket_path)
+            os.chmod(socket_path, socket_mode)
+            return listener
+        return await asyncio.start_server(self.handle_client, host, port)
+
+def _error(rid, code, message):
+    return {'jsonrpc': '2.0', 'id': rid, 'error': {'code': code, 'message': message}}
+
+async def _main(args):
+    motorGroup=syringe_motor.MotorGroup()
+    motorGroup.load(args.calibration)
+    if not motorGroup.motordict:
+        motorGroup.motordict['1']=syringe_motor.Motor()
+    server=PumpServer(motorGroup, args.tick, args.calibration)
+    ports=[args.port] if args.port else syringe_motor.scan_ports()
+    if not ports:
+        raise SystemExit("no adapters found. Use --port.")
+    await server.connect(ports[0], args.baud)
+    try:
+        listener=await server.serve(None if args.listen else args.socket, '127.0.0.1', args.listen,
+                                    SHARED_SOCKET_MODE if args.shared else SOCKET_MODE)
+    except FileExistsError as e:
+        raise SystemExit(str(e))
+    print("serving "+(args.socket if not args.listen else "127.0.0.1:"+str(args.listen)), file=sys.stderr)
+    try:
+        await listener.serve_forever()
+    finally:
+        motorGroup.flush()
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description="Share syringe pumps with local clients over JSON-RPC.")
+    parser.add_argument('--port', help="serial device. Defaults to the first known adapter")
+    parser.add_argument('--baud', type=int, default=9600)
+    parser.add_argument('--calibration', default='syringe_pump_data.xml')
+    parser.add_argument('--socket', default='/tmp/syringe-pump.sock', help="unix socket to listen on")
+    parser.add_argument('--shared', action='store_true', help="let the socket's group connect, not only its owner")
+    parser.add_argument('--listen', type=int, metavar='TCP_PORT', help="listen on localhost instead of a socket")
+    parser.add_argument('--tick', type=float, default=TICK, help="seconds answers are reused for")
+    parser.add_argument('--record', metavar='FILE', help="keep a flight recording of serial traffic, see syringe_recorder.py")
+    args=parser.parse_args(argv)
+    if args.record:
+        import syringe_recorder
+        syringe_motor_async.AsyncSerialBus.recorder=syringe_recorder.install(args.record)
+    try:
+        asyncio.run(_main(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+import threading
+import time
+import collections
+import numpy as np
+
+Snapshot=collections.namedtuple('Snapshot', ['time', 'position', 'reported_velocity', 'velocity'])
+
+class TelemetrySampler(threading.Thread):
+    """Polls a motor's position and reported velocity in the background.
+
+    Samples of (time, position, reported velocity) go into a fixed-size
+    ring buffer, so readers get the latest values from memory instead of
+    waiting on the serial port. The velocity in a snapshot is a least
+    squares fit over the last few positions, which is far more accurate
+    than timing two back-to-back queries.
+
+    The port is only polled while the motor may be moving. Once its last
+    reply and its motion model both say it is idle, samples come from
+    the model, which stays put until a command moves the motor.
+
+    Example:
+        sampler=TelemetrySampler(motor, rate=5)
+        sampler.start()
+        ...
+        snap=sampler.snapshot()
+        sampler.stop()
+
+    """
+
+    def __init__(self, motor, rate=5.0, size=1024, window=8):
+        """
+        Args:
+            motor (syringe_motor.Motor): the motor to poll.
+            rate (float): samples per second.
+            size (int): number of samples kept.
+            window (int): number of samples used for the velocity fit.
+
+        """
+        super(TelemetrySampler, self).__init__()
+        self.daemon=True
+        self.motor=motor
+        self.rate=rate
+        self.window=window
+
+        #columns: monotonic time (s), position (steps), reported velocity (steps/s)
+        self._ring=np.zeros((size,3))
+        self._next=0
+        self._count=0
+        self._lock=threading.Lock()
+        self._stop_event=threading.Event()
+
+    def stop(self):
+        """Stops polling. The buffered samples stay readable."""
+        self._stop_event.set()
+
+    def run(self):
+        period=1.0/self.rate
+        next_time=time.monotonic()
+        while not self._stop_event.is_set():
+            try:
+                self.sample()
+            except Exception:
+                #port closed or busy. Try again next period.
+                pass
+            next_time+=period
+            self._stop_event.wait(max(0, next_time-time.monotonic()))
+
+    def sample(self):
+        """Queries the motor once and stores the result.
+
+        An idle motor isn't queried. Its predicted position is stored,
+        with a velocity of 0.
+
+        Returns:
+            True if both queries were answered, or the motor is idle.
+
+        """
+        t=time.monotonic()
+        position, busy=self.motor.model.predict(t)
+        if busy is False and position is not None and self.motor.busy is False:
+            self._store(t, position, 0)
+            return True
+
+        address=self.motor.motor_address
+        pos_response=self.motor.sendCommand("/"+address+"?0")
+        t=time.monotonic()
+        vel_response=self.motor.sendCommand("/"+address+"?2")
+        if pos_response is None or vel_response is None:
+            return False
+        pos=pos_response.integer()
+        vel=vel_response.integer()
+        if pos is None or vel is None:
+            return False
+
+        #?2 reports velocity in units of 32 microsteps/sec
+        self._store(t, pos, vel*32)
+        return True
+
+    def _store(self, t, position, velocity):
+        with self._lock:
+            self._ring[self._next]=(t, position, velocity)
+            self._next=(self._next+1)%len(self._ring)
+            self._count=min(self._count+1, len(self._ring))
+
+    def history(self, n=None):
+        """Returns up to n of the latest samples, oldest first, as an (n, 3) array."""
+        with self._lock:
+            if n is None or n>self._count:
+                n=self._count
+            idx=(self._next-n+np.arange(n))%len(self._ring)
+            return self._ring[idx].copy()
+
+    def snapshot(self):
+        """Returns the latest Snapshot, or None if nothing has been sampled yet.
+
+        velocity is None until two samples are available.
+        """
+        h=self.history(self.window)
+        if len(h)==0:
+            return None
+        t, pos, rep=h[-1]
+        return Snapshot(float(t), int(pos), float(rep), fit_velocity(h[:,0], h[:,1]))
+
+def fit_velocity(t, pos):
+    """Least squares slope of position over time, in steps/s, or None."""
+    if len(t)<2:
+        return None
+    dt=t-t.mean()
+    denom=np.dot(dt, dt)
+    if denom==0:
+        return None
+    return float(np.dot(dt, pos-pos.mean())/denom)
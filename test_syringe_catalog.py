@@ -0,0 +1,98 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Calibration file catalog, rescanned as files change."""
+import os
+import shutil
+import pytest
+import syringe_catalog
+from syringe_catalog import CalibrationCatalog, sniff_root
+
+CALIBRATION=b'<?xml version="1.0"?>\n<constants><motor/></constants>'
+OTHER=b'<?xml version="1.0"?>\n<settings><motor/></settings>'
+
+def touch(path, later=1):
+    """Moves path's mtime on, as the clock may not have ticked."""
+    st=os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns+later*1000000000))
+
+@pytest.fixture
+def tree(tmp_path):
+    (tmp_path/'a.xml').write_bytes(CALIBRATION)
+    (tmp_path/'b.xml').write_bytes(OTHER)
+    (tmp_path/'notes.txt').write_bytes(CALIBRATION)
+    (tmp_path/'.a.xml.tmp').write_bytes(CALIBRATION)
+    (tmp_path/'runs'/'day1').mkdir(parents=True)
+    (tmp_path/'runs'/'day1'/'c.XML').write_bytes(CALIBRATION)
+    (tmp_path/'.git').mkdir()
+    (tmp_path/'.git'/'d.xml').write_bytes(CALIBRATION)
+    return tmp_path
+
+@pytest.fixture
+def sniffed(monkeypatch):
+    """Paths sniff_root opens."""
+    paths=[]
+    def counting(path):
+        paths.append(os.path.basename(path))
+        return sniff_root(path)
+    monkeypatch.setattr(syringe_catalog, 'sniff_root', counting)
+    return paths
+
+def test_sniff_root(tree):
+    assert sniff_root(str(tree/'a.xml'))=='constants'
+    assert sniff_root(str(tree/'b.xml'))=='settings'
+    (tree/'broken.xml').write_bytes(b'not xml')
+    assert sniff_root(str(tree/'broken.xml')) is None
+    assert sniff_root(str(tree/'missing.xml')) is None
+
+def test_scan(tree, sniffed):
+    catalog=CalibrationCatalog(str(tree))
+    assert catalog.scan()==['a.xml', os.path.join('runs', 'day1', 'c.XML')]
+    assert sorted(sniffed)==['a.xml', 'b.xml', 'c.XML']
+    #nothing changed, so nothing is opened
+    del sniffed[:]
+    assert catalog.scan()==['a.xml', os.path.join('runs', 'day1', 'c.XML')]
+    assert sniffed==[]
+
+def test_changed_files_are_read_again(tree, sniffed):
+    catalog=CalibrationCatalog(str(tree))
+    catalog.scan()
+    del sniffed[:]
+    #a different size
+    (tree/'b.xml').write_bytes(CALIBRATION)
+    assert catalog.scan()==['a.xml', 'b.xml', os.path.join('runs', 'day1', 'c.XML')]
+    assert sniffed==['b.xml']
+    #the same size, but a newer mtime
+    del sniffed[:]
+    (tree/'a.xml').write_bytes(CALIBRATION.replace(b'constants', b'constantz'))
+    touch(tree/'a.xml')
+    assert catalog.scan()==['b.xml', os.path.join('runs', 'day1', 'c.XML')]
+    assert sniffed==['a.xml']
+
+def test_new_and_removed(tree, sniffed):
+    catalog=CalibrationCatalog(str(tree))
+    catalog.scan()
+    del sniffed[:]
+    (tree/'runs'/'day2').mkdir()
+    (tree/'runs'/'day2'/'e.xml').write_bytes(CALIBRATION)
+    touch(tree/'runs')
+    assert catalog.scan()==['a.xml', os.path.join('runs', 'day1', 'c.XML'), os.path.join('runs', 'day2', 'e.xml')]
+    assert sniffed==['e.xml']
+
+    shutil.rmtree(str(tree/'runs'/'day1'))
+    touch(tree/'runs', 2)
+    assert catalog.scan()==['a.xml', os.path.join('runs', 'day2', 'e.xml')]
+    #forgotten, not just skipped
+    assert str(tree/'runs'/'day1') not in catalog._dirs
+    assert str(tree/'runs'/'day1'/'c.XML') not in catalog._files
+
+def test_unchanged_directory_is_not_listed(tree, monkeypatch):
+    catalog=CalibrationCatalog(str(tree))
+    catalog.scan()
+    listed=[]
+    scandir=os.scandir
+    monkeypatch.setattr(syringe_catalog.os, 'scandir', lambda path: listed.append(path) or scandir(path))
+    catalog.scan()
+    assert listed==[]
+    (tree/'f.xml').write_bytes(CALIBRATION)
+    touch(tree)
+    assert 'f.xml' in catalog.scan()
+    assert listed==[str(tree)]
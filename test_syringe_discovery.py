@@ -0,0 +1,45 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Controller discovery on the emulator."""
+import syringe_motor
+from syringe_discovery import BusEntry, probe_port, discover, populate
+from conftest import BAUD
+
+def test_probe_port(emulator):
+    found=probe_port(emulator.slave_path, [9600, BAUD], ['1', '2', '3'])
+    assert [(e.baud, e.address) for e in found]==[(BAUD, '1'), (BAUD, '2')]
+    assert all(e.firmware for e in found)
+    #the probe's bus was never handed out, and is closed again
+    assert syringe_motor.SerialBus.find(emulator.slave_path) is None
+
+def test_probe_keeps_the_open_bus(emulator, motor):
+    #only the rate it's running at, so the motor isn't disturbed
+    found=probe_port(emulator.slave_path, [9600, BAUD], ['1', '2'])
+    assert [(e.baud, e.address) for e in found]==[(BAUD, '1'), (BAUD, '2')]
+    assert syringe_motor.SerialBus.find(emulator.slave_path) is motor.bus
+    assert motor.bus.srl_port.isOpen()
+    assert motor.getPosition(fresh=True)==0
+
+def test_discover_and_populate(emulator):
+    entries=discover([emulator.slave_path, '/dev/does-not-exist'], [BAUD])
+    assert [e.address for e in entries]==['1', '2']
+    group=syringe_motor.MotorGroup()
+    try:
+        assert populate(group, entries)==[]
+        assert set(group.motordict)=={'1', '2'}
+        assert group.bus is syringe_motor.SerialBus.find(emulator.slave_path)
+        assert group.motordict['2'].getPosition(fresh=True)==0
+    finally:
+        for m in group.motordict.values():
+            m.disconnect()
+
+def test_populate_skips_another_baud(emulator):
+    entries=[BusEntry(emulator.slave_path, BAUD, '1', ''), BusEntry(emulator.slave_path, 9600, '2', ''),
+             BusEntry(emulator.slave_path, BAUD, '1', '')]
+    group=syringe_motor.MotorGroup()
+    try:
+        assert populate(group, entries)==entries[1:]
+        assert list(group.motordict)==['1']
+        assert group.bus.srl_port.baudrate==BAUD
+    finally:
+        for m in group.motordict.values():
+            m.disconnect()
@@ -0,0 +1,92 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Reply framing and Response flags, checked against the emulator."""
+import time
+import pytest
+import syringe_motor
+import syringe_emulator
+from syringe_motor import find_frame, decode_frame, Response
+
+def test_find_frame_complete():
+    frame, rest=find_frame(b'\xff/0`1000\x03\r\n')
+    assert frame==b'`1000'
+    assert rest==b'\r\n'
+
+def test_find_frame_partial():
+    assert find_frame(b'garbage')==(None, b'')
+    #a '/' may be the start of the next frame
+    assert find_frame(b'xx/')==(None, b'/')
+    assert find_frame(b'/0`10')==(None, b'/0`10')
+
+def test_find_frame_two_frames():
+    frame, rest=find_frame(b'/0`1\x03/0@\x03')
+    assert frame==b'`1'
+    assert find_frame(rest)[0]==b'@'
+
+def test_decode_frame():
+    assert decode_frame(b'`1234')=='1234'
+    assert decode_frame(b'`\xff\xff')=='ff'
+
+def test_response_flags():
+    ready=Response.from_frame(b'`-12')
+    assert ready.ready and not ready.busy
+    assert ready.error==syringe_motor.ERR_NONE
+    assert ready.integer()==-12
+    assert ready.value==-12
+
+    busy=Response.from_frame(b'@')
+    assert busy.busy
+    assert busy.value is None
+
+    bad=Response.from_frame(bytes([0x40|syringe_motor.STATUS_READY|syringe_motor.ERR_BAD_COMMAND]))
+    assert bad.error==syringe_motor.ERR_BAD_COMMAND
+    assert bad.error_text=="bad command"
+    assert Response.from_frame(b'`EZHR17EN').value=='EZHR17EN'
+
+def test_emulator_replies(emulator, motor):
+    response=motor.sendCommand("/1?0")
+    assert response.ready and response.error==syringe_motor.ERR_NONE
+    assert response.integer()==int(emulator.motors['1'].current_position())
+
+    assert motor.sendCommand("/1XR").error==syringe_motor.ERR_BAD_COMMAND
+    assert motor.sendCommand("/1?7").error==syringe_motor.ERR_BAD_OPERAND
+
+def test_emulator_busy_while_moving(emulator, motor):
+    assert motor.sendCommand("/1V2000A1000R") is not None
+    assert motor.sendCommand("/1Q").busy
+    assert motor.wait_until_idle(timeout=5)
+    assert motor.getPosition(fresh=True)==1000
+
+def test_group_address_does_not_reply(emulator, motor):
+    #'A' is addresses 1 and 2
+    motor.bus.sendBroadcast("/AV5000A200R")
+    time.sleep(0.3)
+    for address in '12':
+        assert int(emulator.motors[address].current_position())==200
+
+def test_split_commands():
+    assert syringe_emulator.split_commands('gV100A0M500G3R')==[('g', 0), ('V', 100), ('A', 0), ('M', 500),
+                                                               ('G', 3), ('R', 0)]
+    with pytest.raises(ValueError):
+        syringe_emulator.split_commands('V100 R')
+
+def test_ramps_are_stepped():
+    motor=syringe_emulator.EmulatedMotor(accel_scale=1000.0, time_scale=10.0)
+    #the move starts somewhere between these two readings
+    early=motor.clock()
+    assert motor.handle('L1V1000A2000R')==(syringe_motor.ERR_NONE, b'')
+    late=motor.clock()
+    #1 s up to 1000 steps/s, 1 s cruising and 1 s slowing down
+    def expected(t):
+        if t<1:
+            return 500*t*t
+        if t<2:
+            return 500+1000*(t-1)
+        return 2000-500*max(0, 3-t)**2
+    for wait in (0.05, 0.1, 0.1):
+        time.sleep(wait)
+        before=motor.clock()-late
+        position=motor.current_position()
+        after=motor.clock()-early
+        assert expected(before)-5<=position<=expected(after)+5
+    time.sleep(0.1)
+    assert not motor.busy() and motor.current_position()==2000
@@ -0,0 +1,135 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Motion model predictions, checked against the emulator."""
+import math
+import time
+import pytest
+import syringe_motor
+import syringe_model
+import syringe_emulator
+from syringe_model import MotionModel, parse_tokens, trapezoid, trapezoid_time
+from conftest import BAUD
+
+def test_parse_tokens():
+    assert parse_tokens('gV100A0M500G3R')==[('g', 0), ('V', 100), ('A', 0), ('M', 500), ('G', 3), ('R', 0)]
+    assert parse_tokens('z-5R')==[('z', -5), ('R', 0)]
+    with pytest.raises(ValueError):
+        parse_tokens('V100 R')
+
+def test_trapezoid():
+    #reaches 1000 steps/s after 1 s and 500 steps, cruises 1 s, slows for 1 s
+    assert trapezoid(2000, 1000, 1000, 0.5)==(125, 3)
+    assert trapezoid(2000, 1000, 1000, 1.5)==(1000, 3)
+    assert trapezoid(2000, 1000, 1000, 3.5)==(2000, 3)
+    #too short to reach 1000 steps/s
+    assert trapezoid(250, 1000, 1000, 10)==(250, 1)
+    assert trapezoid(2000, 1000, math.inf, 1.5)==(1500, 2)
+    assert trapezoid(0, 1000, 1000, 1)==(0, 0)
+    for t in (0.3, 1.2, 2.9):
+        covered=trapezoid(2000, 1000, 1000, t)[0]
+        assert trapezoid_time(2000, 1000, 1000, covered)==pytest.approx(t)
+
+def test_instant_acceleration():
+    model=MotionModel(position=0)
+    model.command('V1000A5000R', 100.0)
+    assert model.predict(102.5)==(2500, True)
+    assert model.end_time()==pytest.approx(105)
+    assert model.predict(106)==(5000, False)
+
+def test_calibrated_acceleration():
+    model=MotionModel(position=0, accel_scale=1000.0)
+    model.command('L1V1000A2000R', 100.0)
+    assert model.end_time()==pytest.approx(103)
+    assert model.predict(100.5)==(125, True)
+    #the motor's accel_scale is its model's
+    motor=syringe_motor.Motor()
+    assert motor.accel_scale is None
+    motor.accel_scale=1000.0
+    assert motor.model.accel_scale==1000.0
+
+def test_loops_and_stored_programs():
+    model=MotionModel(position=0)
+    model.command('s11gV1000A1000M500V1000A0G2R', 100.0)
+    model.command('e11R', 100.0)
+    assert model.end_time()==pytest.approx(105)
+    assert model.predict(101.25)==(1000, True)
+    assert model.predict(102.5)[0]==pytest.approx(0)
+    #G0 loops forever
+    model.command('TR', 103.0)
+    assert model.predict(103.0)==(500, False)
+    model.command('gV1000A1000V1000A0G0R', 103.0)
+    assert model.end_time() is None
+    #0.5 s up to 1000, then 1.5 s a loop
+    assert model.predict(103.5+1.5*10+0.5)==(500, True)
+
+def test_drift():
+    model=MotionModel(position=0)
+    model.command('V1000A5000R', 100.0)
+    assert model.reconcile(5000, False, 106)==0
+    assert model.drifted is None
+    #moved behind the host's back
+    assert model.reconcile(6000, False, 107)==1000
+    assert model.drifted==1000
+    assert model.predict(108)==(6000, False)
+
+def test_late_start():
+    model=MotionModel(position=0)
+    model.command('V1000A5000R', 100.0)
+    #the motor started 0.3 s after the model thought
+    model.reconcile(1700, True, 102.0)
+    assert model.lag==pytest.approx(0.3)
+    assert model.drifted is None
+    assert model.predict(103.3)[0]==pytest.approx(3000)
+
+def test_accel_scale_calibration(tmp_path):
+    path=str(tmp_path/'calibration.xml')
+    group=syringe_motor.MotorGroup()
+    group.motordict['a']=syringe_motor.Motor()
+    group.motordict['a'].accel_scale=1234.5
+    group.motordict['b']=syringe_motor.Motor()
+    with open(path, 'wb') as f:
+        f.write(group.to_xml())
+    loaded=syringe_motor.MotorGroup()
+    loaded.load(path)
+    assert loaded.motordict['a'].accel_scale==1234.5
+    assert loaded.motordict['b'].accel_scale is None
+
+def worst_error(emulator, motor, command, seconds):
+    """Largest difference between the model and the emulator while command runs."""
+    motor.getPosition(fresh=True)
+    motor.sendRawCommand(command)
+    worst=0
+    end=time.monotonic()+seconds
+    while time.monotonic()<end:
+        predicted=motor.predicted_position()
+        worst=max(worst, abs(predicted-emulator.motors['1'].current_position()))
+        time.sleep(0.02)
+    return worst
+
+def test_prediction_on_the_emulator(emulator, motor):
+    motor.accel_scale=emulator.motors['1'].accel_scale
+    #accelerates for 0.4 s, cruises for 0.6 s
+    assert worst_error(emulator, motor, '/1L50V20000A20000R', 1.6)<300
+    assert motor.wait_until_idle(timeout=5)
+    assert motor.model.predict(time.monotonic())==(20000, False)
+    assert motor.model.drifted is None
+
+def test_instant_prediction_on_the_emulator(emulator, motor):
+    #without the calibration, the model runs ahead by about half the time
+    # the motor takes to get up to speed
+    worst=worst_error(emulator, motor, '/1L50V20000A20000R', 1.6)
+    assert 2000<worst<6000
+
+def test_measure_accel_scale():
+    emu=syringe_emulator.Emulator('1', baud=BAUD, accel_scale=1234.0)
+    emu.start()
+    motor=syringe_motor.Motor()
+    try:
+        motor.connect(emu.slave_path, BAUD, '1')
+        motor.sendCommand("/1z100000R")
+        assert motor.measure_accel_scale(5000, 400)==pytest.approx(1234, rel=0.05)
+        #back where it was, with the 'L' it had
+        assert motor.getPosition(fresh=True)==100000
+        assert emu.motors['1'].accel==syringe_model.DEFAULT_ACCEL
+    finally:
+        motor.disconnect()
+        emu.stop()
@@ -0,0 +1,368 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""SerialBus sharing and Motor behaviour, checked against the emulator."""
+import os
+import stat
+import time
+import threading
+import pytest
+import serial
+import syringe_motor
+import syringe_emulator
+from conftest import BAUD
+
+def test_motors_share_a_bus(emulator, motor):
+    other=syringe_motor.Motor()
+    other.connect(emulator.slave_path, BAUD, '2')
+    try:
+        assert other.bus is motor.bus
+        assert set(motor.bus.motors)=={'1', '2'}
+    finally:
+        other.disconnect()
+    #the port stays open for the motor still on it
+    assert motor.bus.srl_port.isOpen()
+    assert motor.sendCommand("/1Q") is not None
+
+def test_readdress_keeps_the_port_open(emulator, motor):
+    bus=motor.bus
+    motor.connect(emulator.slave_path, BAUD, '2')
+    assert motor.bus is bus and bus.srl_port.isOpen()
+    assert bus.motors=={'2': motor}
+    assert motor.motor_address=='2'
+
+def test_failed_probe_leaves_the_motor(emulator, motor):
+    with pytest.raises(serial.serialutil.SerialException):
+        motor.connect(emulator.slave_path, BAUD, '5')
+    assert motor.motor_address=='1'
+    assert motor.bus.motors=={'1': motor}
+
+def test_last_motor_closes_the_bus(emulator):
+    motor=syringe_motor.Motor()
+    motor.connect(emulator.slave_path, BAUD, '1')
+    bus=motor.bus
+    motor.disconnect()
+    assert not bus.srl_port.isOpen()
+    assert emulator.slave_path not in syringe_motor.SerialBus._buses
+
+def test_baud_switch_races_attach(emulator):
+    """get() and attach()/detach() take the bus locks in the same order."""
+    bus=syringe_motor.SerialBus.get(emulator.slave_path, BAUD)
+    motor=syringe_motor.Motor()
+    done=threading.Event()
+    def churn():
+        #the only motor, so each detach closes the port and each attach reopens it
+        for i in range(300):
+            bus.attach(motor)
+            bus.detach(motor)
+        done.set()
+    thread=threading.Thread(target=churn, daemon=True)
+    thread.start()
+    while not done.is_set():
+        other=syringe_motor.SerialBus.get(emulator.slave_path, 57600 if bus.srl_port.baudrate==BAUD else BAUD)
+        if other is not bus:
+            other.close()
+        if not thread.is_alive():
+            break
+    assert done.wait(5)
+
+def test_group_addresses():
+    assert syringe_motor.group_addresses('12')==['A']
+    assert syringe_motor.group_addresses('123')==['A', '3']
+    assert syringe_motor.group_addresses('12345678')==['Q', 'U']
+    assert syringe_motor.group_addresses(set(syringe_motor.GROUP_ADDRESSES['_']))==['_']
+    #a group never reaches a motor outside the set
+    for symbols in ('13', '2', '1234567', '9:;<=>?'):
+        covered=''.join(syringe_motor.GROUP_ADDRESSES.get(a, a) for a in syringe_motor.group_addresses(symbols))
+        assert sorted(covered)==sorted(symbols)
+
+def test_is_motion():
+    assert syringe_motor.is_motion('A1000R')
+    assert syringe_motor.is_motion('R')
+    assert syringe_motor.is_motion('e11R')
+    assert not syringe_motor.is_motion('?0')
+    assert not syringe_motor.is_motion('V2000R')
+    #stored, not run
+    assert not syringe_motor.is_motion('s11A0R')
+
+@pytest.fixture
+def group(emulator):
+    """A MotorGroup of addresses 1 and 2 on the emulator."""
+    g=syringe_motor.MotorGroup()
+    for n in '12':
+        g.motordict[n]=syringe_motor.Motor()
+        g.motordict[n].motor_address=n
+    g.connect(emulator.slave_path, BAUD, calibrate=False)
+    yield g
+    for m in g.motordict.values():
+        m.disconnect()
+
+def test_broadcast(emulator, group):
+    sent=[]
+    write=group.bus.srl_port.write
+    group.bus.srl_port.write=lambda data: sent.append(data) or write(data)
+    group.broadcast("V20000A1000R")
+    assert sent==[b'/AV20000A1000R\r']
+    assert group.motordict['1'].wait_until_idle(timeout=5)
+    assert group.motordict['2'].wait_until_idle(timeout=5)
+    assert group.reconcile()=={'1': 1000, '2': 1000}
+
+def test_start_together(emulator, group):
+    group.start({'1': 'V20000A2000', '2': 'V20000A3000'})
+    for m in group.motordict.values():
+        assert m.wait_until_idle(timeout=5)
+    assert group.reconcile()=={'1': 2000, '2': 3000}
+    #a broadcast reaches every motor's cache and model, though nothing replied
+    assert group.motordict['2'].model.predict(time.monotonic())==(3000, False)
+
+def test_inject_reaches_target(motor):
+    motor.mL_per_rad=motor.motor_position_per_rad=1.0
+    target, warnings=motor.inject(2000, 0.1)
+    assert target==2000 and warnings==[]
+    #inject only sends the move
+    assert motor.motor_position!=2000
+    assert motor.wait_for_position(target, 20000, timeout=5)
+
+def test_inject_rejected():
+    emu=syringe_emulator.Emulator('1', baud=BAUD, require_init=True)
+    emu.start()
+    motor=syringe_motor.Motor()
+    try:
+        motor.connect(emu.slave_path, BAUD, '1')
+        motor.mL_per_rad=motor.motor_position_per_rad=1.0
+        with pytest.raises(ValueError, match="rejected"):
+            motor.inject(2000, 0.1)
+        assert motor.getPosition(fresh=True)==0
+    finally:
+        motor.disconnect()
+        emu.stop()
+
+def new_group(*addresses):
+    g=syringe_motor.MotorGroup()
+    for n in addresses:
+        g.motordict[n]=syringe_motor.Motor()
+        g.motordict[n].motor_address=n
+    return g
+
+def test_connect_calibrates_the_port(emulator):
+    g=new_group('5', '1')
+    try:
+        bus=g.connect(emulator.slave_path, BAUD)
+        #measured with the first motor that answers
+        profile=g.bus_profiles[(emulator.slave_path, BAUD)]
+        assert profile==bus.profile()
+        assert profile['turnaround'] is not None and profile['turnaround']<=profile['turnaround_max']
+        assert profile['delay']<=bus.default_delay()
+    finally:
+        for m in g.motordict.values():
+            m.disconnect()
+
+def test_bus_profile_round_trip(tmp_path):
+    path=str(tmp_path/'calibration.xml')
+    g=new_group('1')
+    g.bus_profiles[('/dev/ttyUSB0', 9600)]={'turnaround':0.002, 'turnaround_max':0.003, 'delay':0.0}
+    g.bus_profiles[('/dev/ttyUSB1', 115200)]={'turnaround':0.001, 'turnaround_max':0.001, 'delay':None}
+    with open(path, 'wb') as f:
+        f.write(g.to_xml())
+    loaded=syringe_motor.MotorGroup()
+    loaded.load(path)
+    assert loaded.bus_profiles=={('/dev/ttyUSB0', 9600): {'turnaround':0.002, 'turnaround_max':0.003, 'delay':0.0},
+                                 ('/dev/ttyUSB1', 115200): {'turnaround':0.001, 'turnaround_max':0.001}}
+
+def test_reconnect_uses_the_saved_profile(emulator, monkeypatch):
+    g=new_group('1')
+    profile={'turnaround':0.004, 'turnaround_max':0.005, 'delay':0.001}
+    g.bus_profiles[(emulator.slave_path, BAUD)]=profile
+    def calibrate(self, address, samples=8):
+        raise AssertionError("the saved profile should be used")
+    monkeypatch.setattr(syringe_motor.SerialBus, 'calibrate', calibrate)
+    try:
+        bus=g.connect(emulator.slave_path, BAUD)
+        assert bus.profile()==profile
+    finally:
+        for m in g.motordict.values():
+            m.disconnect()
+
+def test_serialize_is_atomic(tmp_path):
+    path=tmp_path/'calibration.xml'
+    path.write_bytes(b'old')
+    path.chmod(0o640)
+    inode=path.stat().st_ino
+    g=new_group('1')
+    assert g.serialize(str(path))
+    #a new file renamed over the old one, with the old one's permissions
+    assert path.read_bytes()==g.to_xml()
+    assert path.stat().st_ino!=inode
+    assert stat.S_IMODE(path.stat().st_mode)==0o640
+    assert [p.name for p in tmp_path.iterdir()]==['calibration.xml']
+    #unchanged, so not written again
+    inode=path.stat().st_ino
+    assert not g.serialize(str(path))
+    assert path.stat().st_ino==inode
+
+def test_serialize_new_file_mode(tmp_path):
+    path=tmp_path/'calibration.xml'
+    umask=os.umask(0o022)
+    try:
+        assert new_group('1').serialize(str(path))
+    finally:
+        os.umask(umask)
+    assert stat.S_IMODE(path.stat().st_mode)==0o644
+
+def test_save_later(tmp_path):
+    path=tmp_path/'calibration.xml'
+    g=new_group('1')
+    #nothing marked dirty
+    g.save_later(str(path), delay=0.01)
+    time.sleep(0.05)
+    assert not path.exists()
+
+    g.mark_dirty('1')
+    g.save_later(str(path), delay=0.01)
+    end=time.monotonic()+5
+    while not path.exists() and time.monotonic()<end:
+        time.sleep(0.01)
+    assert path.read_bytes()==g.to_xml()
+    assert not g.dirty
+    assert not g.flush()
+
+def test_failed_flush_stays_dirty(tmp_path, monkeypatch):
+    path=tmp_path/'calibration.xml'
+    path.write_bytes(b'old')
+    g=new_group('1')
+    g.mark_dirty('1')
+    g.save_later(str(path), delay=60)
+    def replace(src, dst):
+        raise OSError("disk full")
+    monkeypatch.setattr(os, 'replace', replace)
+    with pytest.raises(OSError):
+        g.flush()
+    #the old file is untouched and the temporary file is gone
+    assert path.read_bytes()==b'old'
+    assert [p.name for p in tmp_path.iterdir()]==['calibration.xml']
+    assert g.dirty=={'1'}
+
+    monkeypatch.undo()
+    assert g.flush()
+    assert path.read_bytes()==g.to_xml()
+    assert not g.dirty
+
+def test_program_slots():
+    assert syringe_motor.parse_slots('11-15')==range(11, 16)
+    assert syringe_motor.parse_slots('3')==range(3, 4)
+    assert syringe_motor.parse_slots('')==range(0)
+    with pytest.raises(ValueError):
+        syringe_motor.parse_slots('0-4')
+    for slots in (range(11, 16), range(3, 4), range(0)):
+        assert syringe_motor.parse_slots(syringe_motor.format_slots(slots))==slots
+
+def test_repeats_run_from_a_slot(emulator, counting):
+    program="/1gV20000A100V20000A0G2R"
+    assert counting.run_program(program).error==syringe_motor.ERR_NONE
+    assert counting.wait_until_idle(timeout=5)
+    #the first run is sent whole, without an EEPROM write
+    assert [m for m in counting.sent if m.startswith('/1g') or m.startswith('/1s')]==[program]
+    assert counting.programs=={}
+
+    del counting.sent[:]
+    assert counting.run_program(program).error==syringe_motor.ERR_NONE
+    assert counting.wait_until_idle(timeout=5)
+    assert counting.sent[:2]==["/1s11gV20000A100V20000A0G2R", "/1e11R"]
+    assert emulator.motors['1'].programs[11]
+
+    del counting.sent[:]
+    assert counting.run_program(program).error==syringe_motor.ERR_NONE
+    assert counting.sent[0]=="/1e11R"
+    assert counting.wait_until_idle(timeout=5)
+
+def test_least_recently_run_slot_is_reused(emulator, counting):
+    counting.program_slots=range(11, 13)
+    programs=["/1V20000A%dR"%p for p in (100, 200, 300)]
+    slots=[counting.store_program(p) for p in programs[:2]]
+    assert slots==[11, 12]
+    #run the first again, so the second is the oldest
+    assert counting.run_program(programs[0]).error==syringe_motor.ERR_NONE
+    assert counting.wait_until_idle(timeout=5)
+    assert counting.store_program(programs[2])==12
+    assert list(counting.programs)==[11, 12]
+    #already stored, so nothing is written
+    del counting.sent[:]
+    assert counting.store_program(programs[0])==11
+    assert counting.sent==[]
+
+def test_slot_changed_behind_our_back(emulator, counting):
+    program="/1V20000A100R"
+    assert counting.store_program(program)==11
+    del emulator.motors['1'].programs[11]
+    assert counting.run_program(program).error==syringe_motor.ERR_BAD_COMMAND
+    assert counting.programs=={}
+    #run whole, then stored again once it repeats
+    for i in range(2):
+        assert counting.run_program(program).error==syringe_motor.ERR_NONE
+        assert counting.wait_until_idle(timeout=5)
+    assert list(counting.programs)==[11]
+    assert emulator.motors['1'].programs[11]
+
+def test_programs_that_cannot_be_stored(counting):
+    long_program="/1"+"V20000A100"*30+"R"
+    assert counting.store_program(long_program) is None
+    counting.program_slots=range(0)
+    assert counting.store_program("/1V20000A100R") is None
+    #run as ordinary commands instead
+    for i in range(2):
+        assert counting.run_program("/1V20000A100R").error==syringe_motor.ERR_NONE
+        assert counting.wait_until_idle(timeout=5)
+    assert counting.programs=={}
+
+def position_queries(motor):
+    return motor.sent.count("/"+motor.motor_address+"?0")
+
+def test_idle_position_is_cached(counting):
+    assert counting.getPosition()==0
+    assert counting.getPosition()==0
+    assert counting.status().ready
+    #one '?0', and its reply said the motor was idle
+    assert counting.sent==['/1?0']
+    assert counting.getPosition(fresh=True)==0
+    assert position_queries(counting)==2
+
+def test_cache_expires(counting):
+    counting.max_age=0.05
+    counting.getPosition()
+    time.sleep(0.06)
+    counting.getPosition()
+    assert position_queries(counting)==2
+
+def test_motion_invalidates(counting):
+    counting.getPosition()
+    #not motion: a velocity, and a stored program that isn't run
+    counting.sendCommand("/1V20000R")
+    counting.sendCommand("/1s11A5000R")
+    counting.getPosition()
+    assert position_queries(counting)==1
+
+    counting.sendCommand("/1A20000R")
+    assert counting.getPosition()<20000
+    #busy, so every read asks
+    assert counting.getPosition()<20000
+    assert position_queries(counting)==3
+    assert counting.wait_until_idle(timeout=5)
+    assert counting.getPosition()==20000
+    del counting.sent[:]
+    assert counting.getPosition()==20000
+    assert counting.sent==[]
+    #setting the position, and stopping
+    counting.sendCommand("/1z5000R")
+    assert counting.getPosition()==5000
+    counting.sendCommand("/1TR")
+    assert counting.getPosition()==5000
+    assert position_queries(counting)==2
+
+def test_broadcast_invalidates(emulator, group):
+    motors=group.motordict.values()
+    for m in motors:
+        assert m.getPosition()==0
+    group.broadcast("V20000A100R")
+    for m in motors:
+        assert m._cached(m._position) is None
+    for m in motors:
+        assert m.wait_until_idle(timeout=5)
+        assert m.getPosition()==100
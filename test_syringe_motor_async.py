@@ -0,0 +1,30 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""asyncio motors on the emulator."""
+import time
+import asyncio
+import syringe_motor
+import syringe_motor_async
+from conftest import BAUD
+
+def test_async_commands_reach_the_model(emulator):
+    async def main():
+        motor=syringe_motor_async.AsyncMotor()
+        assert await motor.connect(emulator.slave_path, BAUD)
+        try:
+            assert await motor.query_position()==0
+            #the reply was cached and went to the motion model
+            assert motor.motor.getPosition()==0
+            assert motor.motor.model.predict(time.monotonic())==(0, False)
+            assert motor.motor.idle_timeout()==syringe_motor.IDLE_MARGIN
+
+            await motor.move_to(20000, velocity=20000)
+            #motion threw the cached position away
+            assert motor.motor._cached(motor.motor._position) is None
+            position, busy=motor.motor.model.predict(time.monotonic())
+            assert busy and 0<position<20000
+            assert motor.motor.idle_timeout()<syringe_motor.IDLE_TIMEOUT
+            assert await motor.wait_until_idle(timeout=5)
+            assert motor.motor.model.predict(time.monotonic())==(20000, False)
+        finally:
+            motor.bus.close()
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""LTTB downsampling and the chunked sample store behind the Plot tab."""
+import numpy as np
+import pytest
+
+syringe_plot=pytest.importorskip('syringe_plot')
+from syringe_plot import lttb, ChunkedSeries
+
+def test_lttb_small():
+    x=np.arange(10.0)
+    assert list(lttb(x, x, 10))==list(range(10))
+    assert list(lttb(x, x, 20))==list(range(10))
+    assert list(lttb(x, x, 2))==[0, 9]
+    assert list(lttb(x, x, 1))==[0]
+
+def test_lttb_keeps_the_shape():
+    x=np.arange(1000.0)
+    y=np.sin(x/50)
+    y[437]=10
+    picked=lttb(x, y, 50)
+    assert len(picked)==50
+    assert picked[0]==0 and picked[-1]==999
+    assert np.all(np.diff(picked)>0)
+    #a spike is what a triangle is largest for
+    assert 437 in picked
+    #still close to the curve between the points kept
+    assert np.max(np.abs(np.interp(x, x[picked], y[picked])-y)[np.abs(x-437)>40])<0.1
+
+@pytest.fixture
+def series():
+    s=ChunkedSeries(chunk=64, factor=4)
+    for i in range(10000):
+        s.append(float(i), np.sin(i/500.0))
+    return s
+
+def test_series_levels(series):
+    assert len(series)==10000
+    assert series.first_time()==0 and series.last_time()==9999
+    #64 -> 16 -> 4 samples per chunk of samples, level by level
+    assert len(series.levels)>=3
+    assert len(series.levels[1].full)*64+series.levels[1].count==10000//64*16
+    series.clear()
+    assert len(series)==0 and series.first_time() is None and series.last_time() is None
+
+def test_window_recent_span_is_exact(series):
+    t, v=series.window(9900, 9999, 200)
+    assert list(t)==list(np.arange(9900.0, 10000.0))
+    assert np.allclose(v, np.sin(t/500.0))
+
+def test_window_long_span(series, monkeypatch):
+    sizes=[]
+    def counting(x, y, n):
+        sizes.append(len(x))
+        return lttb(x, y, n)
+    monkeypatch.setattr(syringe_plot, 'lttb', counting)
+    t, v=series.window(0, 9999, 100)
+    assert len(t)==100
+    assert np.all(np.diff(t)>0) and t[0]>=0 and t[-1]<=9999
+    assert np.allclose(v, np.sin(t/500.0))
+    #read from a coarse level, not all 10000 samples
+    assert sizes and max(sizes)<2500
+    #a span inside the run
+    t, v=series.window(2000, 3000, 50)
+    assert len(t)<=50 and t[0]>=2000 and t[-1]<=3000
+
+def test_window_does_not_grow_with_the_run():
+    def cost(samples):
+        s=ChunkedSeries(chunk=64, factor=4)
+        for i in range(samples):
+            s.append(float(i), 0.0)
+        sizes=[]
+        real=syringe_plot.lttb
+        syringe_plot.lttb=lambda x, y, n: sizes.append(len(x)) or real(x, y, n)
+        try:
+            s.window(0, samples, 100)
+        finally:
+            syringe_plot.lttb=real
+        return max(sizes)
+    assert cost(100000)<=4*cost(10000)
@@ -0,0 +1,91 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Adapter listing and replug watching, on a made up sysfs tree."""
+import os
+import queue
+import pytest
+import syringe_ports
+from syringe_ports import PortWatcher, adapter_info, enumerate_adapters
+
+class FakeSys:
+    """A sysfs and /dev with USB serial adapters plugged in and out."""
+
+    def __init__(self, root):
+        self.sysfs=str(root/'sys')
+        self.dev=str(root/'dev')
+        os.makedirs(os.path.join(self.sysfs, 'class', 'tty'))
+        os.makedirs(os.path.join(self.sysfs, 'bus', 'usb-serial', 'devices'))
+        os.makedirs(self.dev)
+        self.usb=0
+
+    def plug(self, name, vid, pid, serial='A1'):
+        """Adds a USB device and its tty, like ftdi_sio would."""
+        self.usb+=1
+        usb=os.path.join(self.sysfs, 'devices', 'usb1', '1-%d'%self.usb)
+        tty=os.path.join(usb, '1-%d:1.0'%self.usb, name)
+        os.makedirs(tty)
+        for key, value in (('idVendor', vid), ('idProduct', pid), ('serial', serial), ('product', 'Some adapter')):
+            with open(os.path.join(usb, key), 'w') as f:
+                f.write(value+'\n')
+        os.symlink(tty, os.path.join(self.sysfs, 'bus', 'usb-serial', 'devices', name))
+        os.makedirs(os.path.join(self.sysfs, 'class', 'tty', name))
+        os.symlink(tty, os.path.join(self.sysfs, 'class', 'tty', name, 'device'))
+        open(os.path.join(self.dev, name), 'w').close()
+
+    def unplug(self, name):
+        os.unlink(os.path.join(self.sysfs, 'bus', 'usb-serial', 'devices', name))
+        os.unlink(os.path.join(self.sysfs, 'class', 'tty', name, 'device'))
+        os.rmdir(os.path.join(self.sysfs, 'class', 'tty', name))
+        os.unlink(os.path.join(self.dev, name))
+
+@pytest.fixture
+def fake(tmp_path):
+    return FakeSys(tmp_path)
+
+def test_enumerate_adapters(fake):
+    fake.plug('ttyUSB0', '0403', 'E0B0', 'SP1')
+    fake.plug('ttyUSB1', '1234', '5678')
+    #not a USB adapter
+    os.makedirs(os.path.join(fake.sysfs, 'class', 'tty', 'ttyS0'))
+    assert syringe_ports.has_sysfs(fake.sysfs)
+
+    adapters=enumerate_adapters(sysfs=fake.sysfs, dev=fake.dev)
+    assert adapters==[syringe_ports.Adapter(os.path.join(fake.dev, 'ttyUSB0'), '0403', 'e0b0', 'SP1',
+                                            "Silverpak/EZStepper FTDI adapter")]
+    every=enumerate_adapters({}, fake.sysfs, fake.dev)
+    assert [a.device for a in every]==[os.path.join(fake.dev, n) for n in ('ttyUSB0', 'ttyUSB1')]
+    assert every[1].description=='Some adapter'
+    assert adapter_info('ttyS0', fake.sysfs, fake.dev) is None
+    assert enumerate_adapters(sysfs=fake.dev)==[]
+
+def watch(fake, **args):
+    events=queue.Queue()
+    watcher=PortWatcher(lambda action, a: events.put((action, os.path.basename(a.device))), {},
+                        fake.sysfs, fake.dev, **args)
+    watcher.start()
+    return watcher, events
+
+def replug(fake, watcher, events):
+    fake.plug('ttyUSB1', '0403', '6001')
+    assert events.get(timeout=5)==('add', 'ttyUSB1')
+    fake.unplug('ttyUSB0')
+    assert events.get(timeout=5)==('remove', 'ttyUSB0')
+    watcher.stop()
+    watcher.join(5)
+    assert not watcher.is_alive()
+    #stopping a stopped watcher is harmless
+    watcher.stop()
+    assert events.empty()
+
+@pytest.mark.skipif(syringe_ports._inotify() is None, reason="no inotify")
+def test_watch_with_inotify(fake):
+    fake.plug('ttyUSB0', '0403', 'e0b0')
+    #a long poll_interval, so only inotify could notice in time
+    watcher, events=watch(fake, poll_interval=60)
+    assert set(watcher.adapters)=={os.path.join(fake.dev, 'ttyUSB0')}
+    replug(fake, watcher, events)
+
+def test_watch_by_polling(fake, monkeypatch):
+    monkeypatch.setattr(syringe_ports, '_inotify', lambda: None)
+    fake.plug('ttyUSB0', '0403', 'e0b0')
+    watcher, events=watch(fake, poll_interval=0.05)
+    replug(fake, watcher, events)
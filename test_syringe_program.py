@@ -0,0 +1,248 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Wait encoding and program compilation."""
+import re
+import math
+import time
+import numpy as np
+import pytest
+import syringe_motor
+import syringe_program
+from syringe_program import encode_wait, compile_cycle, cycle_program, sample_profile, compile_profile, profile_program
+from syringe_model import trapezoid
+
+def total_wait(program):
+    """ms a string of M waits and g...G loops waits for. Other commands take no time."""
+    def run(i):
+        total=0
+        while i<len(program):
+            c=program[i]
+            if c=='g':
+                inner, i=run(i+1)
+                m=re.match(r'G(\d+)', program[i:])
+                total+=inner*int(m.group(1))
+                i+=len(m.group(0))
+            elif c=='G':
+                return total, i
+            else:
+                m=re.match(r'([A-Za-z])(\d*)', program[i:])
+                if m.group(1)=='M':
+                    total+=int(m.group(2))
+                i+=len(m.group(0))
+        return total, i
+    return run(0)[0]
+
+def run_profile(exe, start_pos):
+    """(seconds, end position) of a compiled profile, with instant acceleration."""
+    pos=start_pos
+    seconds=0.0
+    for vel, target, wait in re.findall(r'V(\d+)A(\d+)((?:[gMG]\d*)*)', exe):
+        seconds+=abs(int(target)-pos)/float(vel)+total_wait(wait)/1000.0
+        pos=int(target)
+    return seconds+total_wait(re.match(r'/\d((?:[gMG]\d*)*)', exe).group(1))/1000.0, pos
+
+def loop_depth(program):
+    depth=deepest=0
+    for c in program:
+        if c=='g':
+            depth+=1
+            deepest=max(deepest, depth)
+        elif c=='G':
+            depth-=1
+    return deepest
+
+@pytest.mark.parametrize('ms', [0, 1, 30000, 30001, 45000, 60000, 123456, 3600000, 86400000,
+                                123456789, 604800000, 864000000, 10**12, 3*10**12+7])
+def test_encode_wait_totals(ms):
+    for depth in (3, 4):
+        program=encode_wait(ms, depth)
+        assert total_wait(program)==ms
+        assert loop_depth(program)<=depth
+        for n in re.findall(r'[MG](\d+)', program):
+            assert int(n)<=syringe_program.MAX_WAIT
+
+def test_encode_wait_short():
+    assert encode_wait(0)==''
+    assert encode_wait(500)=='M500'
+    assert encode_wait(60000)=='gM7500G8'
+    #a week is one loop
+    assert loop_depth(encode_wait(7*86400*1000))==1
+
+def test_encode_wait_limits():
+    with pytest.raises(ValueError):
+        encode_wait(-1)
+    with pytest.raises(ValueError):
+        encode_wait(30001, 0)
+    #more than 30000 repeats of 30000 ms needs a second level
+    with pytest.raises(ValueError):
+        encode_wait(30000*30000+30000, 1)
+    assert total_wait(encode_wait(30000*30000+30000, 2))==30000*30000+30000
+
+def test_encode_wait_is_fast():
+    encode_wait.cache_clear()
+    start=time.perf_counter()
+    for ms in (123456789, 864000000, 10**12, 987654321987):
+        encode_wait(ms, 4)
+    assert time.perf_counter()-start<0.5
+
+def test_compile_cycle():
+    exe=compile_cycle('1', 1000, 5000, 2000, 4000, 500, 86400000, 10)
+    assert exe.startswith('/1gV2000A1000M500V4000A5000')
+    assert exe.endswith('G10R')
+    assert total_wait(exe[2:-1])==(500+86400000)*10
+
+def test_compile_cycle_limits():
+    with pytest.raises(ValueError):
+        compile_cycle('1', 0, 1000, syringe_program.MAX_VELOCITY+1, 1000, 0, 0, 1)
+    with pytest.raises(ValueError):
+        compile_cycle('1', -1, 1000, 1000, 1000, 0, 0, 1)
+    with pytest.raises(ValueError):
+        compile_cycle('1', 0, 1000, 1000, 1000, 0, 0, syringe_program.MAX_REPEATS+1)
+
+def test_cycle_program():
+    motor=syringe_motor.Motor()
+    motor.motor_position=100000
+    steps=0.1/motor.mL_per_rad*motor.motor_position_per_rad
+    exe, warnings=cycle_program(motor, 0.1, 1, 0, 2, 0, 3)
+    assert warnings==[]
+    assert exe=='/1gV%dA%dV%dA100000G3R'%(steps, 100000-steps, steps/2)
+
+def test_cycle_program_clamps_at_zero():
+    motor=syringe_motor.Motor()
+    motor.motor_position=10
+    exe, warnings=cycle_program(motor, 1.0, 1, 0, 1, 0, 1)
+    assert len(warnings)==1
+    assert 'A0' in exe
+
+def test_cycle_program_rejects():
+    motor=syringe_motor.Motor()
+    with pytest.raises(ValueError):
+        cycle_program(motor, 0.1, 0, 0, 1, 0, 1)
+    with pytest.raises(ValueError):
+        cycle_program(motor, -0.1, 1, 0, 1, 0, 1)
+
+def test_cycle_runs_on_the_emulator(emulator, motor):
+    motor.sendCommand("/1z2000R")
+    motor.getPosition(fresh=True)
+    exe, warnings=cycle_program(motor, 0.01, 0.05, 100, 0.05, 100, 2)
+    assert motor.run_program(exe).error==syringe_motor.ERR_NONE
+    assert motor.wait_until_idle(timeout=5)
+    assert motor.getPosition(fresh=True)==int(motor.motor_position)
+
+def test_sample_profile():
+    t, flow=sample_profile(lambda t: 2*t, 10)
+    assert len(t)==1001 and t[-1]==10
+    assert flow[-1]==20
+    #functions that only take a float
+    t, flow=sample_profile(lambda t: 0 if t<5 else 1, 10, dt=1)
+    assert list(flow)==[0]*5+[1]*6
+    t, flow=sample_profile([0, 2], 10, dt=5)
+    assert list(flow)==[0, 1, 2]
+
+def test_sample_profile_rejects():
+    with pytest.raises(ValueError):
+        sample_profile(1.0, 10)
+    with pytest.raises(ValueError):
+        sample_profile([0, 1], 0)
+    with pytest.raises(ValueError):
+        sample_profile(lambda t: np.full_like(t, np.nan), 10)
+
+@pytest.mark.parametrize('profile', [lambda t: 1.0+0*t, [0, 2], lambda t: 0 if t<30 else 1, lambda t: -np.sin(t/10)])
+def test_profile_program(profile):
+    motor=syringe_motor.Motor()
+    motor.motor_position=500000
+    steps_per_mL=motor.motor_position_per_rad/motor.mL_per_rad
+    t, flow=sample_profile(profile, 60)
+    volume=np.sum((flow[1:]+flow[:-1])*0.5*np.diff(t))/60.0
+    exe, warnings=profile_program(motor, profile, 60, tolerance=0.001)
+    assert warnings==[]
+    assert len(exe)<=syringe_program.MAX_COMMAND_LENGTH
+    seconds, pos=run_profile(exe, motor.motor_position)
+    assert seconds==pytest.approx(60, abs=0.01)
+    assert abs(pos-motor.motor_position-volume*steps_per_mL)<=0.001*steps_per_mL+1
+
+def test_profile_program_rejects():
+    motor=syringe_motor.Motor()
+    with pytest.raises(ValueError):
+        profile_program(motor, 1.0, 60, tolerance=0)
+    #far faster than the motor goes
+    with pytest.raises(ValueError):
+        profile_program(motor, 1e6, 60)
+    #too many moves for one command
+    with pytest.raises(ValueError):
+        profile_program(motor, lambda t: np.sin(t*10), 60, tolerance=1e-6)
+
+def test_compile_profile_clamps():
+    exe, warnings=compile_profile('1', 20000, np.array([0, 10.0]), np.array([0, -22690.0]))
+    #stops at 0 at the flow asked for, and waits out the rest of the 10 s
+    assert exe=='/1V2269A0M1186R'
+    assert len(warnings)==1
+    assert run_profile(exe, 20000)==pytest.approx((10, 0), abs=0.01)
+
+    exe, warnings=compile_profile('1', 900, np.array([0, 10.0]), np.array([0, 200.0]), max_pos=1000)
+    assert exe=='/1V20A1000M5000R'
+    assert len(warnings)==1
+
+def test_compile_profile_waits():
+    exe, warnings=compile_profile('1', 20000, np.array([0, 10.0, 20]), np.array([0, 0, 1000.0]))
+    assert exe=='/1M10000V100A21000R'
+    assert warnings==[]
+
+def test_profile_runs_on_the_emulator(emulator, motor):
+    motor.sendCommand("/1z2000R")
+    motor.getPosition(fresh=True)
+    exe, warnings=profile_program(motor, [0.0, 0.6], 1, tolerance=0.0005)
+    assert motor.run_program(exe).error==syringe_motor.ERR_NONE
+    assert motor.wait_until_idle(timeout=5)
+    assert motor.getPosition(fresh=True)==run_profile(exe, 2000)[1]
+
+def test_limits_are_shared():
+    assert syringe_program.MAX_VELOCITY is syringe_motor.MAX_VELOCITY
+    assert syringe_program.MAX_COMMAND_LENGTH is syringe_motor.MAX_COMMAND_LENGTH
+
+def test_ramp_velocity():
+    assert syringe_program.ramp_velocity(1000, 2, math.inf)==500
+    vel=syringe_program.ramp_velocity(1000, 2, 1000)
+    assert 1000/vel+vel/1000==pytest.approx(2)
+    assert trapezoid(1000, vel, 1000, 0)[1]==pytest.approx(2)
+    #needs 2 s just to speed up and slow down
+    assert syringe_program.ramp_velocity(1000, 1.9, 1000) is None
+
+def ramped_seconds(exe, start_pos, accel):
+    """Like run_profile, with moves that ramp at accel."""
+    pos=start_pos
+    seconds=0.0
+    for vel, target, wait in re.findall(r'V(\d+)A(\d+)((?:[gMG]\d*)*)', exe):
+        seconds+=trapezoid(abs(int(target)-pos), int(vel), accel, 0)[1]+total_wait(wait)/1000.0
+        pos=int(target)
+    return seconds
+
+def test_compile_profile_ramps():
+    knots=np.array([0, 1.0, 2.0, 3.0]), np.array([0, 2000.0, 2500.0, 2500.0])
+    exe, warnings=compile_profile('1', 0, *knots, accel=20000)
+    assert warnings==[]
+    assert ramped_seconds(exe, 0, 20000)==pytest.approx(3, abs=0.002)
+    #faster than the fitted line, to make up for the ramps
+    assert int(re.match(r'/1V(\d+)', exe).group(1))>2000
+    #without the ramps each move would end late
+    exe, warnings=compile_profile('1', 0, *knots)
+    assert ramped_seconds(exe, 0, 20000)>3.1
+
+    exe, warnings=compile_profile('1', 0, np.array([0, 0.1]), np.array([0, 2000.0]), accel=20000)
+    assert len(warnings)==1 and "late" in warnings[0]
+
+def test_ramped_profile_runs_on_the_emulator(emulator, motor):
+    motor.accel_scale=emulator.motors['1'].accel_scale
+    motor.sendCommand("/1L20z2000R")
+    motor.getPosition(fresh=True)
+    #about 5000 steps/s, which takes the motor a quarter of a second to reach
+    slot, warnings=motor.upload_profile([0.6, 0.6], 1, tolerance=0.0005, start=False)
+    assert warnings==[]
+    assert slot in motor.program_slots
+    assert motor.getPosition(fresh=True)==2000
+    start=time.monotonic()
+    motor.sendCommand("/1e"+str(slot)+"R")
+    while emulator.motors['1'].busy() and time.monotonic()<start+5:
+        time.sleep(0.002)
+    assert time.monotonic()-start==pytest.approx(1, abs=0.03)
+    #uploading it again reuses the slot
+    assert motor.upload_profile([0.6, 0.6], 1, tolerance=0.0005)[0]==slot
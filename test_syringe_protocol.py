@@ -0,0 +1,118 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Protocol compilation, and timed runs on the emulator."""
+import json
+import time
+import threading
+import pytest
+import syringe_motor
+import syringe_protocol
+from syringe_protocol import Action, ProtocolRunner, compile_actions, load_protocol, skew_report, sleep_until
+from conftest import BAUD
+
+START=500000
+
+def make_group():
+    group=syringe_motor.MotorGroup()
+    for n in '12':
+        group.motordict[n]=syringe_motor.Motor()
+        group.motordict[n].motor_address=n
+        group.motordict[n].motor_position=START
+    return group
+
+@pytest.fixture
+def group(emulator):
+    """A MotorGroup of addresses 1 and 2 on the emulator, both at START."""
+    g=make_group()
+    g.connect(emulator.slave_path, BAUD)
+    for n in '12':
+        g.motordict[n].sendCommand("/"+n+"z"+str(START)+"R")
+    yield g
+    for m in g.motordict.values():
+        m.disconnect()
+
+def test_load_protocol(tmp_path):
+    path=tmp_path/'mix.json'
+    path.write_text(json.dumps([{"time": 0, "pump": 1, "action": "inject", "ml": 0.5, "secs": 10},
+                                {"time": 5, "pump": "2", "action": "stop"}]))
+    assert load_protocol(str(path))==[Action(0.0, '1', 'inject', {'ml': 0.5, 'secs': 10}),
+                                      Action(5.0, '2', 'stop', {})]
+
+def test_compile_actions_follows_position():
+    group=make_group()
+    steps, warnings=compile_actions(group, [Action(1, '1', 'draw', {'ml': 0.1, 'secs': 10}),
+                                            Action(0, '1', 'inject', {'ml': 0.1, 'secs': 10}),
+                                            Action(2, '2', 'stop', {})])
+    assert warnings==[]
+    #sorted by time
+    assert [s.action.kind for s in steps]==['inject', 'draw', 'stop']
+    assert steps[0].body.startswith('V') and 'P' in steps[0].body
+    assert steps[2].body is None
+    #the group's motors are not moved, only their copies
+    assert group.motordict['1'].motor_position==START
+
+def test_expected_motor_shares_nothing():
+    motor=make_group().motordict['1']
+    motor.mL_per_rad=0.02
+    expected=syringe_protocol.expected_motor(motor)
+    assert expected.mL_per_rad==0.02 and expected.motor_position==START
+    assert expected.bus is not motor.bus and expected.model is not motor.model
+    assert expected.programs is not motor.programs
+
+@pytest.mark.parametrize('action, words', [
+    (Action(0, '9', 'stop', {}), "pump 9"),
+    (Action(-1, '1', 'stop', {}), "negative"),
+    (Action(0, '1', 'spin', {}), "unknown action"),
+    (Action(0, '1', 'inject', {'secs': 1}), "pump 1 inject at 0 s"),
+    (Action(0, '1', 'inject', {'ml': 100, 'secs': 1}), "velocity"),
+    (Action(3, '2', 'draw', {'ml': 100, 'secs': 1000}), "pump 2 draw at 3 s"),
+])
+def test_compile_actions_rejects(action, words):
+    with pytest.raises(ValueError) as e:
+        compile_actions(make_group(), [action])
+    assert words in str(e.value)
+
+def test_sleep_until():
+    deadline=time.monotonic()+0.05
+    assert sleep_until(deadline)
+    assert 0<=time.monotonic()-deadline<0.005
+    cancel=threading.Event()
+    cancel.set()
+    assert not sleep_until(time.monotonic()+10, cancel)
+
+def test_skew_report():
+    assert skew_report([])['mean_skew_ms'] is None
+    a=Action(0, '1', 'stop', {})
+    report=skew_report([syringe_protocol.Dispatch(a, 0, 0, 0.001, None),
+                        syringe_protocol.Dispatch(a, 0, 0, -0.003, None),
+                        syringe_protocol.Dispatch(a, 0, None, None, "no reply")])
+    assert report['actions']==3 and report['errors']==1
+    assert report['mean_skew_ms']==pytest.approx(-1)
+    assert report['max_skew_ms']==pytest.approx(1)
+    assert report['max_abs_skew_ms']==pytest.approx(3)
+
+def test_runner_on_the_emulator(emulator, group):
+    actions=[Action(0, '1', 'inject', {'ml': 0.01, 'secs': 10}),
+             Action(0, '2', 'draw', {'ml': 0.01, 'secs': 10}),
+             Action(0.2, '1', 'stop', {}),
+             Action(0.2, '2', 'stop', {})]
+    runner=ProtocolRunner(group, actions)
+    dispatches=runner.run(start_delay=0.1)
+    assert [d.action for d in dispatches]==sorted(actions, key=lambda a: a.time)
+    for d in dispatches:
+        assert d.error is None
+        #generous, for a loaded test machine
+        assert abs(d.skew)<0.02
+    time.sleep(0.1)
+    positions=group.reconcile()
+    #both moved for about 0.2 s, then stopped, in opposite directions
+    assert positions['1']>START>positions['2']
+    assert abs(emulator.motors['1'].current_position()-positions['1'])<=1
+
+def test_runner_cancel(emulator, group):
+    cancel=threading.Event()
+    cancel.set()
+    action=Action(0, '1', 'inject', {'ml': 0.01, 'secs': 10})
+    runner=ProtocolRunner(group, [action])
+    [dispatch]=runner.run(start_delay=0.1, cancel=cancel)
+    assert dispatch.action==action and dispatch.error=='cancelled' and dispatch.sent is None
+    assert int(emulator.motors['1'].current_position())==START
@@ -0,0 +1,164 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Flight recordings, read back and replayed against the emulator."""
+import io
+import threading
+import pytest
+import syringe_emulator
+import syringe_motor
+import syringe_recorder
+from syringe_recorder import FlightRecorder, read_records, sessions, pair_replies, port_names, replay, TX, RX, LOST, OPEN
+from conftest import BAUD
+
+@pytest.fixture
+def recorder(tmp_path):
+    """Records every SerialBus to a small ring in tmp_path."""
+    r=syringe_recorder.install(str(tmp_path/'test.ring'), size=syringe_recorder.HEADER_SIZE+256*syringe_recorder.RECORD_SIZE)
+    yield r
+    syringe_motor.SerialBus.recorder=None
+    r.close()
+
+def test_round_trip(tmp_path):
+    path=str(tmp_path/'test.ring')
+    r=FlightRecorder(path)
+    r.opened('/dev/ttyUSB0', 9600, 10.0)
+    r.tx('/dev/ttyUSB0', '/1?0', 11.0)
+    r.rx('/dev/ttyUSB0', '/1?0', b'/0`1234\x03', 11.5, 0.012)
+    r.lost('/dev/ttyUSB1', '/2?0', 12.0, 0.5)
+    long_frame=('/1'+'gV1000A0M500V1000A1000G10'*12+'R').encode('utf-8')
+    r.record(TX, 1, '1', long_frame, 13.0)
+    r.close()
+
+    records=read_records(path)
+    assert [x.kind for x in records]==[OPEN, TX, RX, LOST, TX]
+    assert [x.seq for x in records[:4]]==[0, 1, 2, 3]
+    assert [x.bus for x in records]==[1, 1, 1, 2, 1]
+    assert records[0].data==b'/dev/ttyUSB0 9600'
+    assert port_names(records)=={1: ('/dev/ttyUSB0', 9600), 2: ('#2', None)}
+    assert records[1].address=='1' and records[1].data==b'/1?0' and records[1].latency is None
+    assert records[2].latency==pytest.approx(0.012)
+    assert records[3].address=='2' and records[3].data==b''
+    #spilled over several records, and put back together
+    assert records[4].data==long_frame and records[4].length==len(long_frame)
+    assert syringe_recorder.format_record(records[1]).endswith("'/1?0'")
+
+    #opening it again adds after the last record
+    r=FlightRecorder(path)
+    r.tx('/dev/ttyUSB0', '/1Q', 14.0)
+    r.close()
+    assert read_records(path)[-1].data==b'/1Q'
+
+def test_ring_wraps(tmp_path):
+    path=str(tmp_path/'test.ring')
+    r=FlightRecorder(path, syringe_recorder.HEADER_SIZE+8*syringe_recorder.RECORD_SIZE)
+    for i in range(20):
+        r.tx('/dev/ttyUSB0', '/1?%d'%i, float(i))
+    r.close()
+    records=read_records(path)
+    assert [x.data for x in records]==[('/1?%d'%i).encode('utf-8') for i in range(12, 20)]
+
+def test_overwritten_start_of_long_frame(tmp_path):
+    path=str(tmp_path/'test.ring')
+    r=FlightRecorder(path, syringe_recorder.HEADER_SIZE+4*syringe_recorder.RECORD_SIZE)
+    r.record(TX, 1, '1', b'x'*(syringe_recorder.RECORD_DATA*3), 1.0)
+    r.tx('/dev/ttyUSB0', '/1Q', 2.0)
+    r.tx('/dev/ttyUSB0', '/1Q', 3.0)
+    r.close()
+    #the frame's first record is gone, so its MORE records are dropped
+    assert [x.data for x in read_records(path)]==[b'/1Q', b'/1Q']
+
+def test_not_a_recording(tmp_path):
+    path=tmp_path/'test.ring'
+    path.write_bytes(b'\0'*1000)
+    with pytest.raises(ValueError):
+        read_records(str(path))
+
+def test_sessions():
+    R=syringe_recorder.Record
+    records=[R(0, 0, 5.0, OPEN, 1, '', None, 0, b''), R(1, 0, 6.0, TX, 1, '1', None, 0, b''),
+             #another port in the same run
+             R(2, 0, 6.5, OPEN, 2, '', None, 0, b''), R(3, 0, 6.6, TX, 2, '1', None, 0, b''),
+             #a restart, numbering the buses from 1 again
+             R(4, 0, 7.0, OPEN, 1, '', None, 0, b''), R(5, 0, 8.0, TX, 1, '1', None, 0, b''),
+             #a reboot whose opening was overwritten
+             R(6, 0, 1.0, TX, 1, '1', None, 0, b'')]
+    assert [[x.seq for x in run] for run in sessions(records)]==[[0, 1, 2, 3], [4, 5], [6]]
+
+def test_pair_replies():
+    R=syringe_recorder.Record
+    run=[R(0, 0, 1.0, TX, 1, '1', None, 4, b'/1?0'), R(1, 0, 1.1, TX, 2, '1', None, 4, b'/1?0'),
+         R(2, 0, 1.2, RX, 2, '1', 0.1, 0, b''), R(3, 0, 1.3, LOST, 1, '1', 0.3, 0, b''),
+         #group commands get no reply
+         R(4, 0, 1.4, TX, 1, 'A', None, 4, b'/AQR'), R(5, 0, 1.5, TX, 1, '2', None, 4, b'/2?0'),
+         R(6, 0, 1.6, RX, 1, '2', 0.1, 0, b''), R(7, 0, 1.7, TX, 2, '1', None, 4, b'/1?0')]
+    assert [(r.seq, reply and reply.seq) for r, reply in pair_replies(run)]==[(0, 3), (1, 2), (4, None), (5, 6), (7, None)]
+
+def test_record_and_replay(emulator, recorder, motor):
+    motor.sendCommand("/1V20000A2000R")
+    motor.wait_until_idle(timeout=5)
+    motor.getPosition(fresh=True)
+    motor.bus.sendBroadcast("/AV20000A0R")
+    motor.wait_until_idle(timeout=5)
+    motor.getPosition(fresh=True)
+
+    records=read_records(recorder.path)
+    assert records[0].kind==OPEN
+    assert records[0].data.decode('utf-8').split()[-1]==str(BAUD)
+    commands=[x.data for x in records if x.kind==TX]
+    assert b'/1V20000A2000R' in commands and b'/AV20000A0R' in commands
+    for x in records:
+        if x.kind==RX:
+            assert x.latency>0
+
+    syringe_motor.SerialBus.recorder=None
+    out=io.StringIO()
+    result=replay(records, speed=2.0, out=out)
+    assert result['frames']==len(commands)
+    assert result['replies_differ']==0, out.getvalue()
+    assert result['late_ms']['max']<50
+
+def test_replay_skips_time_between_sessions():
+    R=syringe_recorder.Record
+    records=[R(0, 0, 0.0, OPEN, 1, '', None, 0, b'x %d'%BAUD), R(1, 0, 0.0, TX, 1, '1', None, 4, b'/1?0'),
+             R(2, 0, 1000.0, OPEN, 1, '', None, 0, b'x %d'%BAUD), R(3, 0, 1000.0, TX, 1, '1', None, 4, b'/1?0')]
+    out=io.StringIO()
+    result=replay(records, out=out)
+    assert result['frames']==2
+    #there were no replies recorded to compare with
+    assert result['replies_differ']==0
+    assert result['late_ms']['max']<50
+
+def test_record_and_replay_two_ports(emulator, recorder, motor):
+    emu=syringe_emulator.Emulator('1', baud=BAUD)
+    emu.start()
+    other=syringe_motor.Motor()
+    try:
+        other.connect(emu.slave_path, BAUD, '1')
+        #both ports busy at once, so their frames interleave in the ring
+        def run(m, start):
+            for i in range(20):
+                m.sendCommand("/1z%dR"%(start+i))
+                m.getPosition(fresh=True)
+        threads=[threading.Thread(target=run, args=(m, start)) for m, start in ((motor, 1000), (other, 3000))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        other.disconnect()
+        emu.stop()
+
+    records=read_records(recorder.path)
+    names=port_names(records)
+    assert sorted(port for port, baud in names.values())==sorted([emulator.slave_path, emu.slave_path])
+    assert len(sessions(records))==1
+    buses=[x.bus for x in records if x.kind!=OPEN]
+    assert buses!=sorted(buses) and buses!=sorted(buses, reverse=True)
+    for r, reply in pair_replies(records):
+        assert reply is not None and reply.kind==RX and reply.bus==r.bus
+
+    syringe_motor.SerialBus.recorder=None
+    out=io.StringIO()
+    result=replay(records, speed=2.0, out=out)
+    assert result['frames']==sum(1 for x in records if x.kind==TX)
+    #each port's positions came back from its own emulator
+    assert result['replies_differ']==0, out.getvalue()
@@ -0,0 +1,191 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Query coalescing, and the JSON-RPC server on the emulator."""
+import os
+import json
+import stat
+import socket
+import asyncio
+import pytest
+import syringe_motor
+import syringe_emulator
+import syringe_server
+from syringe_server import QueryCache
+from conftest import BAUD
+
+class Fetcher:
+    """A query that takes delay seconds and counts how often it was sent."""
+
+    def __init__(self, delay=0.01):
+        self.delay=delay
+        self.calls=0
+
+    async def __call__(self):
+        self.calls+=1
+        answer=self.calls
+        await asyncio.sleep(self.delay)
+        return answer
+
+def test_cache_coalesces():
+    async def main():
+        cache=QueryCache(tick=10)
+        fetch=Fetcher()
+        answers=await asyncio.gather(*(cache.get(('position', '1'), fetch) for i in range(10)))
+        assert answers==[1]*10
+        #answered from the cache within the tick
+        assert await cache.get(('position', '1'), fetch)==1
+        #other keys are separate
+        assert await cache.get(('status', '1'), fetch)==2
+        assert (cache.requests, cache.fetches)==(12, 2)
+    asyncio.run(main())
+
+def test_cache_tick():
+    async def main():
+        cache=QueryCache(tick=0.02)
+        fetch=Fetcher(0)
+        assert await cache.get(('position', '1'), fetch)==1
+        await asyncio.sleep(0.03)
+        assert await cache.get(('position', '1'), fetch)==2
+    asyncio.run(main())
+
+def test_cache_invalidate():
+    async def main():
+        cache=QueryCache(tick=10)
+        fetch=Fetcher()
+        assert await cache.get(('position', '1'), fetch)==1
+        assert await cache.get(('position', '2'), fetch)==2
+        cache.invalidate('1')
+        assert await cache.get(('position', '1'), fetch)==3
+        assert await cache.get(('position', '2'), fetch)==2
+    asyncio.run(main())
+
+def test_cache_invalidate_in_flight():
+    async def main():
+        cache=QueryCache(tick=10)
+        fetch=Fetcher(0.05)
+        early=asyncio.ensure_future(cache.get(('position', '1'), fetch))
+        await asyncio.sleep(0.01)
+        #the pump is told to move while the query is on the wire
+        cache.invalidate('1')
+        late=asyncio.ensure_future(cache.get(('position', '1'), fetch))
+        assert await early==1
+        assert await late==2
+        #the answer from before the move was not cached
+        assert await cache.get(('position', '1'), fetch)==2
+    asyncio.run(main())
+
+def test_cache_errors_are_not_cached():
+    async def main():
+        cache=QueryCache(tick=10)
+        calls=[]
+        async def fetch():
+            calls.append(1)
+            raise IndexError("motor did not respond")
+        for i in range(2):
+            with pytest.raises(IndexError):
+                await cache.get(('position', '1'), fetch)
+        assert len(calls)==2
+    asyncio.run(main())
+
+def test_cache_cancelled_caller():
+    async def main():
+        cache=QueryCache(tick=10)
+        fetch=Fetcher(0.05)
+        first=asyncio.ensure_future(cache.get(('position', '1'), fetch))
+        second=asyncio.ensure_future(cache.get(('position', '1'), fetch))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second==1
+        assert fetch.calls==1
+    asyncio.run(main())
+
+def test_server_on_the_emulator(emulator):
+    async def main():
+        group=syringe_motor.MotorGroup()
+        for a in '12':
+            group.motordict[a]=syringe_motor.Motor()
+            group.motordict[a].motor_address=a
+            group.motordict[a].motor_position=100000
+        server=syringe_server.PumpServer(group)
+        await server.connect(emulator.slave_path, BAUD)
+        try:
+            positions=await asyncio.gather(*(server.position('1') for i in range(10)))
+            assert positions==[0]*10
+            assert await server.stats()=={'requests': 10, 'fetches': 1}
+
+            reply=await server.call({'jsonrpc': '2.0', 'id': 1, 'method': 'inject',
+                                     'params': {'pump': '1', 'ml': 0.001, 'secs': 0.1}})
+            assert reply['result']['warnings']==[]
+            await asyncio.sleep(0.3)
+            #the move threw away the cached position
+            assert await server.position('1')==reply['result']['target']
+
+            reply=await server.call({'jsonrpc': '2.0', 'id': 2, 'method': 'position', 'params': ['9']})
+            assert reply['error']['code']==syringe_server.INVALID_PARAMS
+            reply=await server.call({'jsonrpc': '2.0', 'id': 3, 'method': 'bogus'})
+            assert 'error' in reply
+        finally:
+            for m in group.motordict.values():
+                m.disconnect()
+    asyncio.run(main())
+
+def test_moves_do_not_interleave(emulator):
+    async def main():
+        server=syringe_server.PumpServer(syringe_motor.MotorGroup(), tick=0)
+        server.motorGroup.motordict['1']=syringe_motor.Motor()
+        await server.connect(emulator.slave_path, BAUD)
+        try:
+            #both read the position only once the other's move is sent and done
+            params={'pump': '1', 'ml': 0.001, 'secs': 0.1}
+            first, second=await asyncio.gather(server.inject(**params), server.inject(**params))
+            assert second['target']==2*first['target']
+            assert await server.group.motordict['1'].wait_until_idle(timeout=5)
+            assert await server.position('1')==second['target']
+        finally:
+            server.motorGroup.motordict['1'].disconnect()
+    asyncio.run(main())
+
+def test_rejected_moves_are_errors():
+    emu=syringe_emulator.Emulator('1', baud=BAUD, require_init=True)
+    emu.start()
+    async def main():
+        server=syringe_server.PumpServer(syringe_motor.MotorGroup())
+        server.motorGroup.motordict['1']=syringe_motor.Motor()
+        await server.connect(emu.slave_path, BAUD)
+        try:
+            for method, params in (('inject', {'pump': '1', 'ml': 0.001, 'secs': 0.1}),
+                                   ('pump', {'pump': '1', 'ml': 0.001, 'pull_secs': 0.1, 'push_secs': 0.1})):
+                reply=await server.call({'jsonrpc': '2.0', 'id': 1, 'method': method, 'params': params})
+                assert reply['error']['code']==syringe_server.PUMP_ERROR
+                assert "rejected" in reply['error']['message']
+        finally:
+            server.motorGroup.motordict['1'].disconnect()
+    try:
+        asyncio.run(main())
+    finally:
+        emu.stop()
+
+def test_socket(tmp_path):
+    async def main():
+        server=syringe_server.PumpServer(syringe_motor.MotorGroup())
+        path=str(tmp_path/'pump.sock')
+        #left behind by an earlier run
+        old=socket.socket(socket.AF_UNIX)
+        old.bind(path)
+        old.close()
+        listener=await server.serve(path)
+        try:
+            assert stat.S_IMODE(os.stat(path).st_mode)==syringe_server.SOCKET_MODE
+            reader, writer=await asyncio.open_unix_connection(path)
+            writer.write(b'{"jsonrpc": "2.0", "id": 1, "method": "pumps"}\n')
+            assert json.loads(await reader.readline())=={'jsonrpc': '2.0', 'id': 1, 'result': []}
+            writer.close()
+        finally:
+            listener.close()
+            await listener.wait_closed()
+
+        other=tmp_path/'data.xml'
+        other.write_bytes(b'<constants/>')
+        with pytest.raises(FileExistsError):
+            await server.serve(str(other))
+        assert other.read_bytes()==b'<constants/>'
+    asyncio.run(main())
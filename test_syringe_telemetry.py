@@ -0,0 +1,43 @@
+#vim: set tabstop=8 softtabstop=0 expandtab shiftwidth=4 smarttab:
+"""Telemetry sampling on the emulator."""
+import time
+import numpy as np
+import pytest
+from syringe_telemetry import TelemetrySampler, fit_velocity
+
+def test_fit_velocity():
+    t=np.array([0.0, 1.0, 2.0, 3.0])
+    assert fit_velocity(t, 5+100*t)==pytest.approx(100)
+    assert fit_velocity(t[:1], t[:1]) is None
+    assert fit_velocity(np.zeros(3), np.arange(3.0)) is None
+
+def test_idle_motor_is_not_polled(counting):
+    sampler=TelemetrySampler(counting)
+    #nothing known yet, so it asks
+    assert sampler.sample()
+    assert counting.sent==['/1?0', '/1?2']
+    del counting.sent[:]
+    for i in range(5):
+        assert sampler.sample()
+    assert counting.sent==[]
+    snap=sampler.snapshot()
+    assert snap.position==0 and snap.velocity==0 and snap.reported_velocity==0
+
+def test_moving_motor_is_polled(counting):
+    sampler=TelemetrySampler(counting)
+    sampler.sample()
+    counting.sendCommand("/1V20000A20000R")
+    del counting.sent[:]
+    for i in range(4):
+        sampler.sample()
+        time.sleep(0.05)
+    assert counting.sent.count('/1?0')==4
+    snap=sampler.snapshot()
+    assert snap.reported_velocity>0
+    assert snap.velocity==pytest.approx(20000, rel=0.2)
+    assert counting.wait_until_idle(timeout=5)
+    sampler.sample()
+    del counting.sent[:]
+    sampler.sample()
+    assert counting.sent==[]
+    assert sampler.snapshot().position==20000